@@ -1,23 +1,299 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, abort, Response, stream_with_context, g, send_from_directory
 from flask_socketio import SocketIO, emit, join_room, leave_room
+import os
+import atexit
+import signal
+import io
 import json
+import gzip
 import base64
 import uuid
+import functools
+import hmac
+import time
+import threading
+import tracemalloc
+from collections import OrderedDict
 from datetime import datetime
 from crypto_utils import CryptoManager
 from user_manager import UserManager
+from key_fanout import KeyFanout
+from rate_limiter import RateLimiter
+from chat_store import ChatStore, parse_timestamp
+from chat_inbox import ChatInbox
+from membership import MembershipRegistry
+from password_hasher import DEFAULT_PASSWORD_PROFILE
+from read_state import ReadStateManager
+from attachment_store import AttachmentStore, SHA256_PATTERN
+from session_state import SessionRegistry, ChatKeyCache, PrivateKeyCache
+from memory_report import start_tracing, memory_report
+from traffic_recorder import TrafficRecorder
+from profiler import Profiler
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-here'
+# Admin endpoints are disabled unless a token is configured
+app.config['ADMIN_TOKEN'] = os.environ.get('CHAT_ADMIN_TOKEN')
 socketio = SocketIO(app, cors_allowed_origins="*")
 
+# Token bucket limits per event: {scope: (tokens per second, burst)}
+# 'sid' limits each connection, 'user' limits all of a user's connections.
+# Before login, the 'user' scope of 'login' is keyed on the claimed username
+# and the client's address, so guessing a password from one address is
+# limited without letting anyone lock the account out from elsewhere
+RATE_LIMITS = {
+    'login': {'sid': (0.2, 5), 'user': (0.2, 5)},
+    'get_public_key': {'sid': (5, 20), 'user': (10, 40)},
+    'get_public_keys': {'sid': (2, 20), 'user': (5, 40)},
+    'start_chat': {'sid': (0.5, 5), 'user': (1, 10)},
+    'add_chat_member': {'sid': (0.5, 5), 'user': (1, 10)},
+    'remove_chat_member': {'sid': (0.5, 5), 'user': (1, 10)},
+    'join_chat': {'sid': (2, 20), 'user': (5, 40)},
+    'leave_chat': {'sid': (2, 20), 'user': (5, 40)},
+    'get_chat_key': {'sid': (1, 10), 'user': (2, 20)},
+    'send_message': {'sid': (5, 20), 'user': (10, 40)},
+    'get_chat_history': {'sid': (2, 20), 'user': (5, 40)},
+    'list_chats': {'sid': (2, 20), 'user': (5, 40)},
+    'mark_read': {'sid': (5, 20), 'user': (10, 40)},
+    'create_attachment': {'sid': (0.5, 5), 'user': (1, 10)},
+    'upload_attachment_chunk': {'sid': (20, 50), 'user': (40, 100)},
+    'get_attachment_status': {'sid': (2, 20), 'user': (5, 40)},
+    'complete_attachment': {'sid': (0.5, 5), 'user': (1, 10)},
+    'get_attachment_url': {'sid': (5, 20), 'user': (10, 40)},
+}
+
+# Page sizes for the user directory and friend lists
+LIST_PAGE_SIZE = 100
+MAX_LIST_PAGE_SIZE = 1000
+
+# Page sizes for chat history, so no request decrypts a whole chat log
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 500
+
+# Most usernames looked up in one get_public_keys request
+MAX_PUBLIC_KEY_BATCH = 500
+
+# Responses at least this large are gzipped for clients that accept it
+GZIP_MIN_SIZE = 1024
+RESPONSE_CACHE_SIZE = 256
+
+# Read acks are persisted and sent to other participants in batches
+READ_RECEIPT_FLUSH_INTERVAL = 2.0  # seconds
+
+# Idle chat keys are evicted on this interval
+CHAT_KEY_EVICT_INTERVAL = 60.0  # seconds
+
+# Trace allocations for /admin/memory when CHAT_TRACEMALLOC is set
+start_tracing()
+
 # Initialize managers
-user_manager = UserManager()
+user_manager = UserManager(os.environ.get('CHAT_DATA_DIR', 'data'),
+                           password_profile=os.environ.get('CHAT_PASSWORD_PROFILE', DEFAULT_PASSWORD_PROFILE))
 crypto_manager = CryptoManager()
+key_fanout = KeyFanout(user_manager, crypto_manager)
+rate_limiter = RateLimiter(RATE_LIMITS)
+chat_store = ChatStore(user_manager, crypto_manager)
+membership = MembershipRegistry(user_manager)
+chat_inbox = ChatInbox(user_manager, chat_store, membership)
+read_state = ReadStateManager(user_manager)
+attachment_store = AttachmentStore(user_manager)
+
+# Inbound traffic is recorded for replay when CHAT_RECORD_FILE is set
+traffic_recorder = TrafficRecorder.from_env()
+if traffic_recorder is not None:
+    atexit.register(traffic_recorder.close)
+
+# Profiling is started on demand through /admin/profile or SIGUSR1
+profiler = Profiler(os.path.join(user_manager.data_dir, "profiles"), socketio.async_mode)
+if hasattr(signal, 'SIGUSR1'):
+    try:
+        signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.start_sampling())
+    except ValueError:
+        # Signal handlers can only be installed from the main thread
+        pass
+
+# Logged-in connections and chat keys; private keys are loaded only to
+# unwrap chat keys that aren't in memory
+session_registry = SessionRegistry()
+user_sessions = session_registry.user_sessions  # {username: set(session_id)}
+chat_aes_keys = ChatKeyCache()
+private_keys = PrivateKeyCache(user_manager, crypto_manager)
+
+# Rendered list responses by (URL, ETag, gzipped)
+_response_cache = OrderedDict()
+_response_cache_lock = threading.Lock()
+
+_read_receipt_task_lock = threading.Lock()
+_read_receipt_task_started = False
+
+_chat_key_task_lock = threading.Lock()
+_chat_key_task_started = False
+
+def read_receipt_flusher():
+    """Persist read cursors and send coalesced read receipts on an interval"""
+    while True:
+        socketio.sleep(READ_RECEIPT_FLUSH_INTERVAL)
+        for chat_id, receipts in read_state.flush().items():
+            socketio.emit('read_receipt', {
+                'chat_id': chat_id,
+                'receipts': receipts
+            }, to=chat_id)
+
+def start_read_receipt_flusher():
+    """Start the read receipt background task on first use"""
+    global _read_receipt_task_started
+    with _read_receipt_task_lock:
+        if not _read_receipt_task_started:
+            _read_receipt_task_started = True
+            socketio.start_background_task(read_receipt_flusher)
+
+def chat_key_evictor():
+    """Drop the keys, indexes and memberships of chats idle too long, and refilled rate limit buckets, on an interval"""
+    while True:
+        socketio.sleep(CHAT_KEY_EVICT_INTERVAL)
+        for chat_id in chat_aes_keys.evict_idle():
+            chat_store.unload(chat_id)
+        # Memberships are also loaded for chats whose key never is, e.g. to
+        # build inboxes, so they are dropped on their own last use
+        membership.evict_idle(chat_aes_keys.idle_timeout)
+        # Login buckets of addresses that never logged in have no session to
+        # release them
+        rate_limiter.prune()
+
+def start_chat_key_evictor():
+    """Start the chat key eviction background task on first use"""
+    global _chat_key_task_started
+    with _chat_key_task_lock:
+        if not _chat_key_task_started:
+            _chat_key_task_started = True
+            socketio.start_background_task(chat_key_evictor)
+
+def get_chat_key(chat_id, username):
+    """Get a chat's AES key, unwrapping it from the user's key ring if needed
+    
+    Callers must check that the user is a member of the chat first.
+    """
+    aes_key = chat_aes_keys.get(chat_id)
+    if aes_key is None and username:
+        wrapped_key = user_manager.load_wrapped_keys(username).get(chat_id)
+        if wrapped_key:
+            aes_key = crypto_manager.decrypt_aes_key(wrapped_key[0], private_keys.get(username))
+            chat_aes_keys.put(chat_id, aes_key)
+    return aes_key
+
+def rate_limited(event):
+    """Reject a Socket.IO event when the client is over its rate limit
+    
+    Every limited event is also written to the traffic recorder, if enabled,
+    and profiled when the profiler samples it.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(data=None):
+            if profiler.should_profile(event):
+                return profiler.profile_call(event, recorded, data)
+            return recorded(data)
+        
+        def recorded(data):
+            if traffic_recorder is None:
+                return limited(data)
+            started = traffic_recorder.now()
+            g.created_ids = {}
+            try:
+                return limited(data)
+            finally:
+                traffic_recorder.record_event(event, request.sid, data, started,
+                                              traffic_recorder.now() - started, g.created_ids)
+        
+        def limited(data):
+            username = session_registry.username(request.sid)
+            if username is None and event == 'login' and isinstance(data, dict):
+                # Limit login attempts against an account from each address,
+                # not just per socket
+                claimed = data.get('username')
+                if isinstance(claimed, str) and user_manager.user_exists(claimed):
+                    username = (claimed, request.remote_addr or '')
+            
+            retry_after = rate_limiter.acquire(event, request.sid, username)
+            if retry_after:
+                emit('rate_limited', {'event': event, 'retry_after': round(retry_after, 3)})
+                return
+            return handler(data if data is not None else {})
+        return wrapper
+    return decorator
+
+def note_created_id(name, value):
+    """Tell the traffic recorder about an id created by the current event"""
+    if traffic_recorder is not None:
+        g.created_ids[name] = value
 
-# Store active sessions and AES keys
-active_sessions = {}  # {session_id: {'username': str, 'private_key': obj}}
-chat_aes_keys = {}    # {chat_id: aes_key}
+@app.before_request
+def start_http_recording():
+    """Note when a request started, for the traffic recorder"""
+    if traffic_recorder is not None:
+        g.record_started = traffic_recorder.now()
+
+@app.after_request
+def record_http_request(response):
+    """Write an HTTP request to the traffic recorder; admin and static files are skipped"""
+    if traffic_recorder is not None and 'record_started' in g and \
+            not request.path.startswith(('/admin/', '/static/')):
+        traffic_recorder.record_http(request, response.status_code, g.record_started,
+                                     traffic_recorder.now() - g.record_started)
+    return response
+
+def versioned_json(version, build):
+    """Respond with JSON tagged by a version counter, honouring If-None-Match
+    
+    build() is only called when the client's copy is stale, and rendered
+    bodies are cached by URL and version, so unchanged polls cost a lookup.
+    """
+    etag = f"{user_manager.version_epoch}-{version}"
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        use_gzip = 'gzip' in request.accept_encodings
+        key = (request.full_path, etag, use_gzip)
+        with _response_cache_lock:
+            cached = _response_cache.get(key)
+            if cached is not None:
+                _response_cache.move_to_end(key)
+        if cached is None:
+            body = json.dumps(build()).encode('utf-8')
+            gzipped = use_gzip and len(body) >= GZIP_MIN_SIZE
+            if gzipped:
+                body = gzip.compress(body, compresslevel=6)
+            cached = (body, gzipped)
+            with _response_cache_lock:
+                _response_cache[key] = cached
+                while len(_response_cache) > RESPONSE_CACHE_SIZE:
+                    _response_cache.popitem(last=False)
+        
+        body, gzipped = cached
+        response = Response(body, mimetype='application/json')
+        if gzipped:
+            response.headers['Content-Encoding'] = 'gzip'
+    
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+def page_args():
+    """Get (cursor, limit) paging parameters from the query string"""
+    limit = min(max(1, request.args.get('limit', LIST_PAGE_SIZE, type=int)), MAX_LIST_PAGE_SIZE)
+    return request.args.get('cursor') or None, limit
+
+def admin_required(view):
+    """Require the configured admin token on an HTTP endpoint"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        token = app.config.get('ADMIN_TOKEN')
+        supplied = request.headers.get('X-Admin-Token', '')
+        if not token or not hmac.compare_digest(supplied, token):
+            abort(404)
+        return view(*args, **kwargs)
+    return wrapper
 
 @app.route('/')
 def index():
@@ -42,9 +318,13 @@ def register():
 
 @app.route('/users', methods=['GET'])
 def get_users():
-    """Get list of all users"""
-    users = user_manager.get_all_users()
-    return jsonify({'users': users})
+    """Get a page of registered users in username order"""
+    cursor, limit = page_args()
+    
+    def build():
+        users, next_cursor = user_manager.list_users(cursor, limit)
+        return {'users': users, 'next_cursor': next_cursor}
+    return versioned_json(user_manager.directory_version, build)
 
 @app.route('/search_users', methods=['POST'])
 def search_users():
@@ -71,27 +351,166 @@ def add_friend():
 
 @app.route('/friends/<username>', methods=['GET'])
 def get_friends(username):
-    """Get user's friends"""
-    friends = user_manager.get_friends(username)
-    return jsonify({'friends': friends})
+    """Get a page of a user's friends"""
+    cursor, limit = page_args()
+    
+    def build():
+        friends, next_cursor = user_manager.list_friends(username, cursor, limit)
+        return {'friends': friends, 'next_cursor': next_cursor}
+    try:
+        return versioned_json(user_manager.get_friends_version(username), build)
+    except ValueError:
+        return jsonify({'friends': [], 'next_cursor': None, 'message': 'Invalid cursor'}), 400
+
+@app.route('/attachments/<attachment_id>/chunks/<int:index>', methods=['PUT'])
+def upload_attachment_chunk(attachment_id, index):
+    """Upload one chunk of an encrypted attachment (body is the raw chunk)"""
+    if not attachment_store.check_token(attachment_id, 'upload', request.headers.get('X-Upload-Token')):
+        abort(403)
+    digest = request.headers.get('X-Chunk-SHA256')
+    success, message = attachment_store.put_chunk(attachment_id, index, request.stream, digest)
+    return jsonify({'success': success, 'message': message}), 200 if success else 400
+
+@app.route('/attachments/<attachment_id>/status', methods=['GET'])
+def get_attachment_upload_status(attachment_id):
+    """Get which chunks of an upload are still missing, to resume it"""
+    if not attachment_store.check_token(attachment_id, 'upload', request.headers.get('X-Upload-Token')):
+        abort(403)
+    manifest = attachment_store.get_manifest(attachment_id)
+    if manifest is None:
+        abort(404)
+    return jsonify(attachment_store.status(manifest))
+
+@app.route('/attachments/<attachment_id>/complete', methods=['POST'])
+def complete_attachment_upload(attachment_id):
+    """Finish an upload once every chunk has arrived"""
+    if not attachment_store.check_token(attachment_id, 'upload', request.headers.get('X-Upload-Token')):
+        abort(403)
+    success, message = attachment_store.complete_upload(attachment_id)
+    return jsonify({'success': success, 'message': message}), 200 if success else 400
+
+@app.route('/attachments/<attachment_id>', methods=['GET'])
+def download_attachment(attachment_id):
+    """Stream an encrypted attachment, honouring a single byte Range"""
+    if not attachment_store.check_token(attachment_id, 'download', request.args.get('token')):
+        abort(403)
+    manifest = attachment_store.get_manifest(attachment_id)
+    if manifest is None or not manifest['complete']:
+        abort(404)
+    
+    size = manifest['size']
+    start, end, status = 0, size, 200
+    if request.range is not None:
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            return Response(status=416, headers={'Content-Range': f'bytes */{size}'})
+        (start, end), status = byte_range, 206
+    
+    response = Response(stream_with_context(attachment_store.iter_range(manifest, start, end)),
+                        status=status, mimetype='application/octet-stream')
+    response.headers['Content-Length'] = str(end - start)
+    response.headers['Accept-Ranges'] = 'bytes'
+    if status == 206:
+        response.headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+    return response
+
+@app.route('/admin/rate_limits', methods=['GET'])
+@admin_required
+def get_rate_limits():
+    """Get rate limiter configuration and counters"""
+    return jsonify(rate_limiter.stats())
+
+@app.route('/admin/memory', methods=['GET'])
+@admin_required
+def get_memory():
+    """Get in-memory state sizes, and allocations by category when tracing"""
+    stats = {
+        'sessions': len(session_registry),
+        'online_users': len(user_sessions),
+        'chat_keys': len(chat_aes_keys),
+        'private_keys': len(private_keys),
+        'chat_indexes': chat_store.loaded_count(),
+        'chat_memberships': membership.loaded_count()[0],
+        'user_chat_lists': membership.loaded_count()[1],
+        'cached_responses': len(_response_cache),
+        'tracing': tracemalloc.is_tracing()
+    }
+    if tracemalloc.is_tracing():
+        stats.update(memory_report(tracemalloc.take_snapshot(), request.args.get('top', 10, type=int)))
+    return jsonify(stats)
+
+@app.route('/admin/profile', methods=['GET'])
+@admin_required
+def get_profile_status():
+    """Get the profiler's state and the profiles written so far"""
+    return jsonify(profiler.status())
+
+@app.route('/admin/profile', methods=['POST'])
+@admin_required
+def start_profile():
+    """Start stack sampling, or cProfile on a fraction of some events
+    
+    Body: {"mode": "sample", "seconds": 30, "interval_ms": 5} or
+    {"mode": "events", "events": {"send_message": 0.1}, "seconds": 30}
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        seconds = float(data.get('seconds', 30))
+        if data.get('mode', 'sample') == 'sample':
+            success, message = profiler.start_sampling(seconds, float(data.get('interval_ms', 5)) / 1000)
+        elif data.get('mode') == 'events':
+            events = data.get('events')
+            if not isinstance(events, dict) or not set(events) <= set(RATE_LIMITS):
+                raise ValueError('Unknown events')
+            success, message = profiler.profile_events(events, seconds)
+        elif data.get('mode') == 'stop':
+            profiler.stop_sampling()
+            profiler.finish_events()
+            success, message = True, "Stopped"
+        else:
+            raise ValueError('Unknown mode')
+    except (TypeError, ValueError) as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    return jsonify({'success': success, 'message': message}), 200 if success else 400
+
+@app.route('/admin/profile/<name>', methods=['GET'])
+@admin_required
+def get_profile(name):
+    """Download a written profile"""
+    return send_from_directory(os.path.abspath(profiler.output_dir), name, as_attachment=True)
 
 @socketio.on('connect')
 def handle_connect():
     """Handle client connection"""
     print(f"Client connected: {request.sid}")
+    if traffic_recorder is not None:
+        traffic_recorder.record_event('connect', request.sid, None, traffic_recorder.now(), 0)
 
 @socketio.on('disconnect')
 def handle_disconnect():
     """Handle client disconnection"""
-    print(f"Client disconnected: {request.sid}")
+    if traffic_recorder is not None:
+        traffic_recorder.record_event('disconnect', request.sid, None, traffic_recorder.now(), 0)
     
     # Clean up session data
-    if request.sid in active_sessions:
-        username = active_sessions[request.sid]['username']
-        user_manager.update_last_seen(username)
-        del active_sessions[request.sid]
+    session, last_session = session_registry.remove(request.sid)
+    if session is None:
+        print(f"Client disconnected: {request.sid}")
+        rate_limiter.forget_session(request.sid, None)
+        return
+    
+    print(f"Client disconnected: {request.sid} ({session.username}, "
+          f"{time.time() - session.connected_at:.0f}s)")
+    rate_limiter.forget_session(request.sid, session.username)
+    user_manager.update_last_seen(session.username)
+    if last_session:
+        chat_inbox.unload(session.username)
+        membership.unload_user(session.username)
+        read_state.unload(session.username)
+        private_keys.forget(session.username)
 
 @socketio.on('login')
+@rate_limited('login')
 def handle_login(data):
     """Handle user login"""
     username = data.get('username')
@@ -108,13 +527,8 @@ def handle_login(data):
         return
     
     # Store session data
-    private_key_pem = user_manager.get_user_private_key(username)
-    private_key = crypto_manager.deserialize_private_key(private_key_pem)
-    
-    active_sessions[request.sid] = {
-        'username': username,
-        'private_key': private_key
-    }
+    session_registry.add(request.sid, username)
+    start_chat_key_evictor()
     
     # Update last seen
     user_manager.update_last_seen(username)
@@ -124,8 +538,28 @@ def handle_login(data):
         'message': 'Logged in successfully',
         'username': username
     })
+    
+    # Deliver chat keys that were wrapped for this user while they were offline
+    delivered = []
+    for chat_id, (wrapped_key, is_pending) in user_manager.load_wrapped_keys(username).items():
+        # A key wrapped just before the user was removed must not reach them
+        if not is_pending or not membership.is_member(chat_id, username):
+            continue
+        aes_key = chat_aes_keys.get(chat_id)
+        if aes_key is None:
+            aes_key = crypto_manager.decrypt_aes_key(wrapped_key, private_keys.get(username))
+            chat_aes_keys.put(chat_id, aes_key)
+        emit('aes_key', {
+            'chat_id': chat_id,
+            'aes_key': base64.b64encode(aes_key).decode('utf-8')
+        })
+        delivered.append(chat_id)
+    if delivered:
+        # Keys stored since the key ring was read stay pending for next time
+        user_manager.mark_wrapped_keys_delivered(username, delivered)
 
 @socketio.on('get_public_key')
+@rate_limited('get_public_key')
 def handle_get_public_key(data):
     """Send user's public key to client"""
     username = data.get('username')
@@ -137,14 +571,43 @@ def handle_get_public_key(data):
     public_key_pem = user_manager.get_user_public_key(username)
     emit('public_key_response', {
         'success': True,
-        'public_key': public_key_pem
+        'public_key': public_key_pem,
+        'fingerprint': user_manager.get_public_key_fingerprint(username)
+    })
+
+@socketio.on('get_public_keys')
+@rate_limited('get_public_keys')
+def handle_get_public_keys(data):
+    """Send the public keys of several users, except those the client already has
+    
+    The client sends the fingerprints of keys it has cached under 'known';
+    only missing or changed keys are sent back, so revalidating a cache
+    costs one round-trip and no key data.
+    """
+    usernames = data.get('usernames')
+    known = data.get('known') or {}
+    if not isinstance(usernames, list) or not all(isinstance(u, str) for u in usernames) or \
+            not isinstance(known, dict):
+        emit('public_keys_response', {'success': False, 'message': 'Invalid request'})
+        return
+    if len(usernames) > MAX_PUBLIC_KEY_BATCH:
+        emit('public_keys_response', {'success': False,
+                                      'message': f'At most {MAX_PUBLIC_KEY_BATCH} users per request'})
+        return
+    
+    keys, unknown = user_manager.get_public_keys(usernames, known)
+    emit('public_keys_response', {
+        'success': True,
+        'keys': keys,
+        'unknown': unknown
     })
 
 @socketio.on('start_chat')
+@rate_limited('start_chat')
 def handle_start_chat(data):
     """Start a new chat session"""
     participants = data.get('participants', [])
-    current_user = active_sessions.get(request.sid, {}).get('username')
+    current_user = session_registry.username(request.sid)
     
     print(f"Start chat request from {current_user} with participants: {participants}")
     
@@ -162,41 +625,39 @@ def handle_start_chat(data):
     if current_user not in participants:
         participants.append(current_user)
     
+    # Drop unknown users and duplicates, keeping the original order
+    participants = [p for p in dict.fromkeys(participants) if user_manager.user_exists(p)]
     print(f"Final participants list: {participants}")
     
     # Generate unique chat ID
     chat_id = str(uuid.uuid4())
+    note_created_id('chat_id', chat_id)
     print(f"Generated chat ID: {chat_id}")
     
     # Generate AES key for this chat
     aes_key = crypto_manager.generate_aes_key()
-    chat_aes_keys[chat_id] = aes_key
+    chat_aes_keys.put(chat_id, aes_key)
     
     # Join the current user to the chat room
     join_room(chat_id)
     print(f"User {current_user} joined room {chat_id}")
     
-    # Send AES key to each participant (simplified approach)
-    for participant in participants:
-        if user_manager.user_exists(participant):
-            print(f"Sending AES key to participant: {participant}")
-            
-            # Find participant's session ID
-            participant_session = None
-            for session_id, session_data in active_sessions.items():
-                if session_data.get('username') == participant:
-                    participant_session = session_id
-                    break
-            
-            if participant_session:
-                print(f"Sending AES key to session: {participant_session}")
-                # Send AES key directly (base64 encoded for simplicity)
-                socketio.emit('aes_key', {
-                    'chat_id': chat_id,
-                    'aes_key': base64.b64encode(aes_key).decode('utf-8')
-                }, room=participant_session)
-            else:
-                print(f"Warning: Participant {participant} not found in active sessions")
+    # Add the chat to every participant's inbox
+    chat_inbox.add_chat(chat_id, participants, datetime.now().timestamp(), created_by=current_user)
+    
+    # Wrap the key for every participant; offline members pick it up on login
+    online_users = [p for p in participants if p in user_sessions]
+    key_fanout.fanout(chat_id, aes_key, participants, online_users)
+    
+    # Send the key to every online device in a single emit
+    online_sessions = [sid for p in online_users for sid in user_sessions[p]]
+    if online_sessions:
+        socketio.emit('aes_key', {
+            'chat_id': chat_id,
+            'aes_key': base64.b64encode(aes_key).decode('utf-8')
+        }, to=online_sessions)
+    print(f"Chat key sent to {len(online_sessions)} sessions, "
+          f"{len(participants) - len(online_users)} participants offline")
     
     emit('chat_started', {
         'chat_id': chat_id,
@@ -205,34 +666,151 @@ def handle_start_chat(data):
     print(f"Chat started successfully with ID: {chat_id}")
 
 @socketio.on('join_chat')
+@rate_limited('join_chat')
 def handle_join_chat(data):
     """Join a chat room"""
     chat_id = data.get('chat_id')
-    username = active_sessions.get(request.sid, {}).get('username')
+    username = session_registry.username(request.sid)
     
     if not username:
         emit('chat_error', {'message': 'Not logged in'})
         return
     
+    if not chat_store.is_valid_chat_id(chat_id) or not membership.is_member(chat_id, username):
+        emit('chat_error', {'message': 'Chat not found'})
+        return
+    
     join_room(chat_id)
     emit('joined_chat', {'chat_id': chat_id, 'username': username})
 
 @socketio.on('leave_chat')
+@rate_limited('leave_chat')
 def handle_leave_chat(data):
     """Leave a chat room"""
     chat_id = data.get('chat_id')
-    username = active_sessions.get(request.sid, {}).get('username')
+    username = session_registry.username(request.sid)
     
     if username:
         leave_room(chat_id)
         emit('left_chat', {'chat_id': chat_id, 'username': username})
 
+@socketio.on('get_chat_key')
+@rate_limited('get_chat_key')
+def handle_get_chat_key(data):
+    """Send a member the chat's AES key again, e.g. after the client evicted it"""
+    chat_id = data.get('chat_id')
+    username = session_registry.username(request.sid)
+    
+    if not username:
+        emit('chat_error', {'message': 'Not logged in'})
+        return
+    
+    if not chat_store.is_valid_chat_id(chat_id) or not membership.is_member(chat_id, username):
+        emit('chat_error', {'message': 'Chat not found'})
+        return
+    
+    aes_key = get_chat_key(chat_id, username)
+    if aes_key is None:
+        emit('chat_error', {'message': 'Chat key unavailable'})
+        return
+    
+    emit('aes_key', {
+        'chat_id': chat_id,
+        'aes_key': base64.b64encode(aes_key).decode('utf-8')
+    })
+
+@socketio.on('add_chat_member')
+@rate_limited('add_chat_member')
+def handle_add_chat_member(data):
+    """Add a user to a chat; any member can add others"""
+    chat_id = data.get('chat_id')
+    new_member = data.get('username')
+    username = session_registry.username(request.sid)
+
+    if not username:
+        emit('chat_error', {'message': 'Not logged in'})
+        return
+
+    if not chat_store.is_valid_chat_id(chat_id) or not membership.is_member(chat_id, username):
+        emit('chat_error', {'message': 'Chat not found'})
+        return
+
+    if not isinstance(new_member, str) or not user_manager.user_exists(new_member):
+        emit('chat_error', {'message': 'User not found'})
+        return
+
+    aes_key = get_chat_key(chat_id, username)
+    if aes_key is None:
+        emit('chat_error', {'message': 'Chat key unavailable'})
+        return
+
+    success, message = chat_inbox.add_member(chat_id, new_member)
+    if not success:
+        emit('chat_error', {'message': message})
+        return
+
+    # Wrap the key for the new member and put their online devices in the room
+    new_sessions = list(user_sessions.get(new_member, ()))
+    key_fanout.fanout(chat_id, aes_key, [new_member], [new_member] if new_sessions else [])
+    for sid in new_sessions:
+        join_room(chat_id, sid=sid, namespace='/')
+    if new_sessions:
+        socketio.emit('aes_key', {
+            'chat_id': chat_id,
+            'aes_key': base64.b64encode(aes_key).decode('utf-8')
+        }, to=new_sessions)
+
+    socketio.emit('chat_members', {
+        'chat_id': chat_id,
+        'members': list(membership.get_members(chat_id))
+    }, to=chat_id)
+    print(f"{username} added {new_member} to chat {chat_id}")
+
+@socketio.on('remove_chat_member')
+@rate_limited('remove_chat_member')
+def handle_remove_chat_member(data):
+    """Remove a user from a chat; members can remove themselves, the creator anyone"""
+    chat_id = data.get('chat_id')
+    removed_member = data.get('username')
+    username = session_registry.username(request.sid)
+
+    if not username:
+        emit('chat_error', {'message': 'Not logged in'})
+        return
+
+    if not chat_store.is_valid_chat_id(chat_id) or not membership.is_member(chat_id, username):
+        emit('chat_error', {'message': 'Chat not found'})
+        return
+
+    if removed_member != username and membership.get_chat(chat_id).get('created_by') != username:
+        emit('chat_error', {'message': 'Only the chat creator can remove other members'})
+        return
+
+    success, message = chat_inbox.remove_member(chat_id, removed_member)
+    if not success:
+        emit('chat_error', {'message': message})
+        return
+
+    # Take the removed member's online devices out of the room
+    removed_sessions = list(user_sessions.get(removed_member, ()))
+    for sid in removed_sessions:
+        leave_room(chat_id, sid=sid, namespace='/')
+    if removed_sessions:
+        socketio.emit('removed_from_chat', {'chat_id': chat_id}, to=removed_sessions)
+
+    socketio.emit('chat_members', {
+        'chat_id': chat_id,
+        'members': list(membership.get_members(chat_id))
+    }, to=chat_id)
+    print(f"{username} removed {removed_member} from chat {chat_id}")
+
 @socketio.on('send_message')
+@rate_limited('send_message')
 def handle_send_message(data):
     """Handle sending encrypted messages"""
     chat_id = data.get('chat_id')
     encrypted_message = data.get('encrypted_message')
-    username = active_sessions.get(request.sid, {}).get('username')
+    username = session_registry.username(request.sid)
     
     if not username:
         emit('message_error', {'message': 'Not logged in'})
@@ -242,65 +820,287 @@ def handle_send_message(data):
         emit('message_error', {'message': 'Missing chat_id or message'})
         return
     
+    if not chat_store.is_valid_chat_id(chat_id):
+        emit('message_error', {'message': 'Invalid chat_id'})
+        return
+    
+    if not membership.is_member(chat_id, username):
+        emit('message_error', {'message': 'Chat not found'})
+        return
+    
+    # Messages can reference completed attachments uploaded to the same chat
+    attachments = data.get('attachments') or []
+    if not isinstance(attachments, list) or len(attachments) > 10:
+        emit('message_error', {'message': 'Invalid attachments'})
+        return
+    for attachment_id in attachments:
+        manifest = attachment_store.get_manifest(attachment_id)
+        if manifest is None or manifest['chat_id'] != chat_id or not manifest['complete']:
+            emit('message_error', {'message': 'Invalid attachments'})
+            return
+    
     # Store encrypted message in chat log
     message_data = {
         'username': username,
         'encrypted_message': encrypted_message,
         'timestamp': datetime.now().isoformat()
     }
+    if attachments:
+        message_data['attachments'] = attachments
     
-    # Load existing chat log
-    encrypted_log = user_manager.load_chat_log(chat_id)
-    if encrypted_log and chat_id in chat_aes_keys:
-        try:
-            chat_log = crypto_manager.decrypt_chat_log(encrypted_log, chat_aes_keys[chat_id])
-        except:
-            chat_log = []
-    else:
-        chat_log = []
-    
-    # Add new message
-    chat_log.append(message_data)
-    
-    # Save encrypted chat log
-    if chat_id in chat_aes_keys:
-        encrypted_log = crypto_manager.encrypt_chat_log(chat_log, chat_aes_keys[chat_id])
-        user_manager.save_chat_log(chat_id, encrypted_log)
+    # Append the message to the chat's record log
+    aes_key = get_chat_key(chat_id, username)
+    if not aes_key:
+        emit('message_error', {'message': 'Chat not found'})
+        return
+    seq = chat_store.append_message(chat_id, message_data, aes_key)
+    chat_inbox.record_message(chat_id, parse_timestamp(message_data['timestamp']), seq)
     
     # Broadcast encrypted message to all participants in the chat
     socketio.emit('message_received', {
         'chat_id': chat_id,
         'username': username,
         'encrypted_message': encrypted_message,
-        'timestamp': message_data['timestamp']
+        'timestamp': message_data['timestamp'],
+        'attachments': attachments,
+        'seq': seq
     }, room=chat_id)
 
 @socketio.on('get_chat_history')
+@rate_limited('get_chat_history')
 def handle_get_chat_history(data):
     """Send encrypted chat history to client"""
     chat_id = data.get('chat_id')
-    username = active_sessions.get(request.sid, {}).get('username')
+    username = session_registry.username(request.sid)
     
     if not username:
         emit('chat_history_error', {'message': 'Not logged in'})
         return
     
-    # Load encrypted chat log
-    encrypted_log = user_manager.load_chat_log(chat_id)
-    if encrypted_log and chat_id in chat_aes_keys:
-        try:
-            chat_log = crypto_manager.decrypt_chat_log(encrypted_log, chat_aes_keys[chat_id])
-            emit('chat_history', {
-                'chat_id': chat_id,
-                'messages': chat_log
-            })
-        except Exception as e:
-            emit('chat_history_error', {'message': 'Failed to decrypt chat history'})
-    else:
+    if not chat_store.is_valid_chat_id(chat_id):
+        emit('chat_history_error', {'message': 'Invalid chat_id'})
+        return
+    
+    if not membership.is_member(chat_id, username):
+        emit('chat_history_error', {'message': 'Chat not found'})
+        return
+    
+    # Optional filters: seq below `before`, timestamps in [since, until),
+    # a single sender, and `at` to jump to the first message at a date
+    try:
+        before = None if data.get('before') is None else int(data['before'])
+        limit = HISTORY_PAGE_SIZE if data.get('limit') is None else int(data['limit'])
+        limit = min(max(1, limit), MAX_HISTORY_PAGE_SIZE)
+        since = None if data.get('since') is None else parse_timestamp(data['since'])
+        until = None if data.get('until') is None else parse_timestamp(data['until'])
+        at = None if data.get('at') is None else parse_timestamp(data['at'])
+        sender = data.get('sender')
+        if sender is not None and not isinstance(sender, str):
+            raise TypeError('sender must be a string')
+    except (TypeError, ValueError):
+        emit('chat_history_error', {'message': 'Invalid history query'})
+        return
+    
+    aes_key = get_chat_key(chat_id, username)
+    if not aes_key:
         emit('chat_history', {
             'chat_id': chat_id,
-            'messages': []
+            'messages': [],
+            'before': before,
+            'has_more': False,
+            'has_newer': False
         })
+        return
+    
+    try:
+        messages, has_more, has_newer = chat_store.query(
+            chat_id, aes_key, before=before, limit=limit,
+            since=since, until=until, sender=sender, at=at
+        )
+    except Exception as e:
+        emit('chat_history_error', {'message': 'Failed to decrypt chat history'})
+        return
+    
+    emit('chat_history', {
+        'chat_id': chat_id,
+        'messages': messages,
+        'before': before,
+        'has_more': has_more,
+        'has_newer': has_newer
+    })
+
+@socketio.on('list_chats')
+@rate_limited('list_chats')
+def handle_list_chats(data):
+    """Send a page of the user's chats, most recently active first"""
+    username = session_registry.username(request.sid)
+    
+    if not username:
+        emit('chat_error', {'message': 'Not logged in'})
+        return
+    
+    try:
+        limit = min(max(1, int(data.get('limit', 20))), 100)
+    except (TypeError, ValueError):
+        emit('chat_error', {'message': 'Invalid limit'})
+        return
+    
+    try:
+        chats, next_cursor = chat_inbox.list_chats(username, data.get('cursor'), limit)
+    except ValueError:
+        emit('chat_error', {'message': 'Invalid cursor'})
+        return
+    for chat in chats:
+        chat['last_read_seq'] = read_state.get_cursor(username, chat['chat_id'])
+        chat['unread'] = read_state.unread_count(username, chat['chat_id'], chat['last_seq'])
+    
+    emit('chat_list', {
+        'chats': chats,
+        'next_cursor': next_cursor
+    })
+
+@socketio.on('mark_read')
+@rate_limited('mark_read')
+def handle_mark_read(data):
+    """Record that the user has read a chat up to a message seq"""
+    chat_id = data.get('chat_id')
+    username = session_registry.username(request.sid)
+    
+    if not username:
+        emit('chat_error', {'message': 'Not logged in'})
+        return
+    
+    if not chat_store.is_valid_chat_id(chat_id) or not membership.is_member(chat_id, username):
+        emit('chat_error', {'message': 'Chat not found'})
+        return
+    
+    try:
+        seq = int(data.get('seq'))
+    except (TypeError, ValueError):
+        emit('chat_error', {'message': 'Invalid seq'})
+        return
+    
+    # Never mark messages that don't exist yet as read
+    last = chat_store.last_entry(chat_id)
+    if last is None or seq < 0:
+        return
+    
+    # Receipts go out with the next flush, coalesced with any later acks
+    if read_state.ack(username, chat_id, min(seq, last[0])):
+        start_read_receipt_flusher()
+
+def get_attachment_for_session(data, require_owner=False):
+    """Get the manifest of an attachment the session may access, or emit an error"""
+    username = session_registry.username(request.sid)
+    if not username:
+        emit('attachment_error', {'message': 'Not logged in'})
+        return None
+    
+    attachment_id = data.get('attachment_id')
+    manifest = attachment_store.get_manifest(attachment_id)
+    if manifest is None or not membership.is_member(manifest['chat_id'], username):
+        emit('attachment_error', {'attachment_id': attachment_id, 'message': 'Attachment not found'})
+        return None
+    if require_owner and manifest['owner'] != username:
+        emit('attachment_error', {'attachment_id': attachment_id, 'message': 'Not the uploader'})
+        return None
+    return manifest
+
+@socketio.on('create_attachment')
+@rate_limited('create_attachment')
+def handle_create_attachment(data):
+    """Start a chunked upload of an encrypted attachment to a chat"""
+    chat_id = data.get('chat_id')
+    username = session_registry.username(request.sid)
+    
+    if not username:
+        emit('attachment_error', {'message': 'Not logged in'})
+        return
+    
+    if not chat_store.is_valid_chat_id(chat_id) or not membership.is_member(chat_id, username):
+        emit('attachment_error', {'message': 'Chat not found'})
+        return
+    
+    success, result = attachment_store.create_upload(username, chat_id, data.get('size'))
+    if not success:
+        emit('attachment_error', {'message': result})
+        return
+    
+    note_created_id('attachment_id', result)
+    
+    # The upload token lets the client send chunks over HTTP instead
+    manifest = attachment_store.get_manifest(result)
+    emit('attachment_created', dict(attachment_store.status(manifest),
+                                    upload_token=attachment_store.make_token(result, 'upload')))
+
+@socketio.on('upload_attachment_chunk')
+@rate_limited('upload_attachment_chunk')
+def handle_upload_attachment_chunk(data):
+    """Store one chunk of an encrypted attachment sent as binary data"""
+    manifest = get_attachment_for_session(data, require_owner=True)
+    if manifest is None:
+        return
+    
+    chunk = data.get('data')
+    digest = data.get('sha256')
+    if not isinstance(chunk, (bytes, bytearray)) or (digest is not None and not (
+            isinstance(digest, str) and SHA256_PATTERN.fullmatch(digest))):
+        emit('attachment_error', {'attachment_id': manifest['attachment_id'], 'message': 'Invalid chunk'})
+        return
+    
+    success, message = attachment_store.put_chunk(manifest['attachment_id'], data.get('index'),
+                                                  io.BytesIO(chunk), digest)
+    if not success:
+        emit('attachment_error', {'attachment_id': manifest['attachment_id'],
+                                  'index': data.get('index'), 'message': message})
+        return
+    
+    emit('attachment_chunk_stored', {'attachment_id': manifest['attachment_id'], 'index': data.get('index')})
+
+@socketio.on('get_attachment_status')
+@rate_limited('get_attachment_status')
+def handle_get_attachment_status(data):
+    """Send an upload's missing chunks so an interrupted upload can resume"""
+    manifest = get_attachment_for_session(data, require_owner=True)
+    if manifest is None:
+        return
+    
+    emit('attachment_status', dict(attachment_store.status(manifest),
+                                   upload_token=attachment_store.make_token(manifest['attachment_id'], 'upload')))
+
+@socketio.on('complete_attachment')
+@rate_limited('complete_attachment')
+def handle_complete_attachment(data):
+    """Finish an upload once every chunk has arrived"""
+    manifest = get_attachment_for_session(data, require_owner=True)
+    if manifest is None:
+        return
+    
+    success, message = attachment_store.complete_upload(manifest['attachment_id'])
+    if not success:
+        emit('attachment_error', {'attachment_id': manifest['attachment_id'], 'message': message})
+        return
+    
+    emit('attachment_completed', {'attachment_id': manifest['attachment_id'], 'size': manifest['size']})
+
+@socketio.on('get_attachment_url')
+@rate_limited('get_attachment_url')
+def handle_get_attachment_url(data):
+    """Send a short-lived download URL for an attachment in one of the user's chats"""
+    manifest = get_attachment_for_session(data)
+    if manifest is None:
+        return
+    
+    if not manifest['complete']:
+        emit('attachment_error', {'attachment_id': manifest['attachment_id'], 'message': 'Upload not complete'})
+        return
+    
+    token = attachment_store.make_token(manifest['attachment_id'], 'download')
+    emit('attachment_url', {
+        'attachment_id': manifest['attachment_id'],
+        'size': manifest['size'],
+        'url': f"/attachments/{manifest['attachment_id']}?token={token}"
+    })
 
 if __name__ == '__main__':
     socketio.run(app, debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,239 @@
+import os
+import re
+import json
+import time
+import uuid
+import hmac
+import hashlib
+import secrets
+import threading
+from datetime import datetime
+
+# Attachments are uploaded in chunks of this size (the last one may be
+# shorter); small enough to fit one Socket.IO message
+ATTACHMENT_CHUNK_SIZE = 512 * 1024
+MAX_ATTACHMENT_SIZE = 100 * 1024 * 1024
+ATTACHMENT_TOKEN_TTL = 3600  # seconds
+ATTACHMENT_ID_PATTERN = re.compile(r'[0-9a-f]{32}')
+SHA256_PATTERN = re.compile(r'[0-9a-f]{64}')
+COPY_BUFFER_SIZE = 64 * 1024
+
+class AttachmentStore:
+    """Encrypted file attachments stored as content-addressed chunks
+
+    Clients encrypt files themselves and upload them in fixed-size chunks,
+    in any order and over as many connections as it takes. Each attachment
+    has a manifest under data/attachments/manifests listing the digest of
+    every chunk received so far, so an interrupted upload resumes with the
+    missing chunks only. Chunk contents are stored under their SHA-256
+    digest in data/attachments/chunks/<aa>/<bb>/<digest>, which makes them
+    immutable and retries idempotent. Clients encrypt every upload with a
+    fresh random IV, so identical files don't share chunks; only the same
+    ciphertext sent again (e.g. a retried chunk) is stored once.
+    """
+
+    def __init__(self, user_manager):
+        self.user_manager = user_manager
+        self.attachments_dir = os.path.join(user_manager.data_dir, "attachments")
+        self.chunks_dir = os.path.join(self.attachments_dir, "chunks")
+        self.manifests_dir = os.path.join(self.attachments_dir, "manifests")
+        os.makedirs(self.chunks_dir, exist_ok=True)
+        os.makedirs(self.manifests_dir, exist_ok=True)
+
+        self._token_key = self._load_token_key()
+        self._manifest_locks = [threading.Lock() for _ in range(64)]
+
+    def _load_token_key(self):
+        """Load the key that signs upload and download tokens, creating it once"""
+        key_file = os.path.join(self.attachments_dir, "token.key")
+        if not os.path.exists(key_file):
+            tmp_file = key_file + '.tmp'
+            with open(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+                f.write(secrets.token_bytes(32))
+            os.replace(tmp_file, key_file)
+        with open(key_file, 'rb') as f:
+            return f.read()
+
+    def is_valid_attachment_id(self, attachment_id):
+        """Check that an attachment id is safe to use in file names"""
+        return isinstance(attachment_id, str) and ATTACHMENT_ID_PATTERN.fullmatch(attachment_id) is not None
+
+    def _manifest_file(self, attachment_id):
+        return os.path.join(self.manifests_dir, f"{attachment_id}.json")
+
+    def _chunk_file(self, digest):
+        """Get the path of a chunk, fanned out by its digest's first bytes"""
+        return os.path.join(self.chunks_dir, digest[:2], digest[2:4], digest)
+
+    def _manifest_lock(self, attachment_id):
+        return self._manifest_locks[hash(attachment_id) % len(self._manifest_locks)]
+
+    def _save_manifest(self, manifest):
+        manifest_file = self._manifest_file(manifest['attachment_id'])
+        tmp_file = manifest_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_file, manifest_file)
+
+    def get_manifest(self, attachment_id):
+        """Get an attachment's manifest, or None for unknown attachments"""
+        if not self.is_valid_attachment_id(attachment_id):
+            return None
+        manifest_file = self._manifest_file(attachment_id)
+        if not os.path.exists(manifest_file):
+            return None
+        with open(manifest_file, 'r') as f:
+            return json.load(f)
+
+    def chunk_length(self, manifest, index):
+        """Get the expected length of chunk number index"""
+        chunk_size = manifest['chunk_size']
+        return min(chunk_size, manifest['size'] - index * chunk_size)
+
+    def missing_chunks(self, manifest):
+        """Get the indexes of the chunks not uploaded yet"""
+        return [index for index, digest in enumerate(manifest['chunks']) if digest is None]
+
+    def status(self, manifest):
+        """Get the upload progress of an attachment for clients"""
+        return {
+            'attachment_id': manifest['attachment_id'],
+            'chat_id': manifest['chat_id'],
+            'size': manifest['size'],
+            'chunk_size': manifest['chunk_size'],
+            'chunk_count': len(manifest['chunks']),
+            'missing': self.missing_chunks(manifest),
+            'complete': manifest['complete']
+        }
+
+    def create_upload(self, owner, chat_id, size):
+        """Start an upload of size encrypted bytes to a chat
+
+        Returns (success, attachment id or error message).
+        """
+        if not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+            return False, "Invalid attachment size"
+        if size > MAX_ATTACHMENT_SIZE:
+            return False, "Attachment too large"
+
+        chunk_count = -(-size // ATTACHMENT_CHUNK_SIZE)
+        manifest = {
+            'attachment_id': uuid.uuid4().hex,
+            'chat_id': chat_id,
+            'owner': owner,
+            'size': size,
+            'chunk_size': ATTACHMENT_CHUNK_SIZE,
+            'chunks': [None] * chunk_count,
+            'complete': False,
+            'created_at': datetime.now().isoformat()
+        }
+        self._save_manifest(manifest)
+        return True, manifest['attachment_id']
+
+    def put_chunk(self, attachment_id, index, stream, digest=None):
+        """Store chunk number index of an upload, read from a binary stream
+
+        The chunk is streamed to disk while it is hashed, and only kept if no
+        chunk with the same content is stored yet. digest, if given, is the
+        SHA-256 hex digest the client expects. Returns (success, message).
+        """
+        manifest = self.get_manifest(attachment_id)
+        if manifest is None:
+            return False, "Attachment not found"
+        if manifest['complete']:
+            return False, "Attachment already complete"
+        if not isinstance(index, int) or not 0 <= index < len(manifest['chunks']):
+            return False, "Invalid chunk index"
+
+        expected_length = self.chunk_length(manifest, index)
+        hasher = hashlib.sha256()
+        received = 0
+        tmp_file = os.path.join(self.chunks_dir, f"{uuid.uuid4().hex}.tmp")
+        try:
+            with open(tmp_file, 'wb') as f:
+                while True:
+                    data = stream.read(COPY_BUFFER_SIZE)
+                    if not data:
+                        break
+                    received += len(data)
+                    if received > expected_length:
+                        return False, "Chunk size mismatch"
+                    hasher.update(data)
+                    f.write(data)
+            if received != expected_length:
+                return False, "Chunk size mismatch"
+
+            chunk_digest = hasher.hexdigest()
+            if digest is not None and digest != chunk_digest:
+                return False, "Chunk checksum mismatch"
+
+            chunk_file = self._chunk_file(chunk_digest)
+            if not os.path.exists(chunk_file):
+                os.makedirs(os.path.dirname(chunk_file), exist_ok=True)
+                os.replace(tmp_file, chunk_file)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+        with self._manifest_lock(attachment_id):
+            manifest = self.get_manifest(attachment_id)
+            # complete_upload may have run while the chunk was being received
+            if manifest['complete']:
+                return False, "Attachment already complete"
+            if manifest['chunks'][index] != chunk_digest:
+                manifest['chunks'][index] = chunk_digest
+                self._save_manifest(manifest)
+        return True, "Chunk stored"
+
+    def complete_upload(self, attachment_id):
+        """Mark an upload complete once every chunk has arrived
+
+        Returns (success, message).
+        """
+        with self._manifest_lock(attachment_id):
+            manifest = self.get_manifest(attachment_id)
+            if manifest is None:
+                return False, "Attachment not found"
+            missing = self.missing_chunks(manifest)
+            if missing:
+                return False, f"{len(missing)} chunks missing"
+            if not manifest['complete']:
+                manifest['complete'] = True
+                self._save_manifest(manifest)
+        return True, "Attachment complete"
+
+    def iter_range(self, manifest, start, end):
+        """Yield bytes [start, end) of a complete attachment from its chunk files"""
+        chunk_size = manifest['chunk_size']
+        position = start
+        while position < end:
+            index = position // chunk_size
+            chunk_end = min(end, (index + 1) * chunk_size)
+            with open(self._chunk_file(manifest['chunks'][index]), 'rb') as f:
+                f.seek(position - index * chunk_size)
+                while position < chunk_end:
+                    data = f.read(min(COPY_BUFFER_SIZE, chunk_end - position))
+                    if not data:
+                        raise IOError(f"Attachment chunk {index} is truncated")
+                    position += len(data)
+                    yield data
+
+    def make_token(self, attachment_id, purpose, ttl=ATTACHMENT_TOKEN_TTL):
+        """Sign a token granting purpose ('upload' or 'download') on an attachment"""
+        expires = int(time.time()) + ttl
+        return f"{expires}.{self._sign(attachment_id, purpose, expires)}"
+
+    def check_token(self, attachment_id, purpose, token):
+        """Check a token from make_token for an attachment and purpose"""
+        try:
+            expires, signature = token.split('.', 1)
+            expires = int(expires)
+        except (AttributeError, ValueError):
+            return False
+        if expires < time.time():
+            return False
+        return hmac.compare_digest(signature, self._sign(attachment_id, purpose, expires))
+
+    def _sign(self, attachment_id, purpose, expires):
+        message = f"{attachment_id}:{purpose}:{expires}".encode('utf-8')
+        return hmac.new(self._token_key, message, hashlib.sha256).hexdigest()
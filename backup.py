@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+"""
+Take consistent, incremental snapshots of a data directory and restore them
+
+Usage: python backup.py snapshot DATA_DIR BACKUP_DIR [--workers N] [--full]
+       python backup.py restore SNAPSHOT_DIR TARGET_DIR [--workers N]
+       python backup.py list BACKUP_DIR
+Snapshots can be taken while the server is up. Each one is a complete copy
+of the data directory in BACKUP_DIR/<timestamp>/data; files unchanged since
+the previous snapshot are hard links to it rather than copies.
+"""
+
+import sys
+import os
+import json
+import gzip
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+MANIFEST_VERSION = 1
+MANIFEST_FILE = "manifest.json.gz"
+BACKUP_WORKERS = 8
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Data directories in the order they are copied. Files refer to files in
+# later directories (the user directory to user records, inboxes to chats,
+# chat indexes to chat logs, attachment manifests to chunks) and each
+# directory is copied before the next one is read, so every reference in a
+# snapshot resolves. Anything not listed is copied last.
+SNAPSHOT_ORDER = ["users.json", "users", "inbox", "read_state", "chats", "wrapped_keys",
+                  "chat_index", "chat_logs", "attachments/manifests", "attachments"]
+# Not part of the data
+SKIPPED_DIRS = {"profiles"}
+
+# Files the server only appends to, or replaces whole with os.replace. A
+# snapshot copies them up to the size they had when scanned, so writes
+# landing during the copy are left for the next snapshot.
+APPEND_ONLY_EXTENSIONS = ('.enc', '.idx', '.jsonl', '.log')
+# Append-only files made of lines; a torn final line is left out
+LINE_EXTENSIONS = ('.idx', '.jsonl', '.log')
+
+def _last_line_end(fd, size):
+    """Get the offset just past the last newline in a file's first size bytes, or 0"""
+    end = size
+    while end > 0:
+        start = max(0, end - COPY_BUFFER_SIZE)
+        newline = os.pread(fd, end - start, start).rfind(b'\n')
+        if newline >= 0:
+            return start + newline + 1
+        end = start
+    return 0
+
+def _copy_file(source, destination, size=None, lines=False):
+    """Copy the first size bytes of an open file (all of it if None) to a new file
+
+    With lines, the copy ends after the last complete line. Returns the
+    number of bytes copied.
+    """
+    fd = source.fileno()
+    if size is None:
+        size = os.fstat(fd).st_size
+    if lines:
+        size = _last_line_end(fd, size)
+    copied = 0
+    with open(destination, 'wb') as f:
+        try:
+            while copied < size:
+                # The kernel copies between the files without a trip through Python
+                sent = os.sendfile(f.fileno(), fd, copied, size - copied)
+                if sent == 0:
+                    return copied
+                copied += sent
+        except OSError:
+            # Platforms whose sendfile only writes to sockets
+            source.seek(copied)
+            while copied < size:
+                chunk = source.read(min(COPY_BUFFER_SIZE, size - copied))
+                if not chunk:
+                    break
+                f.write(chunk)
+                copied += len(chunk)
+    return copied
+
+class _SnapshotWriter:
+    """Copies files of a data directory into a new snapshot, linking unchanged ones"""
+
+    def __init__(self, data_dir, snapshot_data_dir, base_data_dir, base_files):
+        self.data_dir = data_dir
+        self.snapshot_data_dir = snapshot_data_dir
+        self.base_data_dir = base_data_dir
+        self.base_files = base_files  # {relative path: manifest entry}
+
+    def backup_file(self, relative, stat):
+        """Copy or link one file whose parent directory exists in the snapshot
+
+        stat is the file's (size, mtime_ns, inode) when scanned. Returns
+        (manifest entry or None if the file is gone, bytes copied or None if
+        the file was linked).
+        """
+        destination = os.path.join(self.snapshot_data_dir, relative)
+        base_entry = self.base_files.get(relative)
+        if base_entry is not None and tuple(base_entry[:3]) == stat:
+            # Unchanged since the base snapshot: share its copy
+            try:
+                os.link(os.path.join(self.base_data_dir, relative), destination)
+                return base_entry, None
+            except OSError:
+                # Missing from the base, on another filesystem or linked
+                # too often: fall back to copying
+                pass
+
+        try:
+            source = open(os.path.join(self.data_dir, relative), 'rb')
+        except FileNotFoundError:
+            return None, 0
+        with source:
+            current = os.fstat(source.fileno())
+            if relative.endswith(APPEND_ONLY_EXTENSIONS) and current.st_ino == stat[2]:
+                # Still the file that was scanned: copy it as it was then
+                copied = _copy_file(source, destination, stat[0], relative.endswith(LINE_EXTENSIONS))
+            else:
+                # Replaced since the scan (os.replace swaps in a new,
+                # complete file) or never appended to: copy what was opened
+                stat = (current.st_size, current.st_mtime_ns, current.st_ino)
+                copied = _copy_file(source, destination)
+        return [stat[0], stat[1], stat[2], copied], copied
+
+    def backup_entries(self, relative_dir, entries):
+        """Back up the files among a directory's scandir entries, returning {relative path: (entry, copied)}"""
+        results = {}
+        for entry in entries:
+            if entry.name.endswith('.tmp') or not entry.is_file(follow_symlinks=False):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            relative = os.path.join(relative_dir, entry.name) if relative_dir else entry.name
+            manifest_entry, copied = self.backup_file(relative, (stat.st_size, stat.st_mtime_ns, stat.st_ino))
+            if manifest_entry is not None:
+                results[relative] = (manifest_entry, copied)
+        return results
+
+    def backup_tree(self, relative_dir):
+        """Back up every file under a directory"""
+        results = {}
+        pending = [relative_dir]
+        while pending:
+            directory = pending.pop()
+            os.makedirs(os.path.join(self.snapshot_data_dir, directory), exist_ok=True)
+            try:
+                with os.scandir(os.path.join(self.data_dir, directory)) as scan:
+                    entries = list(scan)
+            except FileNotFoundError:
+                continue
+            results.update(self.backup_entries(directory, entries))
+            pending.extend(os.path.join(directory, entry.name) for entry in entries
+                           if entry.is_dir(follow_symlinks=False))
+        return results
+
+    def backup_group(self, group, excluded, pool):
+        """Back up a group: the files directly in it first, then its subdirectories in parallel
+
+        Directories in excluded (the other groups) are left out.
+        """
+        path = os.path.join(self.data_dir, group)
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            manifest_entry, copied = self.backup_file(group, (stat.st_size, stat.st_mtime_ns, stat.st_ino))
+            return {group: (manifest_entry, copied)} if manifest_entry is not None else {}
+        if not os.path.isdir(path):
+            return {}
+
+        os.makedirs(os.path.join(self.snapshot_data_dir, group), exist_ok=True)
+        with os.scandir(path) as scan:
+            entries = [entry for entry in scan
+                       if (os.path.join(group, entry.name) if group else entry.name) not in excluded]
+        # Files at the top of a group (the user directory and its journal,
+        # markers, keys) are copied before what they refer to below them
+        results = self.backup_entries(group, entries)
+        subdirs = [os.path.join(group, entry.name) if group else entry.name
+                   for entry in entries if entry.is_dir(follow_symlinks=False)]
+        for subdir_results in pool.map(self.backup_tree, subdirs):
+            results.update(subdir_results)
+        return results
+
+def list_snapshots(backup_dir):
+    """Get the names of a backup directory's complete snapshots, oldest first"""
+    if not os.path.isdir(backup_dir):
+        return []
+    return sorted(name for name in os.listdir(backup_dir)
+                  if not name.endswith('.partial')
+                  and os.path.exists(os.path.join(backup_dir, name, MANIFEST_FILE)))
+
+def load_manifest(snapshot_dir):
+    """Load a snapshot's manifest"""
+    with gzip.open(os.path.join(snapshot_dir, MANIFEST_FILE), 'rt') as f:
+        return json.load(f)
+
+def create_snapshot(data_dir, backup_dir, workers=BACKUP_WORKERS, incremental=True):
+    """Snapshot a data directory into a new directory under backup_dir
+
+    Incremental snapshots link files whose size, modification time and
+    inode match the latest snapshot's manifest instead of copying them.
+    Returns a summary dict with the snapshot's path and what was copied.
+    """
+    start = time.perf_counter()
+    os.makedirs(backup_dir, exist_ok=True)
+    snapshots = list_snapshots(backup_dir)
+    base = snapshots[-1] if incremental and snapshots else None
+    base_files = load_manifest(os.path.join(backup_dir, base))['files'] if base else {}
+    base_data_dir = os.path.join(backup_dir, base, "data") if base else None
+
+    name = datetime.now().strftime('%Y%m%d-%H%M%S')
+    suffix = 1
+    while os.path.exists(os.path.join(backup_dir, name)) or \
+            os.path.exists(os.path.join(backup_dir, name + '.partial')):
+        suffix += 1
+        name = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{suffix}"
+    partial_dir = os.path.join(backup_dir, name + '.partial')
+    snapshot_data_dir = os.path.join(partial_dir, "data")
+    os.makedirs(snapshot_data_dir)
+
+    writer = _SnapshotWriter(data_dir, snapshot_data_dir, base_data_dir, base_files)
+    files = {}
+    summary = {'files': 0, 'copied': 0, 'linked': 0, 'bytes_copied': 0}
+    groups = SNAPSHOT_ORDER + ['']
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for i, group in enumerate(groups):
+            # Every other group is copied in its own turn
+            excluded = set(groups[:i] + groups[i + 1:]) | SKIPPED_DIRS
+            for relative, (entry, copied) in writer.backup_group(group, excluded, pool).items():
+                files[relative] = entry
+                summary['files'] += 1
+                if copied is None:
+                    summary['linked'] += 1
+                else:
+                    summary['copied'] += 1
+                    summary['bytes_copied'] += copied
+
+    summary['seconds'] = round(time.perf_counter() - start, 3)
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'created': datetime.now().isoformat(),
+        'source': os.path.abspath(data_dir),
+        'base': base,
+        'summary': summary,
+        'files': files
+    }
+    with gzip.open(os.path.join(partial_dir, MANIFEST_FILE), 'wb', compresslevel=1) as f:
+        f.write(json.dumps(manifest, separators=(',', ':')).encode('utf-8'))
+    snapshot_dir = os.path.join(backup_dir, name)
+    os.rename(partial_dir, snapshot_dir)
+    return dict(summary, snapshot=snapshot_dir, base=base)
+
+def restore_snapshot(snapshot_dir, target_dir, workers=BACKUP_WORKERS):
+    """Copy a snapshot's files into an empty or new data directory
+
+    Files are copied rather than linked, so the server never writes into
+    the backup. Returns (success, message).
+    """
+    if not os.path.exists(os.path.join(snapshot_dir, MANIFEST_FILE)):
+        return False, "Not a complete snapshot"
+    if os.path.isdir(target_dir) and os.listdir(target_dir):
+        return False, "Target directory is not empty"
+
+    start = time.perf_counter()
+    files = load_manifest(snapshot_dir)['files']
+    snapshot_data_dir = os.path.join(snapshot_dir, "data")
+    os.makedirs(target_dir, exist_ok=True)
+
+    # One task per shard directory, e.g. chat_logs/3f, so each worker
+    # creates the directories it copies into
+    shards = {}
+    for relative, entry in files.items():
+        shard = os.sep.join(relative.split(os.sep)[:2]) if os.sep in relative else ''
+        shards.setdefault(shard, []).append((relative, entry))
+
+    def restore(items):
+        complete = 0
+        created = set()
+        for relative, entry in items:
+            directory = os.path.dirname(relative)
+            if directory not in created:
+                os.makedirs(os.path.join(target_dir, directory), exist_ok=True)
+                created.add(directory)
+            with open(os.path.join(snapshot_data_dir, relative), 'rb') as source:
+                complete += _copy_file(source, os.path.join(target_dir, relative)) == entry[3]
+        return complete
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        complete = sum(pool.map(restore, shards.values()))
+    if complete != len(files):
+        return False, f"{len(files) - complete} files did not match the manifest"
+    return True, f"Restored {len(files)} files in {time.perf_counter() - start:.1f} s"
+
+def main():
+    """Run a backup command"""
+    args = sys.argv[1:]
+    workers = BACKUP_WORKERS
+    if "--workers" in args:
+        i = args.index("--workers")
+        workers = int(args[i + 1])
+        del args[i:i + 2]
+    full = "--full" in args
+    args = [arg for arg in args if arg != "--full"]
+
+    command = args[0] if args else None
+    if command == "snapshot" and len(args) == 3:
+        data_dir, backup_dir = args[1:]
+        if not os.path.isdir(data_dir):
+            print(f"Data directory not found: {data_dir}")
+            return False
+        summary = create_snapshot(data_dir, backup_dir, workers, incremental=not full)
+        print(f"Snapshot {summary['snapshot']} (base: {summary['base'] or 'none'}): "
+              f"{summary['files']} files, {summary['copied']} copied ({summary['bytes_copied']} bytes), "
+              f"{summary['linked']} unchanged, {summary['seconds']:.1f} s")
+        return True
+    if command == "restore" and len(args) == 3:
+        success, message = restore_snapshot(args[1], args[2], workers)
+        print(message)
+        return success
+    if command == "list" and len(args) == 2:
+        for name in list_snapshots(args[1]):
+            summary = load_manifest(os.path.join(args[1], name))['summary']
+            print(f"{name}  {summary['files']} files, {summary['copied']} copied")
+        return True
+
+    print(__doc__.strip())
+    return False
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
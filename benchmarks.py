@@ -0,0 +1,748 @@
+#!/usr/bin/env python3
+"""
+Performance benchmarks for the Secure Chat App
+
+Usage: python benchmarks.py [benchmark ...]
+Runs every benchmark when none are named.
+"""
+
+import sys
+import os
+import json
+import shutil
+import hashlib
+import contextlib
+import time
+import multiprocessing
+import uuid
+from datetime import datetime
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from crypto_utils import CryptoManager, STREAM_CHUNK_SIZE
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from user_manager import UserManager
+from user_directory import UserDirectory
+from storage_layout import sharded_path
+from key_fanout import KeyFanout
+from chat_store import ChatStore
+from membership import MembershipRegistry
+from password_hasher import PasswordHasher, PASSWORD_PROFILES, DEFAULT_PASSWORD_PROFILE
+
+BENCH_DATA_DIR = "bench_data"
+
+def _fresh_user_manager():
+    """Create a UserManager on an empty benchmark data directory"""
+    if os.path.exists(BENCH_DATA_DIR):
+        shutil.rmtree(BENCH_DATA_DIR)
+    return UserManager(BENCH_DATA_DIR)
+
+def _seed_users(user_manager, count, key_pool_size=8):
+    """Add count users directly, reusing a small pool of RSA key pairs
+
+    register_user generates a fresh RSA key pair on every call, which would
+    dominate the setup time of large benchmarks.
+    """
+    crypto_manager = user_manager.crypto_manager
+    key_pool = []
+    for _ in range(min(count, key_pool_size)):
+        private_key, public_key = crypto_manager.generate_rsa_keypair()
+        public_key_pem = crypto_manager.serialize_public_key(public_key)
+        key_pool.append((crypto_manager.serialize_private_key(private_key), public_key_pem,
+                         crypto_manager.public_key_fingerprint(public_key_pem)))
+
+    usernames = []
+    for i in range(count):
+        username = f"user{i}"
+        private_key_pem, public_key_pem, fingerprint = key_pool[i % len(key_pool)]
+        user_manager.add_user_record({
+            "username": username,
+            "public_key": public_key_pem,
+            "public_key_fingerprint": fingerprint,
+            "private_key": private_key_pem,
+            "password_hash": "",
+            "created_at": datetime.now().isoformat(),
+            "last_seen": datetime.now().isoformat(),
+            "friends": []
+        })
+        usernames.append(username)
+    return usernames
+
+def bench_key_fanout():
+    """Group chat key fanout latency at 10, 100 and 1000 participants"""
+    print("Key fanout (wrap + store per participant, half offline)")
+
+    user_manager = _fresh_user_manager()
+    crypto_manager = CryptoManager()
+    participants = _seed_users(user_manager, 1000)
+
+    for workers in (1, 8):
+        fanout = KeyFanout(user_manager, crypto_manager, max_workers=workers)
+
+        # Warm the public key cache so both runs measure wrapping, not PEM parsing
+        fanout.fanout("warmup", crypto_manager.generate_aes_key(), participants)
+
+        for count in (10, 100, 1000):
+            members = participants[:count]
+            online_users = members[::2]
+            aes_key = crypto_manager.generate_aes_key()
+
+            start = time.perf_counter()
+            fanout.fanout(f"chat-{workers}-{count}", aes_key, members, online_users)
+            elapsed = time.perf_counter() - start
+            print(f"   workers={workers:<2} participants={count:<5} {elapsed * 1000:9.2f} ms")
+        fanout.executor.shutdown()
+
+    shutil.rmtree(BENCH_DATA_DIR)
+
+def bench_history_query():
+    """Sender + time range history query: full log decrypt vs metadata index"""
+    print("History query (one sender, 10 minute window, 3 senders, 1 msg/s)")
+
+    user_manager = _fresh_user_manager()
+    crypto_manager = CryptoManager()
+    chat_store = ChatStore(user_manager, crypto_manager)
+    aes_key = crypto_manager.generate_aes_key()
+    start_time = 1700000000.0
+
+    for count in (1000, 10000, 50000):
+        chat_id = f"bench_{count}"
+        messages = []
+        for i in range(count):
+            message = {
+                'username': f"user{i % 3}",
+                'encrypted_message': 'x' * 60,
+                'timestamp': datetime.fromtimestamp(start_time + i).isoformat()
+            }
+            messages.append(message)
+            chat_store.append_message(chat_id, message, aes_key)
+        since, until = start_time + count / 2, start_time + count / 2 + 600
+
+        # Old path: decrypt the whole single-blob log and filter it
+        encrypted_log = crypto_manager.encrypt_chat_log(messages, aes_key)
+        start = time.perf_counter()
+        full = [m for m in crypto_manager.decrypt_chat_log(encrypted_log, aes_key)
+                if m['username'] == 'user1'
+                and since <= datetime.fromisoformat(m['timestamp']).timestamp() < until]
+        full_elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        indexed, _, _ = chat_store.query(chat_id, aes_key, since=since, until=until, sender='user1')
+        indexed_elapsed = time.perf_counter() - start
+
+        assert len(full) == len(indexed)
+        print(f"   messages={count:<6} matches={len(indexed):<4} "
+              f"full decrypt {full_elapsed * 1000:8.2f} ms   indexed {indexed_elapsed * 1000:6.2f} ms")
+
+    shutil.rmtree(BENCH_DATA_DIR)
+
+def _peak_rss_mb():
+    """Get this process's peak resident set size in MB (Linux)"""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+def _log_read_peak_rss(mode, data_dir, chat_id, aes_key):
+    """Read a whole chat log one way and return (peak RSS growth in MB, seconds, messages)
+
+    Runs in a fresh process so each mode's peak is measured on its own.
+    """
+    user_manager = UserManager(data_dir)
+    crypto_manager = CryptoManager()
+    chat_store = ChatStore(user_manager, crypto_manager)
+    baseline = _peak_rss_mb()
+
+    start = time.perf_counter()
+    if mode == 'blob_full':
+        # Old path: read the whole legacy blob and decrypt it in one go
+        count = len(crypto_manager.decrypt_chat_log(user_manager.load_chat_log(chat_id), aes_key))
+    elif mode == 'blob_stream':
+        with user_manager.open_chat_log(chat_id) as encrypted_log:
+            count = sum(1 for _ in crypto_manager.iter_decrypt_chat_log(encrypted_log, aes_key))
+    else:
+        chat_store.get_index(chat_id, aes_key)
+        seqs = range(chat_store.message_count(chat_id))
+        count = sum(1 for _ in chat_store.iter_messages(chat_id, aes_key, seqs))
+    elapsed = time.perf_counter() - start
+
+    return _peak_rss_mb() - baseline, elapsed, count
+
+def bench_log_read_memory(count=200000):
+    """Peak memory of reading a whole large chat log: full blob vs streaming"""
+    print(f"Whole chat log read ({count} messages, peak RSS growth per fresh process)")
+
+    user_manager = _fresh_user_manager()
+    crypto_manager = CryptoManager()
+    chat_store = ChatStore(user_manager, crypto_manager)
+    aes_key = crypto_manager.generate_aes_key()
+    start_time = 1700000000.0
+
+    messages = [{
+        'username': f"user{i % 3}",
+        'encrypted_message': 'x' * 60,
+        'timestamp': datetime.fromtimestamp(start_time + i).isoformat()
+    } for i in range(count)]
+    user_manager.save_chat_log("blob", crypto_manager.encrypt_chat_log(messages, aes_key))
+    for message in messages:
+        chat_store.append_message("records", message, aes_key)
+    del messages
+    size = os.path.getsize(user_manager._chat_log_file("blob")) / (1024 * 1024)
+    print(f"   legacy blob size {size:.1f} MB")
+
+    context = multiprocessing.get_context('spawn')
+    runs = [('blob_full', "blob", "legacy blob, full decrypt (before)"),
+            ('blob_stream', "blob", "legacy blob, streaming decrypt"),
+            ('records_stream', "records", "record log, streaming decrypt")]
+    with context.Pool(1, maxtasksperchild=1) as pool:
+        for mode, chat_id, label in runs:
+            peak_mb, elapsed, read = pool.apply(_log_read_peak_rss,
+                                                (mode, BENCH_DATA_DIR, chat_id, aes_key))
+            assert read == count
+            print(f"   {label:<36} peak +{peak_mb:8.1f} MB   {elapsed * 1000:8.0f} ms")
+
+    shutil.rmtree(BENCH_DATA_DIR)
+
+def bench_stream_crypto(total_mb=1024):
+    """Chunked streaming encrypt/decrypt throughput vs raw AES-GCM"""
+    print(f"Streaming encryption ({total_mb} MB input, {STREAM_CHUNK_SIZE // 1024} KB chunks)")
+
+    crypto_manager = CryptoManager()
+    aes_key = crypto_manager.generate_aes_key()
+    block = os.urandom(1024 * 1024)
+
+    def source():
+        for _ in range(total_mb):
+            yield block
+
+    def report(label, elapsed):
+        print(f"   {label:<32} {elapsed:7.2f} s   {total_mb / elapsed:8.1f} MB/s")
+
+    # Raw AES: one GCM context over the whole input, no framing
+    encryptor = Cipher(algorithms.AES(aes_key), modes.GCM(os.urandom(12))).encryptor()
+    buffer = bytearray(len(block) + 15)
+    start = time.perf_counter()
+    for piece in source():
+        encryptor.update_into(piece, buffer)
+    encryptor.finalize()
+    report("raw AES-GCM", time.perf_counter() - start)
+
+    start = time.perf_counter()
+    encrypted_size = sum(len(piece) for piece in crypto_manager.encrypt_stream(source(), aes_key))
+    report("encrypt_stream", time.perf_counter() - start)
+
+    # Decrypt a smaller sample kept in memory and scale up to the same size
+    sample_mb = min(total_mb, 64)
+    encrypted = b''.join(crypto_manager.encrypt_stream([block] * sample_mb, aes_key))
+    start = time.perf_counter()
+    for _ in range(total_mb // sample_mb):
+        for _ in crypto_manager.decrypt_stream([encrypted], aes_key):
+            pass
+    report("decrypt_stream", time.perf_counter() - start)
+
+    overhead = (encrypted_size / (total_mb * 1024 * 1024) - 1) * 100
+    print(f"   size overhead {overhead:.3f}%")
+
+def _startup_peak_rss(mode, data_dir):
+    """Start up on a data directory and return (peak RSS growth in MB, seconds)
+
+    'legacy' loads a single users.json the way startup used to, 'sharded'
+    constructs a UserManager over per-user records.
+    """
+    import json
+    baseline = _peak_rss_mb()
+    start = time.perf_counter()
+    if mode == 'legacy':
+        with open(os.path.join(data_dir, "users.json"), 'r') as f:
+            users = json.load(f)
+        assert users
+    else:
+        user_manager = UserManager(data_dir)
+        assert user_manager.user_exists("user0")
+    elapsed = time.perf_counter() - start
+    return _peak_rss_mb() - baseline, elapsed
+
+def bench_startup():
+    """Server startup time and memory: single users.json vs sharded records"""
+    print("Startup (load users, peak RSS growth per fresh process)")
+
+    crypto_manager = CryptoManager()
+    private_key, public_key = crypto_manager.generate_rsa_keypair()
+    record = json.dumps({
+        "public_key": crypto_manager.serialize_public_key(public_key),
+        "private_key": crypto_manager.serialize_private_key(private_key),
+        "password_hash": "0" * 96,
+        "created_at": datetime.now().isoformat(),
+        "last_seen": datetime.now().isoformat(),
+        "friends": []
+    })
+
+    context = multiprocessing.get_context('spawn')
+    for count in (10000, 100000, 1000000):
+        user_manager = _fresh_user_manager()
+        usernames = [f"user{i}" for i in range(count)]
+
+        # Startup reads only the directory, so records of the sharded layout
+        # are not written; a legacy users.json is only built up to 100k
+        # users (about 250 MB) to keep the benchmark's disk use reasonable
+        UserDirectory.create(os.path.join(user_manager.users_dir, "directory"), usernames)
+        runs = [('sharded', "sharded records")]
+        if count <= 100000:
+            with open(user_manager.users_file + '.bench', 'w') as f:
+                f.write('{')
+                f.write(', '.join(f'"{username}": {record}' for username in usernames))
+                f.write('}')
+            legacy_dir = BENCH_DATA_DIR + "_legacy"
+            os.makedirs(legacy_dir, exist_ok=True)
+            os.replace(user_manager.users_file + '.bench', os.path.join(legacy_dir, "users.json"))
+            runs.insert(0, ('legacy', "users.json (before)"))
+
+        with context.Pool(1, maxtasksperchild=1) as pool:
+            for mode, label in runs:
+                data_dir = BENCH_DATA_DIR + "_legacy" if mode == 'legacy' else BENCH_DATA_DIR
+                peak_mb, elapsed = pool.apply(_startup_peak_rss, (mode, data_dir))
+                print(f"   users={count:<8} {label:<20} {elapsed * 1000:9.1f} ms   "
+                      f"peak +{peak_mb:8.1f} MB   {peak_mb * 1024 * 1024 / count:7.1f} B/user")
+
+        if os.path.exists(BENCH_DATA_DIR + "_legacy"):
+            shutil.rmtree(BENCH_DATA_DIR + "_legacy")
+    shutil.rmtree(BENCH_DATA_DIR)
+
+def bench_chat_storage(counts=(10000, 100000, 300000), samples=5000):
+    """Per-chat file create/open latency: flat directory vs hashed fanout"""
+    print("Chat file storage (create, open existing, miss; microseconds per file)")
+
+    import random
+    for count in counts:
+        chat_ids = [str(uuid.uuid4()) for _ in range(count)]
+        sample = random.sample(chat_ids, min(samples, count))
+        missing = [str(uuid.uuid4()) for _ in range(samples)]
+
+        for layout in ('flat', 'sharded'):
+            directory = os.path.join(BENCH_DATA_DIR, layout)
+            if os.path.exists(BENCH_DATA_DIR):
+                shutil.rmtree(BENCH_DATA_DIR)
+            os.makedirs(directory)
+
+            def path(chat_id):
+                if layout == 'flat':
+                    return os.path.join(directory, f"{chat_id}.enc")
+                return sharded_path(directory, f"{chat_id}.enc")
+
+            start = time.perf_counter()
+            for chat_id in chat_ids:
+                file_path = path(chat_id)
+                if layout == 'sharded':
+                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                with open(file_path, 'ab') as f:
+                    f.write(b'CHATLOG1')
+            create = (time.perf_counter() - start) / count
+
+            start = time.perf_counter()
+            for chat_id in sample:
+                with open(path(chat_id), 'rb') as f:
+                    f.read(8)
+            open_existing = (time.perf_counter() - start) / len(sample)
+
+            start = time.perf_counter()
+            for chat_id in missing:
+                os.path.exists(path(chat_id))
+            miss = (time.perf_counter() - start) / len(missing)
+
+            # Listing the directory a chat lives in, as backups and tools do
+            start = time.perf_counter()
+            with os.scandir(os.path.dirname(path(chat_ids[0]))) as entries:
+                listed = sum(1 for _ in entries)
+            listing = time.perf_counter() - start
+
+            print(f"   chats={count:<7} {layout:<8} create {create * 1e6:7.1f}   open {open_existing * 1e6:6.1f}   "
+                  f"miss {miss * 1e6:5.1f}   list one dir {listing * 1000:7.2f} ms ({listed} entries)")
+
+    shutil.rmtree(BENCH_DATA_DIR)
+
+def bench_chat_writers(writers=8, messages=4000, chat_counts=(1, 2, 8, 32)):
+    """send_message throughput by number of chats: one global lock vs per-chat stripes"""
+    print(f"Chat write throughput ({writers} writer threads, {messages} messages, messages/s)")
+
+    import threading
+    crypto_manager = CryptoManager()
+    aes_key = crypto_manager.generate_aes_key()
+    for chat_count in chat_counts:
+        results = []
+        for label, stripes in (('global lock', 1), ('striped', None)):
+            if os.path.exists(BENCH_DATA_DIR):
+                shutil.rmtree(BENCH_DATA_DIR)
+            chat_store = ChatStore(UserManager(BENCH_DATA_DIR), crypto_manager)
+            if stripes is not None:
+                # One shared lock is what a global writer lock would cost
+                chat_store._chat_locks = chat_store._chat_locks[:stripes]
+            chat_ids = [f"chat_{i}" for i in range(chat_count)]
+            for chat_id in chat_ids:
+                chat_store.append_message(chat_id, {"username": "seed", "encrypted_message": "x",
+                                                    "timestamp": datetime.now().isoformat()}, aes_key)
+            barrier = threading.Barrier(writers + 1)
+
+            def write(writer):
+                barrier.wait()
+                for i in range(writer, messages, writers):
+                    chat_store.append_message(chat_ids[i % chat_count], {
+                        "username": f"user{writer}",
+                        "encrypted_message": "m" * 200,
+                        "timestamp": datetime.now().isoformat()
+                    }, aes_key)
+
+            threads = [threading.Thread(target=write, args=(writer,)) for writer in range(writers)]
+            for thread in threads:
+                thread.start()
+            barrier.wait()
+            start = time.perf_counter()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+
+            stored = sum(chat_store.message_count(chat_id) for chat_id in chat_ids) - chat_count
+            if stored != messages:
+                print(f"   [FAIL] {label}: {stored} of {messages} messages stored")
+            results.append(f"{label} {messages / elapsed:8.0f}")
+        print(f"   chats={chat_count:<4} " + "   ".join(results))
+
+    shutil.rmtree(BENCH_DATA_DIR)
+
+def _session_state_rss(mode, count):
+    """Build count sessions or chat keys one way and return peak RSS growth in MB
+
+    'dict' is a session dict holding a deserialized private key, as sessions
+    used to be; 'session' is a slotted Session in a SessionRegistry. 'keys'
+    and 'key cache' hold chat keys in a plain dict and in a ChatKeyCache.
+    """
+    import secrets
+    from session_state import SessionRegistry, ChatKeyCache
+    crypto_manager = CryptoManager()
+    private_key_pem = crypto_manager.serialize_private_key(crypto_manager.generate_rsa_keypair()[0])
+    baseline = _peak_rss_mb()
+    if mode == 'dict':
+        sessions, user_sessions = {}, {}
+        for i in range(count):
+            session_id = secrets.token_urlsafe(15)
+            sessions[session_id] = {
+                'username': f"user{i}",
+                'private_key': crypto_manager.deserialize_private_key(private_key_pem)
+            }
+            user_sessions.setdefault(f"user{i}", set()).add(session_id)
+    elif mode == 'session':
+        sessions = SessionRegistry()
+        for i in range(count):
+            sessions.add(secrets.token_urlsafe(15), f"user{i}")
+    elif mode == 'keys':
+        keys = {}
+        for i in range(count):
+            keys[str(uuid.uuid4())] = secrets.token_bytes(32)
+    else:
+        keys = ChatKeyCache()
+        for i in range(count):
+            keys.put(str(uuid.uuid4()), secrets.token_bytes(32))
+    return _peak_rss_mb() - baseline
+
+def bench_session_memory(connections=50000, dict_sample=500):
+    """Memory per connection and per chat key: old session dicts vs slotted state"""
+    print("Session state memory (peak RSS growth per fresh process)")
+
+    context = multiprocessing.get_context('spawn')
+    runs = [
+        ('dict', dict_sample, "session dict + private key"),
+        ('session', connections, "slotted Session"),
+        ('keys', connections, "chat keys in a dict"),
+        ('key cache', connections, "ChatKeyCache"),
+    ]
+    with context.Pool(1, maxtasksperchild=1) as pool:
+        for mode, count, label in runs:
+            peak_mb = pool.apply(_session_state_rss, (mode, count))
+            print(f"   {label:<28} x{count:<7} peak +{peak_mb:7.1f} MB   "
+                  f"{peak_mb * 1024 * 1024 / count:8.0f} B each   "
+                  f"{peak_mb * connections / count:7.1f} MB at {connections}")
+
+def bench_profiler_overhead(messages=3000):
+    """send_message handling cost with the profiler off, sampling, and profiling events"""
+    print(f"Profiler overhead ({messages} chat appends, microseconds per message)")
+
+    from profiler import Profiler
+    crypto_manager = CryptoManager()
+    aes_key = crypto_manager.generate_aes_key()
+    if os.path.exists(BENCH_DATA_DIR):
+        shutil.rmtree(BENCH_DATA_DIR)
+    chat_store = ChatStore(UserManager(BENCH_DATA_DIR), crypto_manager)
+    profiler = Profiler(os.path.join(BENCH_DATA_DIR, "profiles"))
+
+    def send(i):
+        chat_store.append_message("chat", {"username": "alice", "encrypted_message": "m" * 200,
+                                           "timestamp": datetime.now().isoformat()}, aes_key)
+
+    def handler(i):
+        # What the rate_limited wrapper does around every event
+        if profiler.should_profile('send_message'):
+            return profiler.profile_call('send_message', send, i)
+        return send(i)
+
+    runs = [
+        ('no profiler hook', None, send),
+        ('profiler off', None, handler),
+        ('sampling every 5 ms', 'sample', handler),
+        ('cProfile 10% of events', 0.1, handler),
+        ('cProfile every event', 1.0, handler),
+    ]
+    for label, mode, function in runs:
+        if mode == 'sample':
+            profiler.start_sampling(duration=600)
+        elif mode is not None:
+            profiler.profile_events({'send_message': mode}, duration=600)
+        start = time.perf_counter()
+        for i in range(messages):
+            function(i)
+        elapsed = time.perf_counter() - start
+        profiler.stop_sampling()
+        profiler.finish_events()
+        print(f"   {label:<24} {elapsed / messages * 1e6:8.1f}")
+        time.sleep(0.05)
+
+    shutil.rmtree(BENCH_DATA_DIR)
+
+def bench_backup(chats=100000, changed_fraction=0.01, worker_counts=(1, 8)):
+    """Snapshot and restore time for a data directory of many chats"""
+    print(f"Backup ({chats} chats, seconds)")
+
+    import random
+    from backup import create_snapshot, restore_snapshot
+    if os.path.exists(BENCH_DATA_DIR):
+        shutil.rmtree(BENCH_DATA_DIR)
+    data_dir = os.path.join(BENCH_DATA_DIR, "data")
+    UserManager(data_dir)
+
+    # Each chat gets a log, an index and metadata, written directly since
+    # encrypting real messages would dominate the setup
+    record = b'\x00\x00\x01\x00' + os.urandom(256)
+    chat_ids = [str(uuid.uuid4()) for _ in range(chats)]
+    for chat_id in chat_ids:
+        for directory, extension, content in (
+                ("chat_logs", ".enc", b'CHATLOG1' + record),
+                ("chat_index", ".idx", json.dumps([8, 256, 1700000000.0, "alice", 0]).encode() + b'\n'),
+                ("chats", ".json", json.dumps({"chat_id": chat_id, "participants": ["alice", "bob"],
+                                               "created_at": 1700000000.0}).encode())):
+            path = sharded_path(os.path.join(data_dir, directory), chat_id + extension)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(content)
+    files = chats * 3
+
+    def timed(function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        return time.perf_counter() - start, result
+
+    backups_dir = os.path.join(BENCH_DATA_DIR, "backups")
+    elapsed, _ = timed(shutil.copytree, data_dir, os.path.join(BENCH_DATA_DIR, "copytree"))
+    print(f"   shutil.copytree (no consistency) {elapsed:7.2f}")
+    shutil.rmtree(os.path.join(BENCH_DATA_DIR, "copytree"))
+
+    for workers in worker_counts:
+        elapsed, summary = timed(create_snapshot, data_dir, backups_dir, workers, False)
+        print(f"   full snapshot, {workers} workers    {elapsed:7.2f}   ({summary['copied']} of {files} files copied)")
+        if workers != worker_counts[-1]:
+            shutil.rmtree(summary['snapshot'])
+
+    elapsed, summary = timed(create_snapshot, data_dir, backups_dir, worker_counts[-1])
+    print(f"   incremental, nothing changed     {elapsed:7.2f}   ({summary['copied']} of {files} files copied)")
+
+    for chat_id in random.sample(chat_ids, int(chats * changed_fraction)):
+        with open(sharded_path(os.path.join(data_dir, "chat_logs"), chat_id + ".enc"), 'ab') as f:
+            f.write(record)
+        with open(sharded_path(os.path.join(data_dir, "chat_index"), chat_id + ".idx"), 'a') as f:
+            f.write(json.dumps([268, 256, 1700000001.0, "bob", 1]) + '\n')
+    elapsed, summary = timed(create_snapshot, data_dir, backups_dir, worker_counts[-1])
+    print(f"   incremental, {changed_fraction:.0%} of chats changed {elapsed:7.2f}   "
+          f"({summary['copied']} of {files} files copied)")
+
+    for workers in worker_counts:
+        target = os.path.join(BENCH_DATA_DIR, f"restore_{workers}")
+        elapsed, (success, message) = timed(restore_snapshot, summary['snapshot'], target, workers)
+        if not success:
+            print(f"   [FAIL] Restore: {message}")
+        print(f"   restore, {workers} workers          {elapsed:7.2f}")
+        shutil.rmtree(target)
+
+    shutil.rmtree(BENCH_DATA_DIR)
+
+def _public_key_lookup_costs(data_dir, usernames, rounds):
+    """Look up every user's public key through the Socket.IO handlers, three ways
+
+    Returns {mode: (ms per lookup, round-trips, bytes received)}. Runs in a
+    fresh process, since the app reads CHAT_DATA_DIR when imported.
+    """
+    # Handlers log with print; this process is only for the benchmark
+    sys.stdout = open(os.devnull, 'w')
+    os.environ['CHAT_DATA_DIR'] = data_dir
+    import app as server
+    server.rate_limiter.limits = {}
+    client = server.socketio.test_client(server.app)
+    client.get_received()
+
+    def one_at_a_time():
+        received = []
+        for username in usernames:
+            client.emit('get_public_key', {'username': username})
+            received += client.get_received()
+        return len(usernames), received
+
+    def batch(known):
+        client.emit('get_public_keys', {'usernames': usernames, 'known': known})
+        return 1, client.get_received()
+
+    _, received = batch({})
+    current = {username: key['fingerprint'] for username, key in received[0]['args'][0]['keys'].items()}
+    results = {}
+    for mode, lookup in (('one at a time', one_at_a_time),
+                         ('batch, empty cache', lambda: batch({})),
+                         ('batch, cache current', lambda: batch(current))):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            round_trips, received = lookup()
+        elapsed = (time.perf_counter() - start) / rounds
+        results[mode] = (elapsed * 1000, round_trips, sum(len(json.dumps(packet['args'])) for packet in received))
+    client.disconnect()
+    return results
+
+def bench_public_keys(member_counts=(10, 100, 500), rounds=20, rtt_ms=50):
+    """Fetching a group's public keys: one request per member vs one batch with cached fingerprints"""
+    print(f"Public key lookup for a group chat (server time per lookup, bytes sent, total at {rtt_ms} ms RTT)")
+
+    user_manager = _fresh_user_manager()
+    usernames = _seed_users(user_manager, max(member_counts))
+    pem = user_manager.get_user_public_key(usernames[0])
+    start = time.perf_counter()
+    for _ in range(100):
+        user_manager.crypto_manager.public_key_fingerprint(pem)
+    print(f"   fingerprinting one key takes {(time.perf_counter() - start) * 10:.3f} ms, "
+          f"done once per user instead of per lookup")
+
+    context = multiprocessing.get_context('spawn')
+    for count in member_counts:
+        with context.Pool(1, maxtasksperchild=1) as pool:
+            results = pool.apply(_public_key_lookup_costs, (BENCH_DATA_DIR, usernames[:count], rounds))
+        for mode, (server_ms, round_trips, received) in results.items():
+            print(f"   members={count:<4} {mode:<22} {server_ms:8.2f} ms   {received:8d} B   "
+                  f"{round_trips:4d} round-trips   ~{server_ms + round_trips * rtt_ms:7.0f} ms")
+
+    shutil.rmtree(BENCH_DATA_DIR)
+
+def bench_membership(member_counts=(2, 100, 1000), checks=100000, changes=200):
+    """Membership checks: participant tuple scan vs registry set, and the cost of member changes"""
+    print(f"Chat membership ({checks} checks of the last member, {changes} add/remove pairs)")
+
+    user_manager = _fresh_user_manager()
+    membership = MembershipRegistry(user_manager)
+
+    for count in member_counts:
+        chat_id = f"bench_{count}"
+        members = [f"user{i}" for i in range(count)]
+        membership.create_chat(chat_id, members, 1700000000.0, created_by=members[0])
+        participants = membership.get_members(chat_id)
+        last = members[-1]
+
+        start = time.perf_counter()
+        for _ in range(checks):
+            last in participants
+        scan_elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(checks):
+            membership.is_member(chat_id, last)
+        set_elapsed = time.perf_counter() - start
+
+        membership.unload_chat(chat_id)
+        start = time.perf_counter()
+        membership.is_member(chat_id, last)
+        cold_elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for i in range(changes):
+            membership.add_member(chat_id, f"guest{i}")
+            membership.remove_member(chat_id, f"guest{i}")
+        change_elapsed = time.perf_counter() - start
+
+        print(f"   members={count:<5} tuple scan {scan_elapsed / checks * 1e9:7.0f} ns   "
+              f"registry {set_elapsed / checks * 1e9:5.0f} ns   cold load {cold_elapsed * 1000:6.2f} ms   "
+              f"add+remove {change_elapsed / changes * 1000:6.2f} ms")
+
+    shutil.rmtree(BENCH_DATA_DIR)
+
+def bench_password_hashing(logins=10):
+    """Logins per second per core for each password hash profile, and the one-off cost of a rehash"""
+    print(f"Password hashing ({logins} logins per profile through authenticate_user, "
+          f"default profile {DEFAULT_PASSWORD_PROFILE}, {os.cpu_count()} cores)")
+
+    user_manager = _fresh_user_manager()
+    for profile, (kdf, params) in PASSWORD_PROFILES.items():
+        user_manager.password_hasher = PasswordHasher(profile)
+        username = f"user_{profile}"
+        user_manager.register_user(username, "password123")
+
+        start = time.process_time()
+        for _ in range(logins):
+            assert user_manager.authenticate_user(username, "password123")[0]
+        cpu_per_login = (time.process_time() - start) / logins
+        memory = f"{128 * params[1] * params[0] / (1 << 20):4.0f} MiB" if kdf == 'scrypt' else "   -    "
+        print(f"   {profile:<14} {cpu_per_login * 1000:7.1f} ms CPU   {1 / cpu_per_login:6.1f} logins/s/core   "
+              f"memory {memory}   ~{os.cpu_count() / cpu_per_login:6.1f} logins/s on this host")
+
+    # A legacy salt+hex hash is verified at 100,000 PBKDF2 iterations, then
+    # rehashed with the current profile on the first successful login
+    user_manager.password_hasher = PasswordHasher(DEFAULT_PASSWORD_PROFILE)
+    salt = "0" * 32
+    legacy_hash = salt + hashlib.pbkdf2_hmac('sha256', b"password123", salt.encode('utf-8'), 100000).hex()
+    timings = []
+    for i in range(logins):
+        username = f"legacy{i}"
+        user_manager.add_user_record({"username": username, "password_hash": legacy_hash, "friends": []})
+        # The rehash is logged with print; keep the report readable
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            start = time.process_time()
+            assert user_manager.authenticate_user(username, "password123")[0]
+            timings.append(time.process_time() - start)
+    print(f"   first login with a legacy hash (verify + rehash to {DEFAULT_PASSWORD_PROFILE}) "
+          f"{sum(timings) / logins * 1000:7.1f} ms CPU, once per user")
+
+    shutil.rmtree(BENCH_DATA_DIR)
+
+BENCHMARKS = {
+    'key_fanout': bench_key_fanout,
+    'history_query': bench_history_query,
+    'log_read_memory': bench_log_read_memory,
+    'stream_crypto': bench_stream_crypto,
+    'startup': bench_startup,
+    'chat_storage': bench_chat_storage,
+    'chat_writers': bench_chat_writers,
+    'session_memory': bench_session_memory,
+    'profiler_overhead': bench_profiler_overhead,
+    'backup': bench_backup,
+    'public_keys': bench_public_keys,
+    'membership': bench_membership,
+    'password_hashing': bench_password_hashing,
+}
+
+def main():
+    """Run the selected benchmarks"""
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark: {name} (available: {', '.join(BENCHMARKS)})")
+            return False
+
+    print("Secure Chat App - Benchmarks")
+    print("=" * 50)
+    for name in names:
+        BENCHMARKS[name]()
+        print()
+    return True
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
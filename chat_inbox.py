@@ -0,0 +1,300 @@
+import threading
+from datetime import datetime
+from membership import MembershipRegistry
+
+class InboxEntry:
+    """One chat in a user's inbox, linked in order of last activity"""
+
+    __slots__ = ('chat_id', 'participants', 'last_timestamp', 'last_seq', 'prev', 'next')
+
+    def __init__(self, chat_id, participants, last_timestamp, last_seq):
+        self.chat_id = chat_id
+        self.participants = participants
+        self.last_timestamp = last_timestamp
+        self.last_seq = last_seq
+        self.prev = None
+        self.next = None
+
+    def key(self):
+        """Get the (last_timestamp, chat_id) pair the inbox is ordered by, newest first"""
+        return self.last_timestamp, self.chat_id
+
+    def to_dict(self):
+        return {
+            'chat_id': self.chat_id,
+            'participants': list(self.participants),
+            'last_timestamp': datetime.fromtimestamp(self.last_timestamp).isoformat(),
+            'last_seq': self.last_seq
+        }
+
+def format_cursor(entry):
+    """Encode a page cursor pointing just after an inbox entry"""
+    return f"{entry.last_timestamp!r}:{entry.chat_id}"
+
+def parse_cursor(cursor):
+    """Decode a page cursor into the key it points after, raising ValueError if malformed"""
+    if not isinstance(cursor, str) or ':' not in cursor:
+        raise ValueError("Invalid cursor")
+    timestamp, chat_id = cursor.split(':', 1)
+    return float(timestamp), chat_id
+
+class UserInbox:
+    """A user's chats as a doubly linked list, most recently active first
+
+    Entries are kept sorted by (last_timestamp, chat_id), descending, so a
+    page cursor can name a position in that order rather than a chat: a
+    chat that moves to the front between page requests doesn't make the
+    next page restart or skip.
+    """
+
+    def __init__(self):
+        self.head = None
+        self.tail = None
+        self.entries = {}  # {chat_id: InboxEntry}
+
+    def _unlink(self, entry):
+        if entry.prev is None:
+            self.head = entry.next
+        else:
+            entry.prev.next = entry.next
+        if entry.next is None:
+            self.tail = entry.prev
+        else:
+            entry.next.prev = entry.prev
+        entry.prev = entry.next = None
+
+    def _insert(self, entry):
+        """Link an entry in its sorted place, found from the front (O(1) for the newest)"""
+        key = entry.key()
+        following = self.head
+        while following is not None and following.key() > key:
+            following = following.next
+        if following is None:
+            entry.prev = self.tail
+            if self.tail is not None:
+                self.tail.next = entry
+            else:
+                self.head = entry
+            self.tail = entry
+            return
+        entry.prev = following.prev
+        entry.next = following
+        if following.prev is not None:
+            following.prev.next = entry
+        else:
+            self.head = entry
+        following.prev = entry
+
+    def add(self, entry):
+        """Add a chat in order of its last activity"""
+        existing = self.entries.get(entry.chat_id)
+        if existing is not None:
+            self._unlink(existing)
+        self.entries[entry.chat_id] = entry
+        self._insert(entry)
+
+    def remove(self, chat_id):
+        """Remove a chat the user no longer belongs to"""
+        entry = self.entries.pop(chat_id, None)
+        if entry is not None:
+            self._unlink(entry)
+
+    def touch(self, chat_id, timestamp, seq):
+        """Record new activity in a chat and move it to the front"""
+        entry = self.entries.get(chat_id)
+        if entry is None:
+            return
+        # Concurrent senders can report their seqs out of order
+        if entry.last_seq is not None and seq <= entry.last_seq:
+            return
+        self._unlink(entry)
+        entry.last_timestamp = timestamp
+        entry.last_seq = seq
+        self._insert(entry)
+
+    def page(self, cursor=None, limit=20):
+        """Get up to limit entries after the cursor, and the next cursor
+
+        Raises ValueError for a malformed cursor.
+        """
+        entry = self.head
+        if cursor is not None:
+            key = parse_cursor(cursor)
+            after = self.entries.get(key[1])
+            if after is not None and after.key() == key:
+                entry = after.next
+            else:
+                # The cursor's chat moved or left; resume strictly after its old place
+                while entry is not None and entry.key() >= key:
+                    entry = entry.next
+
+        chats = []
+        while entry is not None and len(chats) < limit:
+            chats.append(entry)
+            entry = entry.next
+        next_cursor = format_cursor(chats[-1]) if chats and entry is not None else None
+        return chats, next_cursor
+
+class ChatInbox:
+    """Per-user chat lists ordered by last activity
+
+    Which chats a user belongs to comes from the MembershipRegistry. A
+    user's inbox is built the first time it is needed, reading each chat's
+    last activity from the tail of its index, and is then kept up to date in
+    memory as chats are started, members change and messages are sent.
+    Inboxes are built without holding the lock; changes made meanwhile are
+    queued and applied to the new inbox before it is published.
+    """
+
+    def __init__(self, user_manager, chat_store, membership=None):
+        self.user_manager = user_manager
+        self.chat_store = chat_store
+        self.membership = membership if membership is not None else MembershipRegistry(user_manager)
+
+        self._lock = threading.Lock()
+        self._inboxes = {}  # {username: UserInbox}
+        self._loading = {}  # {username: changes to apply once their inbox is built}
+
+    def get_chat(self, chat_id):
+        """Get a chat's stored metadata, or None for unknown chats"""
+        return self.membership.get_chat(chat_id)
+
+    def get_participants(self, chat_id):
+        """Get a chat's participants as a tuple"""
+        return self.membership.get_members(chat_id)
+
+    def _apply(self, username, change):
+        """Apply a change to a user's inbox if it is loaded or being built (call with the lock held)"""
+        inbox = self._inboxes.get(username)
+        if inbox is not None:
+            change(inbox)
+        elif username in self._loading:
+            self._loading[username].append(change)
+
+    def add_chat(self, chat_id, participants, timestamp, created_by=None):
+        """Record a new chat in every participant's inbox"""
+        chat = self.membership.create_chat(chat_id, participants, timestamp, created_by)
+        participants = tuple(chat['participants'])
+        with self._lock:
+            for username in participants:
+                self._apply(username, lambda inbox: inbox.add(InboxEntry(chat_id, participants, timestamp, None)))
+
+    def _update_participants(self, chat_id, participants):
+        """Update a chat's participants in the users' inboxes (call with the lock held)"""
+        def update(inbox):
+            entry = inbox.entries.get(chat_id)
+            if entry is not None:
+                entry.participants = participants
+
+        for username in participants:
+            self._apply(username, update)
+
+    def add_member(self, chat_id, username):
+        """Add a user to a chat and to their inbox
+
+        Returns (success, message).
+        """
+        success, message = self.membership.add_member(chat_id, username)
+        if not success:
+            return success, message
+        participants = self.membership.get_members(chat_id)
+        chat = self.membership.get_chat(chat_id)
+        last = self.chat_store.last_entry(chat_id)
+        timestamp, seq = (last[1], last[0]) if last else (chat['created_at'], None)
+        with self._lock:
+            self._update_participants(chat_id, participants)
+            self._apply(username, lambda inbox: inbox.add(InboxEntry(chat_id, participants, timestamp, seq)))
+        return success, message
+
+    def remove_member(self, chat_id, username):
+        """Remove a user from a chat and drop it from their inbox
+
+        Returns (success, message).
+        """
+        success, message = self.membership.remove_member(chat_id, username)
+        if not success:
+            return success, message
+        participants = self.membership.get_members(chat_id)
+        with self._lock:
+            self._update_participants(chat_id, participants)
+            self._apply(username, lambda inbox: inbox.remove(chat_id))
+        return success, message
+
+    def record_message(self, chat_id, timestamp, seq):
+        """Move a chat to the front of its participants' inboxes"""
+        participants = self.get_participants(chat_id)
+        with self._lock:
+            for username in participants:
+                self._apply(username, lambda inbox: inbox.touch(chat_id, timestamp, seq))
+
+    def _load_inbox(self, username):
+        """Build a user's inbox from their chats and each chat's last activity"""
+        chat_ids = self.membership.get_user_chats(username)
+
+        entries = []
+        for chat_id in chat_ids:
+            chat = self.get_chat(chat_id)
+            if chat is None:
+                continue
+            last = self.chat_store.last_entry(chat_id)
+            if last is None:
+                entry = InboxEntry(chat_id, tuple(chat['participants']), chat['created_at'], None)
+            else:
+                entry = InboxEntry(chat_id, tuple(chat['participants']), last[1], last[0])
+            entries.append(entry)
+
+        inbox = UserInbox()
+        for entry in sorted(entries, key=lambda e: e.last_timestamp):
+            inbox.add(entry)
+        return inbox
+
+    def get_inbox(self, username):
+        """Get a user's inbox, loading it on first use"""
+        inbox = self._inboxes.get(username)
+        if inbox is not None:
+            return inbox
+        with self._lock:
+            inbox = self._inboxes.get(username)
+            if inbox is not None:
+                return inbox
+            # Changes from here on are queued until the inbox is published
+            self._loading.setdefault(username, [])
+
+        # Build outside the lock, which every send takes
+        try:
+            inbox = self._load_inbox(username)
+        except BaseException:
+            with self._lock:
+                self._loading.pop(username, None)
+            raise
+
+        with self._lock:
+            published = self._inboxes.get(username)
+            if published is not None:
+                # Another request built it first
+                return published
+            changes = self._loading.pop(username, None)
+            if changes is None:
+                # Unloaded while it was built; don't keep it
+                return inbox
+            # Changes are safe to repeat on a build that already saw them
+            for change in changes:
+                change(inbox)
+            self._inboxes[username] = inbox
+        return inbox
+
+    def list_chats(self, username, cursor=None, limit=20):
+        """Get a page of a user's chats, most recently active first
+
+        Raises ValueError for a malformed cursor.
+        """
+        inbox = self.get_inbox(username)
+        with self._lock:
+            entries, next_cursor = inbox.page(cursor, limit)
+            return [entry.to_dict() for entry in entries], next_cursor
+
+    def unload(self, username):
+        """Drop a user's inbox from memory"""
+        with self._lock:
+            self._inboxes.pop(username, None)
+            self._loading.pop(username, None)
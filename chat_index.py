@@ -0,0 +1,161 @@
+import os
+import sys
+import json
+from array import array
+from bisect import bisect_left
+
+class ChatIndex:
+    """Plaintext metadata index over one chat's append-only record log
+
+    Entry n describes message sequence number n: the byte offset and length
+    of its encrypted record, its timestamp (seconds since the epoch) and its
+    sender. Entries are persisted as JSON lines of
+    [offset, length, timestamp, sender, seq], one per message, and kept in
+    memory as flat arrays so lookups are binary searches.
+
+    A corrupt line still takes up its seq, as a placeholder listed in
+    missing, so the seqs after it never shift; a line whose stored seq is
+    ahead of its position has placeholders added for the lines lost before
+    it. Placeholders have no record and are left out of query results.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        self.offsets = array('Q')
+        self.lengths = array('I')
+        self.timestamps = array('d')  # Non-decreasing, so they can be bisected
+        self.senders = []
+        self.sender_seqs = {}  # {sender: array of seq}
+        self.missing = set()  # Seqs of placeholders for corrupt lines
+
+        self._load()
+
+    def _load(self):
+        """Load entries from the index file"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb+') as f:
+            position = 0
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Drop a torn final line from an interrupted append
+                    f.truncate(position)
+                    break
+                position += len(line)
+                try:
+                    offset, length, timestamp, sender, seq = json.loads(line)
+                    # Check types first so a bad entry never half-updates the arrays
+                    entry = int(offset), int(length), float(timestamp), sender
+                    seq = int(seq)
+                    if not isinstance(sender, str) or min(entry[0], entry[1], seq) < 0:
+                        raise ValueError('Invalid index entry')
+                except (ValueError, TypeError):
+                    # Keep the line's seq rather than make the whole chat unloadable
+                    self._add_missing()
+                    continue
+                while len(self.offsets) < seq:
+                    self._add_missing()
+                if seq < len(self.offsets):
+                    # A duplicate or out-of-place line; its position is taken
+                    self._add_missing()
+                    continue
+                self._add(*entry)
+
+    def _add(self, offset, length, timestamp, sender):
+        """Add an entry to the in-memory arrays
+
+        Readers take no lock and size everything by len(offsets), so offsets
+        is appended last: every seq a reader can see has all its fields.
+        """
+        seq = len(self.offsets)
+        sender = sys.intern(sender)
+        self.lengths.append(length)
+        self.timestamps.append(timestamp)
+        self.senders.append(sender)
+        seqs = self.sender_seqs.get(sender)
+        if seqs is None:
+            seqs = self.sender_seqs[sender] = array('I')
+        seqs.append(seq)
+        self.offsets.append(offset)
+        return seq
+
+    def _add_missing(self):
+        """Add a placeholder entry for a corrupt line, keeping later seqs in place"""
+        seq = len(self.offsets)
+        self.lengths.append(0)
+        self.timestamps.append(self.timestamps[-1] if self.timestamps else 0.0)
+        self.senders.append('')
+        self.missing.add(seq)
+        self.offsets.append(0)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def append(self, offset, length, timestamp, sender):
+        """Record a newly appended message and return its sequence number"""
+        # Clock steps backwards must not break the timestamp ordering
+        if self.timestamps and timestamp < self.timestamps[-1]:
+            timestamp = self.timestamps[-1]
+
+        with open(self.path, 'a') as f:
+            f.write(json.dumps([offset, length, timestamp, sender, len(self.offsets)]) + '\n')
+        return self._add(offset, length, timestamp, sender)
+
+    @classmethod
+    def create(cls, path, entries):
+        """Write a new index from (offset, length, timestamp, sender) entries"""
+        tmp_path = path + '.tmp'
+        last_timestamp = float('-inf')
+        with open(tmp_path, 'w') as f:
+            for seq, (offset, length, timestamp, sender) in enumerate(entries):
+                last_timestamp = max(last_timestamp, timestamp)
+                f.write(json.dumps([offset, length, last_timestamp, sender, seq]) + '\n')
+        os.replace(tmp_path, path)
+        return cls(path)
+
+    @staticmethod
+    def read_last_entry(path, tail_size=4096):
+        """Read (seq, timestamp, sender) of the newest entry without loading the index"""
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(0, size - tail_size))
+            lines = f.read().splitlines()
+        for line in reversed(lines):
+            try:
+                offset, length, timestamp, sender, seq = json.loads(line)
+            except (json.JSONDecodeError, ValueError, UnicodeDecodeError):
+                continue
+            return seq, timestamp, sender
+        return None
+
+    def span(self, seq):
+        """Get the (offset, length) of a message's encrypted record"""
+        return self.offsets[seq], self.lengths[seq]
+
+    def seq_at(self, timestamp):
+        """Get the first sequence number at or after a timestamp"""
+        return bisect_left(self.timestamps, timestamp, 0, len(self.offsets))
+
+    def seq_range(self, since=None, until=None):
+        """Get the [start, end) sequence numbers with since <= timestamp < until"""
+        # Only bisect the entries published when the search began
+        count = len(self.offsets)
+        start = 0 if since is None else bisect_left(self.timestamps, since, 0, count)
+        end = count if until is None else bisect_left(self.timestamps, until, 0, count)
+        return start, max(start, end)
+
+    def sender_seq_bounds(self, sender, start, end):
+        """Get the positions in sender_seqs[sender] of the sender's seqs in [start, end)"""
+        seqs = self.sender_seqs.get(sender, ())
+        return bisect_left(seqs, start), bisect_left(seqs, end)
+
+    def last_entry(self):
+        """Get (seq, timestamp, sender) of the newest message, or None"""
+        if not self.offsets:
+            return None
+        seq = len(self.offsets) - 1
+        return seq, self.timestamps[seq], self.senders[seq]
@@ -0,0 +1,209 @@
+import os
+import re
+import json
+import threading
+from bisect import bisect_left
+from datetime import datetime
+from chat_index import ChatIndex
+
+# Chat ids become file names, so only allow a safe character set
+CHAT_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+# Chats hash onto this many writer locks, so writes to one chat are
+# serialized while writes to different chats rarely contend
+CHAT_LOCK_STRIPES = 256
+
+def parse_timestamp(value):
+    """Convert an ISO 8601 timestamp or epoch seconds to epoch seconds"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    return datetime.fromisoformat(value).timestamp()
+
+class ChatStore:
+    """Append-only encrypted chat logs with a per-chat metadata index
+
+    Each message is its own encrypted record in the chat log, and the chat's
+    ChatIndex maps its sequence number to the record's offset, timestamp and
+    sender. History queries use the index to find the matching records and
+    only read and decrypt those.
+
+    Writes to a chat (appends, creating its index and upgrading a legacy
+    log) hold the chat's lock stripe, so they apply one at a time in seq
+    order while other chats proceed in parallel. Reads take no lock: a
+    message's record is written before its index entry, so every seq a
+    reader can see is complete on disk.
+    """
+
+    def __init__(self, user_manager, crypto_manager):
+        self.user_manager = user_manager
+        self.crypto_manager = crypto_manager
+        self.index_dir = os.path.join(user_manager.data_dir, "chat_index")
+        os.makedirs(self.index_dir, exist_ok=True)
+
+        self._indexes = {}  # {chat_id: ChatIndex}
+        self._chat_locks = [threading.Lock() for _ in range(CHAT_LOCK_STRIPES)]
+
+    def is_valid_chat_id(self, chat_id):
+        """Check that a chat id is safe to use in file names"""
+        return isinstance(chat_id, str) and CHAT_ID_PATTERN.fullmatch(chat_id) is not None
+
+    def _index_file(self, chat_id, create=False):
+        """Get the path of a chat's index file"""
+        return self.user_manager.chat_data_file(self.index_dir, chat_id, ".idx", create)
+
+    def _chat_lock(self, chat_id):
+        """Get the lock stripe serializing writes to a chat"""
+        return self._chat_locks[hash(chat_id) % len(self._chat_locks)]
+
+    def get_index(self, chat_id, aes_key=None):
+        """Get a chat's index, upgrading a legacy log when the key is given
+
+        Returns None for chats with no messages, and for legacy logs that
+        can't be upgraded without the key.
+        """
+        index = self._indexes.get(chat_id)
+        if index is not None:
+            return index
+        with self._chat_lock(chat_id):
+            return self._load_index(chat_id, aes_key)
+
+    def _load_index(self, chat_id, aes_key):
+        """Load or build a chat's index (call with the chat's lock held)"""
+        index = self._indexes.get(chat_id)
+        if index is not None:
+            return index
+
+        log_format = self.user_manager.chat_log_format(chat_id)
+        if log_format == 'legacy':
+            if aes_key is None:
+                return None
+            index = self._upgrade_legacy_log(chat_id, aes_key)
+        elif log_format == 'records':
+            index = ChatIndex(self._index_file(chat_id, create=True))
+        else:
+            return None
+
+        self._indexes[chat_id] = index
+        return index
+
+    def _upgrade_legacy_log(self, chat_id, aes_key):
+        """Rewrite a single-blob chat log as records and index it
+
+        The blob is memory-mapped and decrypted incrementally, and each
+        message is re-encrypted as a record as soon as it is parsed, so the
+        upgrade never holds the whole log in memory. A log that doesn't
+        decrypt and parse completely raises ValueError and is left as it is.
+        """
+        entries = []
+
+        def payloads():
+            # The mapping is closed once this is exhausted, before the new
+            # log replaces the old one
+            with self.user_manager.open_chat_log(chat_id) as encrypted_log:
+                for message in self.crypto_manager.iter_decrypt_chat_log(encrypted_log, aes_key):
+                    entries.append((parse_timestamp(message['timestamp']), message['username']))
+                    yield self.crypto_manager.encrypt_message(json.dumps(message), aes_key)
+
+        spans = self.user_manager.write_chat_records(chat_id, payloads())
+        return ChatIndex.create(self._index_file(chat_id, create=True), [
+            (offset, length, timestamp, sender)
+            for (offset, length), (timestamp, sender) in zip(spans, entries)
+        ])
+
+    def append_message(self, chat_id, message, aes_key):
+        """Encrypt and append a message, returning its sequence number"""
+        # Encrypt outside the lock so concurrent senders only queue for the I/O
+        payload = self.crypto_manager.encrypt_message(json.dumps(message), aes_key)
+        with self._chat_lock(chat_id):
+            index = self._load_index(chat_id, aes_key)
+            if index is None:
+                index = self._indexes[chat_id] = ChatIndex(self._index_file(chat_id, create=True))
+            offset = self.user_manager.append_chat_record(chat_id, payload)
+            return index.append(offset, len(payload), parse_timestamp(message['timestamp']),
+                                message['username'])
+
+    def unload(self, chat_id):
+        """Drop a chat's index from memory; it is reloaded on next use"""
+        with self._chat_lock(chat_id):
+            self._indexes.pop(chat_id, None)
+
+    def loaded_count(self):
+        """Get the number of chat indexes held in memory"""
+        return len(self._indexes)
+
+    def last_entry(self, chat_id):
+        """Get (seq, timestamp, sender) of a chat's newest message, or None"""
+        index = self._indexes.get(chat_id)
+        if index is not None:
+            return index.last_entry()
+        return ChatIndex.read_last_entry(self._index_file(chat_id))
+
+    def message_count(self, chat_id, aes_key=None):
+        """Get the number of messages in a chat"""
+        index = self.get_index(chat_id, aes_key)
+        return 0 if index is None else len(index)
+
+    def iter_messages(self, chat_id, aes_key, seqs):
+        """Read and decrypt the messages with the given sequence numbers one by one
+
+        Records are decrypted straight out of the memory-mapped log into one
+        reusable buffer, so streaming a whole chat only ever holds the
+        current message.
+        """
+        index = self.get_index(chat_id, aes_key)
+        if index is None:
+            return
+
+        if index.missing:
+            # Placeholders for corrupt index lines have no record to read
+            seqs = [seq for seq in seqs if seq not in index.missing]
+
+        buffer = bytearray()
+        payloads = self.user_manager.iter_chat_records(chat_id, (index.span(seq) for seq in seqs))
+        for seq, payload in zip(seqs, payloads):
+            message = json.loads(self.crypto_manager.decrypt_record(payload, aes_key, buffer))
+            message['seq'] = seq
+            yield message
+
+    def read_messages(self, chat_id, aes_key, seqs):
+        """Read and decrypt the messages with the given sequence numbers"""
+        return list(self.iter_messages(chat_id, aes_key, seqs))
+
+    def query(self, chat_id, aes_key, before=None, limit=None, since=None, until=None,
+              sender=None, at=None):
+        """Find a page of messages matching a history query
+
+        since/until bound the timestamps (inclusive/exclusive), before bounds
+        the sequence number (exclusive) and sender keeps one user's messages.
+        The page holds the newest `limit` matches, or with `at` the first
+        `limit` matches at or after that time (jump to date).
+
+        Returns (messages, has_more, has_newer), where has_more/has_newer say
+        whether matches exist before/after the page.
+        """
+        index = self.get_index(chat_id, aes_key)
+        if index is None:
+            return [], False, False
+
+        start, end = index.seq_range(since, until)
+        if before is not None:
+            end = max(start, min(end, before))
+
+        # Matching seqs are candidates[first:last], found by bisection
+        if sender is None:
+            candidates = range(len(index))
+            first, last = start, end
+        else:
+            candidates = index.sender_seqs.get(sender, ())
+            first, last = index.sender_seq_bounds(sender, start, end)
+
+        if at is not None:
+            page_start = bisect_left(candidates, index.seq_at(at), first, last)
+            page_end = last if limit is None else min(last, page_start + limit)
+        else:
+            page_end = last
+            page_start = first if limit is None else max(first, last - limit)
+
+        seqs = list(candidates[page_start:page_end])
+        messages = self.read_messages(chat_id, aes_key, seqs)
+        return messages, page_start > first, page_end < last
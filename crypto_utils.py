@@ -1,12 +1,136 @@
 import os
 import json
+import hashlib
 import base64
+import codecs
+import struct
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.backends import default_backend
 import secrets
 
+# Streams start with this header: magic, plaintext chunk size and the random
+# nonce prefix. Each chunk's nonce is the prefix, a 32-bit chunk counter and a
+# final-chunk flag, so dropped, reordered or truncated chunks fail to verify.
+STREAM_HEADER = struct.Struct('>8sI7s')
+STREAM_MAGIC = b'CHATSTR1'
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_MAX_CHUNK_SIZE = 16 * 1024 * 1024
+STREAM_TAG_SIZE = 16
+
+def _stream_reader(source):
+    """Get a read(size) function over a binary file-like object or an iterable of bytes
+    
+    read returns exactly size bytes, or fewer only at the end of the source.
+    """
+    if hasattr(source, 'read'):
+        def read(size):
+            data = source.read(size)
+            # Pipes and sockets can return short reads before the end
+            while data and len(data) < size:
+                more = source.read(size - len(data))
+                if not more:
+                    break
+                data += more
+            return data
+        return read
+    
+    pieces = iter(source)
+    current = memoryview(b'')
+    position = 0
+    def read(size):
+        nonlocal current, position
+        parts = []
+        needed = size
+        while needed:
+            if position >= len(current):
+                piece = next(pieces, None)
+                if piece is None:
+                    break
+                current, position = memoryview(piece), 0
+                continue
+            part = current[position:position + needed]
+            parts.append(part)
+            position += len(part)
+            needed -= len(part)
+        # Copy, since callers may reuse the buffers they yielded
+        return b''.join(parts)
+    return read
+
+def _stream_nonce(prefix, counter, final):
+    """Build the nonce of chunk number counter"""
+    if counter > 0xFFFFFFFF:
+        raise ValueError("Stream has too many chunks")
+    return prefix + counter.to_bytes(4, 'big') + (b'\x01' if final else b'\x00')
+
+def _padding_length(plaintext, length):
+    """Get the PKCS#7 padding length at the end of plaintext[:length]
+
+    Raises ValueError for invalid padding, which is what decrypting with the
+    wrong key or corrupt data usually produces.
+    """
+    padding_length = plaintext[length - 1] if length else 0
+    if not 1 <= padding_length <= 16 or padding_length > length or \
+            any(byte != padding_length for byte in plaintext[length - padding_length:length]):
+        raise ValueError("Invalid padding")
+    return padding_length
+
+class JsonArrayStream:
+    """Incremental parser for a JSON array of objects fed in text pieces"""
+    
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.text = ''
+        self.started = False
+        self.finished = False
+    
+    def feed(self, text):
+        """Add text and return the array items that are now complete"""
+        self.text += text
+        items = []
+        position = 0
+        length = len(self.text)
+        while not self.finished:
+            # Skip whitespace and separators between items
+            while position < length and self.text[position] in ' \t\r\n,':
+                position += 1
+            if position >= length:
+                break
+            
+            if not self.started:
+                if self.text[position] != '[':
+                    raise ValueError('Chat log is not a JSON array')
+                self.started = True
+                position += 1
+                continue
+            
+            if self.text[position] == ']':
+                self.finished = True
+                position += 1
+                break
+            
+            try:
+                item, end = self.decoder.raw_decode(self.text, position)
+            except json.JSONDecodeError:
+                # The item continues in the next piece of text
+                break
+            if end >= length:
+                # A value at the very end may still be incomplete (e.g. a number)
+                break
+            items.append(item)
+            position = end
+        
+        self.text = self.text[position:]
+        return items
+    
+    def close(self):
+        """Check that the input ended right after the array was closed"""
+        if not self.finished or self.text.strip():
+            raise ValueError('Chat log is truncated or has trailing data')
+
 class CryptoManager:
     """Handles RSA and AES encryption/decryption operations"""
     
@@ -38,6 +162,14 @@ class CryptoManager:
             backend=self.backend
         )
     
+    def public_key_fingerprint(self, pem_string):
+        """Get the SHA-256 of a public key's DER encoding, in hex"""
+        der = self.deserialize_public_key(pem_string).public_bytes(
+            encoding=serialization.Encoding.DER,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        return hashlib.sha256(der).hexdigest()
+    
     def serialize_private_key(self, private_key):
         """Serialize private key to PEM format"""
         pem = private_key.private_bytes(
@@ -117,11 +249,136 @@ class CryptoManager:
         padded_message = decryptor.update(encrypted_message) + decryptor.finalize()
         
         # Remove padding
-        padding_length = padded_message[-1]
+        padding_length = _padding_length(padded_message, len(padded_message))
         message_bytes = padded_message[:-padding_length]
         
         return message_bytes.decode('utf-8')
     
+    def decrypt_record(self, encrypted_data, aes_key, buffer):
+        """Decrypt a message from any bytes-like object into a reusable buffer
+        
+        Unlike decrypt_message, the IV and ciphertext are not copied out of
+        encrypted_data (which can be a memoryview into a memory-mapped log),
+        and the plaintext is decrypted into buffer, a bytearray that is grown
+        as needed and can be passed again for the next record.
+        """
+        with memoryview(encrypted_data) as view:
+            iv = bytes(view[:16])
+            with view[16:] as encrypted_message:
+                needed = len(encrypted_message) + 15
+                if len(buffer) < needed:
+                    buffer.extend(bytes(needed - len(buffer)))
+                
+                cipher = Cipher(algorithms.AES(aes_key), modes.CBC(iv), backend=self.backend)
+                decryptor = cipher.decryptor()
+                length = decryptor.update_into(encrypted_message, buffer)
+                decryptor.finalize()
+        
+        # Remove padding while decoding straight from the buffer
+        with memoryview(buffer) as plaintext:
+            padding_length = _padding_length(plaintext, length)
+            with plaintext[:length - padding_length] as message_bytes:
+                return str(message_bytes, 'utf-8')
+    
+    def iter_decrypt_chat_log(self, encrypted_data, aes_key, chunk_size=1 << 20):
+        """Decrypt a single-blob chat log incrementally, yielding its messages
+        
+        encrypted_data can be any bytes-like object, such as a memory-mapped
+        file. It is decrypted chunk_size bytes at a time into one reusable
+        buffer and the JSON array is parsed as the plaintext comes out, so
+        memory use is bounded by the chunk size and the largest message
+        rather than the size of the log. Raises ValueError for a log that is
+        truncated, malformed or decrypted with the wrong key, after yielding
+        the messages before the problem.
+        """
+        chunk_size -= chunk_size % 16
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        parser = JsonArrayStream()
+        buffer = bytearray(chunk_size + 16)
+        
+        with memoryview(encrypted_data) as view:
+            cipher = Cipher(algorithms.AES(aes_key), modes.CBC(bytes(view[:16])), backend=self.backend)
+            decryptor = cipher.decryptor()
+            
+            total = len(view)
+            position = 16
+            while position < total:
+                end = min(position + chunk_size, total)
+                with view[position:end] as chunk:
+                    length = decryptor.update_into(chunk, buffer)
+                position = end
+                
+                # Padding is in the final block, which is always in the last chunk
+                if position >= total:
+                    length -= _padding_length(buffer, length)
+                
+                with memoryview(buffer) as plaintext:
+                    with plaintext[:length] as decrypted:
+                        text = decoder.decode(decrypted, final=position >= total)
+                yield from parser.feed(text)
+            decryptor.finalize()
+        # A truncated log must fail rather than pass as a shorter one
+        parser.close()
+    
+    def encrypt_stream(self, source, aes_key, chunk_size=STREAM_CHUNK_SIZE):
+        """Encrypt a binary file-like object or iterable of bytes chunk by chunk
+        
+        Yields the stream header and then one AES-GCM encrypted chunk per
+        chunk_size bytes of input, so large inputs can be piped to a file or
+        socket without being buffered.
+        """
+        if not 0 < chunk_size <= STREAM_MAX_CHUNK_SIZE:
+            raise ValueError("Invalid stream chunk size")
+        
+        prefix = secrets.token_bytes(7)
+        header = STREAM_HEADER.pack(STREAM_MAGIC, chunk_size, prefix)
+        aesgcm = AESGCM(aes_key)
+        read = _stream_reader(source)
+        yield header
+        
+        # Read one chunk ahead to know which chunk is the final one
+        counter = 0
+        chunk = read(chunk_size)
+        while True:
+            following = read(chunk_size) if len(chunk) == chunk_size else b''
+            final = not following
+            yield aesgcm.encrypt(_stream_nonce(prefix, counter, final), chunk, header)
+            if final:
+                return
+            chunk = following
+            counter += 1
+    
+    def decrypt_stream(self, source, aes_key):
+        """Decrypt the output of encrypt_stream, yielding plaintext chunks
+        
+        Each chunk is authenticated before it is yielded. Raises ValueError
+        if the stream was modified, reordered, truncated or extended.
+        """
+        read = _stream_reader(source)
+        header = read(STREAM_HEADER.size)
+        if len(header) < STREAM_HEADER.size:
+            raise ValueError("Stream header is truncated")
+        magic, chunk_size, prefix = STREAM_HEADER.unpack(header)
+        if magic != STREAM_MAGIC or not 0 < chunk_size <= STREAM_MAX_CHUNK_SIZE:
+            raise ValueError("Not an encrypted stream")
+        
+        aesgcm = AESGCM(aes_key)
+        encrypted_size = chunk_size + STREAM_TAG_SIZE
+        counter = 0
+        chunk = read(encrypted_size)
+        while True:
+            following = read(encrypted_size) if len(chunk) == encrypted_size else b''
+            final = not following
+            try:
+                plaintext = aesgcm.decrypt(_stream_nonce(prefix, counter, final), chunk, header)
+            except InvalidTag:
+                raise ValueError("Stream failed authentication (modified or truncated)") from None
+            yield plaintext
+            if final:
+                return
+            chunk = following
+            counter += 1
+    
     def encrypt_chat_log(self, chat_data, aes_key):
         """Encrypt chat log data"""
         json_data = json.dumps(chat_data)
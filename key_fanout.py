@@ -0,0 +1,63 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Deserialized public keys kept in memory at most
+PUBLIC_KEY_CACHE_SIZE = 1024
+
+class KeyFanout:
+    """Wraps chat AES keys for every participant on a worker pool"""
+
+    def __init__(self, user_manager, crypto_manager, max_workers=8, cache_size=PUBLIC_KEY_CACHE_SIZE):
+        self.user_manager = user_manager
+        self.crypto_manager = crypto_manager
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='key-fanout')
+
+        # Recently used deserialized public keys, so repeated chats don't
+        # re-parse PEM data: {username: public_key}
+        self.cache_size = cache_size
+        self._public_keys = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def _get_public_key(self, username):
+        """Get a participant's deserialized public key"""
+        with self._cache_lock:
+            public_key = self._public_keys.get(username)
+            if public_key is not None:
+                self._public_keys.move_to_end(username)
+                return public_key
+
+        public_key_pem = self.user_manager.get_user_public_key(username)
+        if public_key_pem is None:
+            return None
+        public_key = self.crypto_manager.deserialize_public_key(public_key_pem)
+        with self._cache_lock:
+            self._public_keys[username] = public_key
+            self._public_keys.move_to_end(username)
+            while len(self._public_keys) > self.cache_size:
+                self._public_keys.popitem(last=False)
+        return public_key
+
+    def _wrap_for_participant(self, chat_id, aes_key, username, pending):
+        """Wrap the chat key for one participant and store it in their key ring"""
+        public_key = self._get_public_key(username)
+        if public_key is None:
+            return username, None
+
+        wrapped_key = self.crypto_manager.encrypt_aes_key(aes_key, public_key)
+        self.user_manager.store_wrapped_key(username, chat_id, wrapped_key, pending)
+        return username, wrapped_key
+
+    def fanout(self, chat_id, aes_key, participants, online_users=()):
+        """Wrap and store the chat key for all participants in parallel
+
+        Participants not in online_users are marked pending so the key is
+        delivered the next time they log in. Returns {username: wrapped_key}.
+        """
+        online_users = set(online_users)
+        results = self.executor.map(
+            lambda username: self._wrap_for_participant(
+                chat_id, aes_key, username, username not in online_users),
+            participants
+        )
+        return {username: wrapped_key for username, wrapped_key in results if wrapped_key is not None}
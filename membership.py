@@ -0,0 +1,242 @@
+import os
+import json
+import time
+import threading
+
+# Chats and users hash onto this many locks serializing changes to their
+# metadata and journals
+CHAT_LOCK_STRIPES = 256
+USER_LOCK_STRIPES = 64
+
+# Chats and chat lists unused for this long are dropped by evict_idle, the
+# same as idle chat keys; they are reloaded from disk on next use
+MEMBERSHIP_IDLE_TIMEOUT = 30 * 60  # seconds
+
+class MembershipRegistry:
+    """Who belongs to which chat, by chat and by user
+
+    A chat's members are stored in its metadata file under data/chats, and
+    each user has an append-only journal under data/inbox of the chats they
+    joined and left. Both are loaded on first use and kept in memory as
+    sets, so checking membership is a dict and a set lookup. Changes write
+    the one chat's metadata and append one line per affected user, holding
+    only the chat's and that user's lock stripes; the registry lock is held
+    just to swap the in-memory entries. Entries unused for a while are
+    dropped by evict_idle, so memory follows the active chats and users
+    rather than every one ever touched.
+    """
+
+    def __init__(self, user_manager):
+        self.user_manager = user_manager
+        self.chats_dir = os.path.join(user_manager.data_dir, "chats")
+        self.inbox_dir = os.path.join(user_manager.data_dir, "inbox")
+        os.makedirs(self.chats_dir, exist_ok=True)
+        os.makedirs(self.inbox_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._chat_locks = [threading.Lock() for _ in range(CHAT_LOCK_STRIPES)]
+        self._user_locks = [threading.Lock() for _ in range(USER_LOCK_STRIPES)]
+        self._chats = {}       # {chat_id: chat metadata, with 'participants' in join order}
+        self._members = {}     # {chat_id: frozenset of usernames}
+        self._user_chats = {}  # {username: {chat_id: None} in join order}
+        # Last use of each loaded entry, written without the lock on reads
+        self._chat_used = {}  # {chat_id: monotonic time}
+        self._user_used = {}  # {username: monotonic time}
+
+    def _chat_lock(self, chat_id):
+        """Get the lock stripe serializing changes to a chat"""
+        return self._chat_locks[hash(chat_id) % len(self._chat_locks)]
+
+    def _user_lock(self, username):
+        """Get the lock stripe serializing reads and appends of a user's journal"""
+        return self._user_locks[hash(username) % len(self._user_locks)]
+
+    def _chat_file(self, chat_id, create=False):
+        return self.user_manager.chat_data_file(self.chats_dir, chat_id, ".json", create)
+
+    def _journal_file(self, username):
+        return self.user_manager.user_data_file(self.inbox_dir, username, ".jsonl")
+
+    def _write_chat(self, chat):
+        """Atomically write a chat's metadata, so readers never see a partial file"""
+        chat_file = self._chat_file(chat['chat_id'], create=True)
+        tmp_file = chat_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(chat, f)
+        os.replace(tmp_file, chat_file)
+
+    def _append_journal(self, username, chat_id, removed=False):
+        """Append a change to a user's journal and their loaded chat list"""
+        entry = {'chat_id': chat_id, 'removed': True} if removed else {'chat_id': chat_id}
+        # Under the user's stripe, so a load either reads the line or sees the update
+        with self._user_lock(username):
+            with open(self._journal_file(username), 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+            with self._lock:
+                chats = self._user_chats.get(username)
+                if chats is not None:
+                    if removed:
+                        chats.pop(chat_id, None)
+                    else:
+                        chats[chat_id] = None
+
+    def _load_chat(self, chat_id):
+        """Get a chat's metadata, loading it on first use, or None for unknown chats"""
+        self._chat_used[chat_id] = time.monotonic()
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat_file = self._chat_file(chat_id)
+            if not os.path.exists(chat_file):
+                return None
+            with open(chat_file, 'r') as f:
+                chat = json.load(f)
+            with self._lock:
+                # A change made while this was read is newer, so keep it
+                chat = self._chats.setdefault(chat_id, chat)
+                self._members.setdefault(chat_id, frozenset(chat['participants']))
+        return chat
+
+    def _load_user_chats(self, username):
+        """Get the chats a user belongs to, replaying their journal on first use"""
+        self._user_used[username] = time.monotonic()
+        chats = self._user_chats.get(username)
+        if chats is None:
+            with self._user_lock(username):
+                chats = self._user_chats.get(username)
+                if chats is not None:
+                    return chats
+                chats = {}
+                journal_file = self._journal_file(username)
+                if os.path.exists(journal_file):
+                    with open(journal_file, 'r') as f:
+                        for line in f:
+                            try:
+                                entry = json.loads(line)
+                                chat_id = entry['chat_id']
+                            except (json.JSONDecodeError, KeyError, TypeError):
+                                continue
+                            if entry.get('removed'):
+                                chats.pop(chat_id, None)
+                            else:
+                                chats[chat_id] = None
+                with self._lock:
+                    self._user_chats[username] = chats
+        return chats
+
+    def get_chat(self, chat_id):
+        """Get a chat's stored metadata, or None for unknown chats"""
+        return self._load_chat(chat_id)
+
+    def get_members(self, chat_id):
+        """Get a chat's members as a tuple, in the order they joined"""
+        chat = self._load_chat(chat_id)
+        return tuple(chat['participants']) if chat else ()
+
+    def is_member(self, chat_id, username):
+        """Check if a user belongs to a chat"""
+        self._chat_used[chat_id] = time.monotonic()
+        members = self._members.get(chat_id)
+        if members is None:
+            chat = self._load_chat(chat_id)
+            if chat is None:
+                return False
+            members = self._members.get(chat_id) or frozenset(chat['participants'])
+        return username in members
+
+    def get_user_chats(self, username):
+        """Get the ids of the chats a user belongs to, in the order they joined"""
+        chats = self._load_user_chats(username)
+        with self._lock:
+            return list(chats)
+
+    def create_chat(self, chat_id, participants, timestamp, created_by=None):
+        """Store a new chat and add it to every participant's journal"""
+        chat = {'chat_id': chat_id, 'participants': list(dict.fromkeys(participants)),
+                'created_at': timestamp, 'created_by': created_by}
+        with self._chat_lock(chat_id):
+            self._write_chat(chat)
+            with self._lock:
+                self._chats[chat_id] = chat
+                self._members[chat_id] = frozenset(chat['participants'])
+                self._chat_used[chat_id] = time.monotonic()
+            for username in chat['participants']:
+                self._append_journal(username, chat_id)
+        return chat
+
+    def add_member(self, chat_id, username):
+        """Add a user to a chat
+
+        Returns (success, message).
+        """
+        chat = self._load_chat(chat_id)
+        if chat is None:
+            return False, "Chat not found"
+        with self._chat_lock(chat_id):
+            chat = self._load_chat(chat_id)
+            if username in chat['participants']:
+                return False, f"{username} is already a member"
+            chat = dict(chat, participants=chat['participants'] + [username])
+            self._write_chat(chat)
+            with self._lock:
+                self._chats[chat_id] = chat
+                self._members[chat_id] = frozenset(chat['participants'])
+                self._chat_used[chat_id] = time.monotonic()
+            self._append_journal(username, chat_id)
+        return True, f"Added {username}"
+
+    def remove_member(self, chat_id, username):
+        """Remove a user from a chat and drop the chat's key from their key ring
+
+        Returns (success, message).
+        """
+        chat = self._load_chat(chat_id)
+        if chat is None:
+            return False, "Chat not found"
+        with self._chat_lock(chat_id):
+            chat = self._load_chat(chat_id)
+            if username not in chat['participants']:
+                return False, f"{username} is not a member"
+            chat = dict(chat, participants=[p for p in chat['participants'] if p != username])
+            self._write_chat(chat)
+            with self._lock:
+                self._chats[chat_id] = chat
+                self._members[chat_id] = frozenset(chat['participants'])
+                self._chat_used[chat_id] = time.monotonic()
+            self._append_journal(username, chat_id, removed=True)
+            self.user_manager.remove_wrapped_key(username, chat_id)
+        return True, f"Removed {username}"
+
+    def unload_chat(self, chat_id):
+        """Drop a chat's members from memory"""
+        with self._lock:
+            self._chats.pop(chat_id, None)
+            self._members.pop(chat_id, None)
+            self._chat_used.pop(chat_id, None)
+
+    def unload_user(self, username):
+        """Drop a user's chat list from memory"""
+        with self._lock:
+            self._user_chats.pop(username, None)
+            self._user_used.pop(username, None)
+
+    def evict_idle(self, idle_timeout=MEMBERSHIP_IDLE_TIMEOUT, now=None):
+        """Drop chats and chat lists unused for idle_timeout seconds
+
+        Returns the number of (chats, users) dropped.
+        """
+        cutoff = (time.monotonic() if now is None else now) - idle_timeout
+        with self._lock:
+            idle_chats = [chat_id for chat_id, used in list(self._chat_used.items()) if used <= cutoff]
+            for chat_id in idle_chats:
+                self._chats.pop(chat_id, None)
+                self._members.pop(chat_id, None)
+                self._chat_used.pop(chat_id, None)
+            idle_users = [username for username, used in list(self._user_used.items()) if used <= cutoff]
+            for username in idle_users:
+                self._user_chats.pop(username, None)
+                self._user_used.pop(username, None)
+        return len(idle_chats), len(idle_users)
+
+    def loaded_count(self):
+        """Get the number of chats and users held in memory"""
+        return len(self._members), len(self._user_chats)
@@ -0,0 +1,86 @@
+import os
+import tracemalloc
+
+# Frames kept per allocation when tracing, enough to see past library internals
+TRACEMALLOC_FRAMES = 8
+
+# Allocations are attributed to the innermost frame in one of this app's
+# modules or in one of these packages; anything else is 'other'
+MODULE_CATEGORIES = {
+    'session_state.py': 'sessions and keys',
+    'rate_limiter.py': 'rate limiter',
+    'chat_index.py': 'chat indexes',
+    'chat_store.py': 'chat indexes',
+    'chat_inbox.py': 'inboxes',
+    'membership.py': 'inboxes',
+    'read_state.py': 'read state',
+    'user_manager.py': 'users',
+    'user_directory.py': 'users',
+    'app.py': 'app',
+}
+PACKAGE_CATEGORIES = {
+    'socketio': 'socket.io',
+    'engineio': 'socket.io',
+    'flask_socketio': 'socket.io',
+    'flask': 'http',
+    'werkzeug': 'http',
+    'jinja2': 'http',
+}
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def start_tracing():
+    """Start tracing allocations if the CHAT_TRACEMALLOC environment variable is set
+
+    Tracing roughly doubles allocation cost, so it is off by default.
+    """
+    if os.environ.get('CHAT_TRACEMALLOC') and not tracemalloc.is_tracing():
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+
+def categorize(traceback):
+    """Get the category of an allocation from its traceback"""
+    for frame in reversed(traceback):
+        directory, name = os.path.split(frame.filename)
+        if directory == APP_DIR:
+            if name in MODULE_CATEGORIES:
+                return MODULE_CATEGORIES[name]
+            continue
+        parts = directory.split(os.sep)
+        for packages_dir in ('site-packages', 'dist-packages'):
+            if packages_dir in parts:
+                package = (parts + [''])[parts.index(packages_dir) + 1]
+                if package in PACKAGE_CATEGORIES:
+                    return PACKAGE_CATEGORIES[package]
+    return 'other'
+
+def memory_report(snapshot, top=10):
+    """Summarize a tracemalloc snapshot by category and by allocating line
+
+    Returns {'total': bytes, 'categories': [{'category', 'bytes', 'blocks'}],
+    'top': [{'location', 'bytes', 'blocks'}]}, both lists largest first.
+    """
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ])
+
+    categories = {}
+    total = 0
+    for stat in snapshot.statistics('traceback'):
+        name = categorize(stat.traceback)
+        category = categories.setdefault(name, {'category': name, 'bytes': 0, 'blocks': 0})
+        category['bytes'] += stat.size
+        category['blocks'] += stat.count
+        total += stat.size
+
+    lines = [{
+        'location': f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+        'bytes': stat.size,
+        'blocks': stat.count
+    } for stat in snapshot.statistics('lineno')[:top]]
+
+    return {
+        'total': total,
+        'categories': sorted(categories.values(), key=lambda category: -category['bytes']),
+        'top': lines
+    }
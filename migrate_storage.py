@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""
+Move per-chat data files from the old flat layout into hashed subdirectories
+
+Usage: python migrate_storage.py [data_dir] [--pause SECONDS]
+Safe to run while the server is up; the server picks up any file it needs
+before the migration gets to it.
+"""
+
+import sys
+import os
+import time
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from storage_layout import migrate_directory
+
+# Data directories holding one file per chat
+CHAT_DATA_DIRS = ["chat_logs", "chat_index", "chats"]
+
+def main():
+    """Migrate every per-chat data directory"""
+    args = sys.argv[1:]
+    pause = 0.0
+    if "--pause" in args:
+        i = args.index("--pause")
+        pause = float(args[i + 1])
+        del args[i:i + 2]
+    data_dir = args[0] if args else "data"
+
+    if not os.path.isdir(data_dir):
+        print(f"Data directory not found: {data_dir}")
+        return False
+
+    for name in CHAT_DATA_DIRS:
+        start = time.perf_counter()
+        moved = migrate_directory(os.path.join(data_dir, name), pause=pause)
+        print(f"{name}: moved {moved} files in {time.perf_counter() - start:.1f} s")
+    return True
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
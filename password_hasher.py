@@ -0,0 +1,107 @@
+import hmac
+import hashlib
+import secrets
+
+SALT_SIZE = 16  # bytes
+HASH_SIZE = 32  # bytes
+
+def _pbkdf2_sha256(password, salt, iterations):
+    return hashlib.pbkdf2_hmac('sha256', password, salt, iterations, HASH_SIZE)
+
+def _scrypt(password, salt, n, r, p):
+    # The default 32 MiB limit is too low for n >= 2**15; allow what the
+    # parameters need (128 * r * (n + p + 2) bytes) plus some headroom
+    return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p,
+                          maxmem=128 * r * (n + p + 2) + (1 << 20), dklen=HASH_SIZE)
+
+# Key derivation functions by the name stored in hashes, with the number of
+# integer cost parameters each takes
+KDFS = {
+    'pbkdf2-sha256': (_pbkdf2_sha256, 1),  # iterations
+    'scrypt': (_scrypt, 3),                # n, r, p
+}
+
+# Named choices of KDF and cost. Roughly, on one core: pbkdf2 ~40 ms,
+# pbkdf2-strong ~240 ms, scrypt ~60 ms and 16 MiB, scrypt-strong ~550 ms and
+# 128 MiB per login (python benchmarks.py password_hashing)
+PASSWORD_PROFILES = {
+    'pbkdf2': ('pbkdf2-sha256', (100000,)),
+    'pbkdf2-strong': ('pbkdf2-sha256', (600000,)),
+    'scrypt': ('scrypt', (16384, 8, 1)),
+    'scrypt-strong': ('scrypt', (131072, 8, 1)),
+}
+DEFAULT_PASSWORD_PROFILE = 'scrypt'
+
+# Hashes from before the format recorded its parameters: 32 hex chars of
+# salt, used as text, then the hex PBKDF2-SHA256 digest at 100,000 iterations
+LEGACY_ITERATIONS = 100000
+LEGACY_SALT_LENGTH = 32
+
+class PasswordHasher:
+    """Hashes passwords with a cost profile and verifies hashes of any profile
+
+    Hashes are stored as "$kdf$param,param$salt$hash", with the salt and
+    hash in hex, so each one can be checked with the parameters it was made
+    with after the profile changes. Hashes made with other parameters, or in
+    the legacy salt+hex format, still verify and are reported by
+    needs_rehash so they can be upgraded at the next login.
+    """
+
+    def __init__(self, profile=DEFAULT_PASSWORD_PROFILE):
+        if profile not in PASSWORD_PROFILES:
+            raise ValueError(f"Unknown password profile: {profile} "
+                             f"(available: {', '.join(PASSWORD_PROFILES)})")
+        self.profile = profile
+        self.kdf, self.params = PASSWORD_PROFILES[profile]
+
+    def hash(self, password):
+        """Hash a password with the current profile and a random salt"""
+        salt = secrets.token_bytes(SALT_SIZE)
+        derive, _ = KDFS[self.kdf]
+        password_hash = derive(password.encode('utf-8'), salt, *self.params)
+        params = ','.join(str(param) for param in self.params)
+        return f"${self.kdf}${params}${salt.hex()}${password_hash.hex()}"
+
+    def _parse(self, stored_hash):
+        """Split a stored hash into (kdf, params, salt, hash), or None if malformed"""
+        if not stored_hash.startswith('$'):
+            if len(stored_hash) != LEGACY_SALT_LENGTH + HASH_SIZE * 2:
+                return None
+            try:
+                password_hash = bytes.fromhex(stored_hash[LEGACY_SALT_LENGTH:])
+            except ValueError:
+                return None
+            salt = stored_hash[:LEGACY_SALT_LENGTH].encode('utf-8')
+            return 'pbkdf2-sha256', (LEGACY_ITERATIONS,), salt, password_hash
+
+        parts = stored_hash.split('$')
+        if len(parts) != 5 or parts[1] not in KDFS:
+            return None
+        try:
+            params = tuple(int(param) for param in parts[2].split(','))
+            salt = bytes.fromhex(parts[3])
+            password_hash = bytes.fromhex(parts[4])
+        except ValueError:
+            return None
+        if len(params) != KDFS[parts[1]][1]:
+            return None
+        return parts[1], params, salt, password_hash
+
+    def verify(self, password, stored_hash):
+        """Check a password against a stored hash of any supported format"""
+        parsed = self._parse(stored_hash)
+        if parsed is None:
+            return False
+        kdf, params, salt, password_hash = parsed
+        derive, _ = KDFS[kdf]
+        try:
+            derived = derive(password.encode('utf-8'), salt, *params)
+        except ValueError:
+            # Parameters the KDF rejects, e.g. an scrypt n that isn't a power of 2
+            return False
+        return hmac.compare_digest(derived, password_hash)
+
+    def needs_rehash(self, stored_hash):
+        """Check if a stored hash was made with other than the current profile"""
+        parsed = self._parse(stored_hash)
+        return parsed is None or stored_hash[0] != '$' or parsed[:2] != (self.kdf, self.params)
@@ -0,0 +1,261 @@
+import os
+import sys
+import time
+import random
+import pstats
+import cProfile
+import threading
+from collections import Counter
+from datetime import datetime
+
+# Default length of a profiling window, e.g. one started by a signal
+PROFILE_WINDOW = 30.0  # seconds
+SAMPLE_INTERVAL = 0.005  # seconds
+MAX_PROFILE_WINDOW = 600.0  # seconds
+# How long finishing waits for profiled calls still running
+FINISH_TIMEOUT = 10.0  # seconds
+# Deeper stacks are cut off at this many frames from the root
+MAX_STACK_DEPTH = 128
+
+def _green_threads():
+    """Check if eventlet has monkey-patched threads into greenlets"""
+    patcher = sys.modules.get('eventlet.patcher')
+    return patcher is not None and patcher.is_monkey_patched('thread')
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def _function_label(function):
+    filename, lineno, name = function
+    if filename == '~':
+        # Built-in functions have no file
+        return name
+    return f"{name} ({os.path.basename(filename)}:{lineno})"
+
+def collapse_pstats(stats):
+    """Turn cProfile stats into collapsed stacks weighted by microseconds
+
+    cProfile only keeps caller/callee pairs, so a function's time is split
+    between the paths leading to it in proportion to the time each caller
+    spent in it. Recursive calls are cut at their first repeat.
+    """
+    children = {}
+    for function, (_, _, _, _, callers) in stats.items():
+        for caller, caller_stats in callers.items():
+            children.setdefault(caller, []).append((function, caller_stats[3]))
+    roots = [function for function, (_, _, _, _, callers) in stats.items() if not callers]
+
+    stacks = Counter()
+
+    def walk(function, path, scale):
+        _, _, total_self, total, _ = stats[function]
+        path = path + (_function_label(function),)
+        stacks[';'.join(path)] += total_self * scale
+        if len(path) >= MAX_STACK_DEPTH:
+            return
+        for child, time_in_child in children.get(function, ()):
+            child_total = stats[child][3]
+            if child_total and _function_label(child) not in path:
+                walk(child, path, scale * min(1.0, time_in_child / child_total))
+
+    for root in roots:
+        walk(root, (), 1.0)
+    return Counter({stack: int(seconds * 1e6) for stack, seconds in stacks.items() if seconds >= 1e-6})
+
+class Profiler:
+    """On-demand profiling of the running server
+
+    Two modes, each running for a window and then writing its results to
+    output_dir as collapsed stacks ("frame;frame;frame count" lines, ready
+    for flamegraph.pl or speedscope):
+
+    - Stack sampling: a background thread records the stack of every other
+      thread at a fixed interval.
+    - Event profiling: a fraction of the chosen Socket.IO events run under
+      cProfile, aggregated per event and also saved as .prof files.
+
+    When neither is running, the only cost is should_profile's check of an
+    empty dict per event.
+
+    Both work per OS thread. Under eventlet or gevent, handlers are
+    greenlets sharing one thread: a stack sample shows whichever greenlet
+    was running, and cProfile would charge every handler that ran while a
+    profiled call was waiting to that call. Event profiling is therefore
+    only offered with async_mode 'threading' and no eventlet monkey
+    patching; stack sampling still works, attributing time to the running
+    greenlet.
+    """
+
+    def __init__(self, output_dir, async_mode='threading'):
+        self.output_dir = output_dir
+        self.async_mode = async_mode
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._sampling_until = 0.0
+        self._event_fractions = {}  # {event: fraction of calls to profile}
+        self._events_until = 0.0
+        self._event_profiles = {}   # {(event, thread id): cProfile.Profile}
+        self._event_counts = Counter()
+        self._in_flight = 0         # Profiled calls still running
+
+    def _output_file(self, name, extension):
+        os.makedirs(self.output_dir, exist_ok=True)
+        timestamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        return os.path.join(self.output_dir, f"{name}-{timestamp}{extension}")
+
+    def _write_collapsed(self, name, stacks):
+        path = self._output_file(name, '.collapsed')
+        with open(path, 'w') as f:
+            for stack, count in sorted(stacks.items()):
+                f.write(f"{stack} {count}\n")
+        return path
+
+    def status(self):
+        """Get what is running and the profiles written so far"""
+        now = time.monotonic()
+        files = sorted(os.listdir(self.output_dir)) if os.path.isdir(self.output_dir) else []
+        return {
+            'sampling': self._sampler is not None,
+            'sampling_remaining': round(max(0.0, self._sampling_until - now), 1) if self._sampler else 0,
+            'events': dict(self._event_fractions),
+            'events_remaining': round(max(0.0, self._events_until - now), 1) if self._event_fractions else 0,
+            'files': files
+        }
+
+    def start_sampling(self, duration=PROFILE_WINDOW, interval=SAMPLE_INTERVAL):
+        """Sample every thread's stack for duration seconds
+
+        Returns (success, message).
+        """
+        if not 0 < duration <= MAX_PROFILE_WINDOW or not 0.001 <= interval <= 1:
+            return False, "Invalid duration or interval"
+        with self._lock:
+            if self._sampler is not None:
+                return False, "Already sampling"
+            self._sampling_until = time.monotonic() + duration
+            self._sampler = threading.Thread(target=self._sample, args=(interval,),
+                                             name="profiler-sampler", daemon=True)
+            self._sampler.start()
+        return True, f"Sampling for {duration:g} s"
+
+    def _sample(self, interval):
+        """Collect stack samples until the window ends, then write them out"""
+        me = threading.get_ident()
+        stacks = Counter()
+        samples = 0
+        while time.monotonic() < self._sampling_until:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                path = []
+                while frame is not None:
+                    path.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                path.append(names.get(ident, f"thread-{ident}"))
+                stacks[';'.join(reversed(path[-MAX_STACK_DEPTH:]))] += 1
+            samples += 1
+            time.sleep(interval)
+
+        path = self._write_collapsed('samples', stacks)
+        print(f"Profiler: wrote {samples} samples to {path}")
+        with self._lock:
+            self._sampler = None
+
+    def stop_sampling(self):
+        """End the sampling window early; the samples so far are still written"""
+        self._sampling_until = 0.0
+
+    def profile_events(self, fractions, duration=PROFILE_WINDOW):
+        """Run cProfile on a fraction of calls to some events for duration seconds
+
+        fractions maps event names to the fraction of their calls to profile.
+        Returns (success, message).
+        """
+        if not 0 < duration <= MAX_PROFILE_WINDOW or not fractions or \
+                not all(isinstance(f, (int, float)) and 0 < f <= 1 for f in fractions.values()):
+            return False, "Invalid events, fractions or duration"
+        if self.async_mode != 'threading' or _green_threads():
+            return False, "Event profiling needs the threading async mode; use stack sampling"
+        with self._lock:
+            if self._event_fractions:
+                return False, "Already profiling events"
+            self._event_profiles = {}
+            self._event_counts = Counter()
+            self._events_until = time.monotonic() + duration
+            self._event_fractions = dict(fractions)
+        # Write the results on time even if the events stop arriving
+        timer = threading.Timer(duration, self._finish_events_when_due)
+        timer.daemon = True
+        timer.start()
+        return True, f"Profiling {', '.join(fractions)} for {duration:g} s"
+
+    def should_profile(self, event):
+        """Check if this call of an event should be profiled"""
+        fractions = self._event_fractions
+        if not fractions:
+            return False
+        if time.monotonic() >= self._events_until:
+            # The window's timer writes the results; finishing here would
+            # make this caller wait for in-flight calls and the disk
+            return False
+        fraction = fractions.get(event)
+        return fraction is not None and random.random() < fraction
+
+    def profile_call(self, event, function, *args):
+        """Call function under cProfile, adding to the event's profile
+
+        Each thread keeps one profile per event that is switched on for the
+        call, so profiling a call costs no more than cProfile itself.
+        """
+        key = (event, threading.get_ident())
+        with self._lock:
+            profile = self._event_profiles.get(key)
+            if profile is None:
+                profile = self._event_profiles[key] = cProfile.Profile()
+            self._in_flight += 1
+        profile.enable()
+        try:
+            return function(*args)
+        finally:
+            profile.disable()
+            with self._lock:
+                self._in_flight -= 1
+                self._event_counts[event] += 1
+
+    def _finish_events_when_due(self):
+        # A timer left from an earlier window must not end a later one
+        if time.monotonic() >= self._events_until - 0.05:
+            self.finish_events()
+
+    def finish_events(self):
+        """End event profiling and write each event's profile
+
+        Returns the paths written.
+        """
+        with self._lock:
+            if not self._event_fractions:
+                return []
+            self._event_fractions = {}
+        # Profiles can only be read once no call is adding to them
+        deadline = time.monotonic() + FINISH_TIMEOUT
+        while self._in_flight and time.monotonic() < deadline:
+            time.sleep(0.01)
+        with self._lock:
+            profiles, self._event_profiles = self._event_profiles, {}
+            counts = self._event_counts
+
+        event_stats = {}
+        for (event, _), profile in profiles.items():
+            if event in event_stats:
+                event_stats[event].add(profile)
+            else:
+                event_stats[event] = pstats.Stats(profile)
+
+        paths = []
+        for event, stats in event_stats.items():
+            prof_path = self._output_file(f"event-{event}", '.prof')
+            stats.dump_stats(prof_path)
+            paths += [prof_path, self._write_collapsed(f"event-{event}", collapse_pstats(stats.stats))]
+            print(f"Profiler: wrote {counts[event]} profiled {event} calls to {prof_path}")
+        return paths
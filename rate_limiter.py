@@ -0,0 +1,116 @@
+import time
+import threading
+
+class TokenBucket:
+    """Token bucket that refills continuously at a fixed rate"""
+
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, burst, now):
+        self.tokens = float(burst)
+        self.updated = now
+
+    def refill(self, rate, burst, now):
+        """Add the tokens earned since the last update"""
+        self.tokens = min(float(burst), self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+class RateLimiter:
+    """Per-session and per-user token bucket rate limiting for Socket.IO events
+
+    limits maps an event name to {'sid': (rate, burst), 'user': (rate, burst)},
+    where rate is tokens per second and burst is the bucket size. Either scope
+    may be left out. Events without an entry are not limited.
+    """
+
+    def __init__(self, limits, clock=time.monotonic):
+        self.limits = limits
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._buckets = {}  # {(scope, key, event): TokenBucket}
+        self.counters = {event: {'allowed': 0, 'throttled_sid': 0, 'throttled_user': 0}
+                         for event in limits}
+
+    def _bucket(self, scope, key, event, burst, now):
+        """Get or create the bucket for one scope of an event"""
+        bucket = self._buckets.get((scope, key, event))
+        if bucket is None:
+            bucket = TokenBucket(burst, now)
+            self._buckets[(scope, key, event)] = bucket
+        return bucket
+
+    def acquire(self, event, sid, username=None):
+        """Take a token for an event
+
+        Returns 0 when the event is allowed, otherwise the number of seconds
+        until the client may try again. A token is only taken when every
+        applicable bucket has one.
+        """
+        event_limits = self.limits.get(event)
+        if not event_limits:
+            return 0
+
+        scopes = [('sid', sid)]
+        if username is not None:
+            scopes.append(('user', username))
+
+        with self._lock:
+            now = self.clock()
+            buckets = []
+            for scope, key in scopes:
+                limit = event_limits.get(scope)
+                if limit is None:
+                    continue
+                rate, burst = limit
+                bucket = self._bucket(scope, key, event, burst, now)
+                bucket.refill(rate, burst, now)
+                if bucket.tokens < 1:
+                    self.counters[event][f'throttled_{scope}'] += 1
+                    return (1 - bucket.tokens) / rate
+                buckets.append(bucket)
+
+            for bucket in buckets:
+                bucket.tokens -= 1
+            self.counters[event]['allowed'] += 1
+            return 0
+
+    def forget_session(self, sid, username=None):
+        """Drop a closed session's buckets, and the user's buckets once refilled"""
+        with self._lock:
+            now = self.clock()
+            for event, event_limits in self.limits.items():
+                self._buckets.pop(('sid', sid, event), None)
+
+                # A full bucket behaves exactly like a missing one
+                bucket = self._buckets.get(('user', username, event))
+                if bucket is not None:
+                    rate, burst = event_limits['user']
+                    bucket.refill(rate, burst, now)
+                    if bucket.tokens >= burst:
+                        del self._buckets[('user', username, event)]
+
+    def prune(self):
+        """Drop every bucket that has refilled, returning how many were dropped"""
+        with self._lock:
+            now = self.clock()
+            full = []
+            for key, bucket in self._buckets.items():
+                scope, _, event = key
+                rate, burst = self.limits[event][scope]
+                bucket.refill(rate, burst, now)
+                if bucket.tokens >= burst:
+                    full.append(key)
+            for key in full:
+                del self._buckets[key]
+            return len(full)
+
+    def stats(self):
+        """Get the configured limits, counters and number of tracked buckets"""
+        with self._lock:
+            return {
+                'limits': {event: {scope: {'rate': rate, 'burst': burst}
+                                   for scope, (rate, burst) in event_limits.items()}
+                           for event, event_limits in self.limits.items()},
+                'counters': {event: dict(counts) for event, counts in self.counters.items()},
+                'tracked_buckets': len(self._buckets)
+            }
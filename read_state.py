@@ -0,0 +1,97 @@
+import os
+import json
+import threading
+
+class ReadStateManager:
+    """Per-user, per-chat read cursors with coalesced acknowledgements
+
+    A read cursor is the highest message seq a user has read in a chat, and
+    the unread count is the chat's last seq minus the cursor. Acks update the
+    in-memory cursor right away, but persisting cursors and notifying other
+    participants happen in batches through flush(), so any number of acks
+    for a chat within one flush interval cost one write and one receipt.
+    """
+
+    def __init__(self, user_manager):
+        self.user_manager = user_manager
+        self.read_state_dir = os.path.join(user_manager.data_dir, "read_state")
+        os.makedirs(self.read_state_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._cursors = {}           # {username: {chat_id: seq}}
+        self._dirty_users = set()    # Users with cursors not yet persisted
+        self._pending_receipts = {}  # {chat_id: {username: seq}}
+
+    def _read_state_file(self, username):
+        return self.user_manager.user_data_file(self.read_state_dir, username, ".json")
+
+    def _load(self, username):
+        """Get a user's cursors, loading them on first use (call with the lock held)"""
+        cursors = self._cursors.get(username)
+        if cursors is None:
+            cursors = {}
+            read_state_file = self._read_state_file(username)
+            if os.path.exists(read_state_file):
+                try:
+                    with open(read_state_file, 'r') as f:
+                        cursors = json.load(f)
+                except json.JSONDecodeError:
+                    cursors = {}
+            self._cursors[username] = cursors
+        return cursors
+
+    def _persist(self, username):
+        """Write a user's cursors to disk (call with the lock held)"""
+        read_state_file = self._read_state_file(username)
+        tmp_file = read_state_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self._cursors.get(username, {}), f)
+        os.replace(tmp_file, read_state_file)
+
+    def get_cursor(self, username, chat_id):
+        """Get the highest seq a user has read in a chat, or -1"""
+        with self._lock:
+            return self._load(username).get(chat_id, -1)
+
+    def unread_count(self, username, chat_id, last_seq):
+        """Get the number of messages after the user's read cursor"""
+        if last_seq is None:
+            return 0
+        return max(0, last_seq - self.get_cursor(username, chat_id))
+
+    def ack(self, username, chat_id, seq):
+        """Record that a user has read a chat up to seq
+
+        Returns True when the cursor moved forward.
+        """
+        with self._lock:
+            cursors = self._load(username)
+            if seq <= cursors.get(chat_id, -1):
+                return False
+            cursors[chat_id] = seq
+            self._dirty_users.add(username)
+            self._pending_receipts.setdefault(chat_id, {})[username] = seq
+            return True
+
+    def flush(self):
+        """Persist changed cursors and return the pending receipts
+
+        Returns {chat_id: {username: seq}} with the latest cursor of every
+        user who acked the chat since the last flush.
+        """
+        with self._lock:
+            for username in self._dirty_users:
+                self._persist(username)
+            self._dirty_users.clear()
+
+            receipts = self._pending_receipts
+            self._pending_receipts = {}
+            return receipts
+
+    def unload(self, username):
+        """Persist and drop a user's cursors from memory"""
+        with self._lock:
+            if username in self._dirty_users:
+                self._persist(username)
+                self._dirty_users.discard(username)
+            self._cursors.pop(username, None)
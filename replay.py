@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+Replay a recorded traffic trace against the server in this checkout
+
+Usage: python replay.py TRACE [--fast] [--no-rate-limits] [--data-dir DIR]
+                        [--output REPORT.json] [--baseline REPORT.json]
+
+Record a trace by starting the server with CHAT_RECORD_FILE set. The replay
+starts from an empty data directory (a temporary one unless --data-dir is
+given), registers the trace's users and replays every event at its
+original time, or back to back with --fast. Each recorded connection gets
+its own Socket.IO test client, so handlers run in this process and their
+latency and CPU time are measured directly. --output saves the report as
+JSON, and --baseline compares against a report saved from another build.
+"""
+
+import sys
+import os
+import json
+import gzip
+import time
+import base64
+import shutil
+import tempfile
+import contextlib
+from urllib.parse import urlsplit, parse_qs
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+# Every user the replay registers gets this password; traces hold none
+REPLAY_PASSWORD = "replay-password"
+
+# Responses carrying the ids the server created, by id name
+CREATED_ID_RESPONSES = {'chat_id': 'chat_started', 'attachment_id': 'attachment_created'}
+
+def load_trace(path):
+    """Read a trace's entries in start time order
+
+    A trace file may hold several recording runs one after another; each run
+    is shifted to start after the previous one and its connection aliases
+    are kept apart.
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    entries = []
+    run, offset, last = 0, 0.0, 0.0
+    with opener(path, 'rt') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # A torn final line from a server that was killed
+                continue
+            if 'trace' in entry:
+                run, offset = run + 1, last
+                continue
+            entry['t'] += offset
+            if entry.get('sid'):
+                entry['sid'] = f"{run}:{entry['sid']}"
+            last = max(last, entry['t'])
+            entries.append(entry)
+    entries.sort(key=lambda entry: entry['t'])
+    return entries
+
+def decode(value, key=None):
+    """Rebuild a recorded payload, filling redacted values with placeholders of the same size"""
+    if isinstance(value, dict):
+        if '$redacted' in value:
+            return REPLAY_PASSWORD if key == 'password' else 'A' * value['$redacted']
+        if '$bytes' in value:
+            return bytes(value['$bytes'])
+        if '$b64' in value:
+            return base64.b64decode(value['$b64'])
+        return {k: decode(v, k) for k, v in value.items()}
+    if isinstance(value, list):
+        return [decode(item) for item in value]
+    return value
+
+def percentile(values, fraction):
+    """Get a percentile of a sorted list"""
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+class Replayer:
+    """Drives the app in this process with a recorded trace"""
+
+    def __init__(self, server, fast=False):
+        self.server = server
+        self.fast = fast
+        self.http = server.app.test_client()
+        self.clients = {}  # {connection alias: Socket.IO test client}
+        self.ids = {}      # {recorded id: replayed id}
+        self.tokens = {}   # {(replayed attachment id, purpose): token}
+        self.etags = {}    # {URL: last ETag}
+        self.stats = {}    # {event name: {'wall': [...], 'cpu': [...], 'recorded': [...], 'errors': n}}
+
+    def register_users(self, entries):
+        """Register the users the trace logs in or chats with, unless it registers them itself"""
+        registered = {decode(entry['body']).get('username') for entry in entries
+                      if entry['kind'] == 'http' and entry['path'] == '/register' and entry.get('body')}
+        usernames = set()
+        for entry in entries:
+            data = entry.get('data') or {}
+            if entry['name'] == 'login':
+                usernames.add(data.get('username'))
+            elif entry['name'] == 'start_chat':
+                usernames.update(data.get('participants') or [])
+        for username in sorted(u for u in usernames - registered if isinstance(u, str)):
+            if not self.server.user_manager.user_exists(username):
+                self.server.user_manager.register_user(username, REPLAY_PASSWORD)
+
+    def map_ids(self, value):
+        """Replace recorded ids in a payload with the ids created during the replay"""
+        if isinstance(value, dict):
+            return {k: self.map_ids(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self.map_ids(item) for item in value]
+        if isinstance(value, str):
+            return self.ids.get(value, value)
+        return value
+
+    def _measure(self, name, recorded_ms, action):
+        """Run an action, adding its wall and CPU time to the event's stats"""
+        stats = self.stats.setdefault(name, {'wall': [], 'cpu': [], 'recorded': [], 'errors': 0})
+        wall, cpu = time.perf_counter(), time.thread_time()
+        failed = action()
+        stats['cpu'].append((time.thread_time() - cpu) * 1000)
+        stats['wall'].append((time.perf_counter() - wall) * 1000)
+        stats['recorded'].append(recorded_ms)
+        if failed:
+            stats['errors'] += 1
+
+    def _learn(self, entry, received):
+        """Map the ids the server created for an event and keep any attachment tokens"""
+        for packet in received:
+            args = packet['args'][0] if packet['args'] and isinstance(packet['args'][0], dict) else {}
+            if packet['name'] == 'attachment_created':
+                self.tokens[(args['attachment_id'], 'upload')] = args['upload_token']
+            elif packet['name'] == 'attachment_url':
+                token = parse_qs(urlsplit(args['url']).query).get('token', [None])[0]
+                self.tokens[(args['attachment_id'], 'download')] = token
+            for id_name, recorded_id in (entry.get('ids') or {}).items():
+                if packet['name'] == CREATED_ID_RESPONSES.get(id_name) and id_name in args:
+                    self.ids[recorded_id] = args[id_name]
+
+    def replay_event(self, entry):
+        """Replay one Socket.IO event on its connection's client"""
+        alias, name = entry['sid'], entry['name']
+        if name == 'connect':
+            def connect():
+                self.clients[alias] = self.server.socketio.test_client(self.server.app)
+            self._measure(name, entry['ms'], connect)
+            return
+
+        client = self.clients.get(alias)
+        if client is None:
+            client = self.clients[alias] = self.server.socketio.test_client(self.server.app)
+        if name == 'disconnect':
+            self._measure(name, entry['ms'], lambda: client.disconnect())
+            del self.clients[alias]
+            return
+
+        data = self.map_ids(decode(entry['data']))
+        # Broadcasts from earlier events aren't this event's responses
+        client.get_received()
+        received = []
+
+        def emit():
+            client.emit(name, data)
+            received.extend(client.get_received())
+            return any(packet['name'].endswith('_error') or packet['name'] == 'rate_limited'
+                       for packet in received)
+        self._measure(name, entry['ms'], emit)
+        self._learn(entry, received)
+
+    def replay_http(self, entry):
+        """Replay one HTTP request with the shared test client"""
+        path = '/'.join(self.ids.get(part, part) for part in entry['path'].split('/'))
+        parts = path.split('/')
+        attachment_id = parts[2] if len(parts) > 2 and parts[1] == 'attachments' else None
+
+        headers = {}
+        for header, value in entry.get('headers', {}).items():
+            if header == 'X-Upload-Token':
+                value = self.tokens.get((attachment_id, 'upload'), '')
+            elif header == 'If-None-Match':
+                value = self.etags.get(path)
+                if value is None:
+                    continue
+            headers[header] = value
+        query = {key: self.tokens.get((attachment_id, 'download'), '') if key == 'token' else value
+                 for key, value in entry.get('query', {}).items()}
+
+        body = self.map_ids(decode(entry.get('body')))
+        kwargs = {'data': body} if isinstance(body, bytes) else {'json': body} if body is not None else {}
+
+        def request():
+            response = self.http.open(path, method=entry['method'], query_string=query,
+                                      headers=headers, **kwargs)
+            response.get_data()
+            if response.headers.get('ETag'):
+                self.etags[path] = response.headers['ETag']
+            return response.status_code >= 400 and entry.get('status', 200) < 400
+        self._measure(entry['name'], entry['ms'], request)
+
+    def run(self, entries):
+        """Replay every entry, pacing them as recorded unless fast"""
+        start = time.perf_counter()
+        for i, entry in enumerate(entries):
+            if not self.fast:
+                delay = entry['t'] - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            if entry['kind'] == 'http':
+                self.replay_http(entry)
+            else:
+                self.replay_event(entry)
+            if i % 1000 == 999:
+                # Drop broadcasts queued for connections that haven't spoken since
+                for client in self.clients.values():
+                    client.get_received()
+        for client in list(self.clients.values()):
+            client.disconnect()
+        return time.perf_counter() - start
+
+def build_report(replayer, wall, cpu):
+    """Summarize per-event latency and CPU time"""
+    events = {}
+    for name, stats in sorted(replayer.stats.items()):
+        wall_ms, recorded_ms = sorted(stats['wall']), sorted(stats['recorded'])
+        events[name] = {
+            'count': len(wall_ms),
+            'p50_ms': round(percentile(wall_ms, 0.50), 3),
+            'p95_ms': round(percentile(wall_ms, 0.95), 3),
+            'p99_ms': round(percentile(wall_ms, 0.99), 3),
+            'max_ms': round(wall_ms[-1], 3),
+            'cpu_ms': round(sum(stats['cpu']) / len(stats['cpu']), 3),
+            'recorded_p50_ms': round(percentile(recorded_ms, 0.50), 3),
+            'errors': stats['errors']
+        }
+    count = sum(event['count'] for event in events.values())
+    return {'events': events, 'total': {'count': count, 'wall_s': round(wall, 3),
+                                        'cpu_s': round(cpu, 3), 'events_per_s': round(count / wall, 1)}}
+
+def print_report(report, baseline=None):
+    """Print a report, with changes against a baseline report when given"""
+    print(f"{'event':<52} {'count':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8} "
+          f"{'cpu ms':>8} {'rec p50':>8} {'errors':>6}")
+    for name, event in report['events'].items():
+        line = (f"{name:<52} {event['count']:>6} {event['p50_ms']:>8.2f} {event['p95_ms']:>8.2f} "
+                f"{event['p99_ms']:>8.2f} {event['max_ms']:>8.2f} {event['cpu_ms']:>8.2f} "
+                f"{event['recorded_p50_ms']:>8.2f} {event['errors']:>6}")
+        old = (baseline or {}).get('events', {}).get(name)
+        if old:
+            line += (f"   p50 {(event['p50_ms'] - old['p50_ms']) / (old['p50_ms'] or 1) * 100:+.0f}%"
+                     f"  cpu {(event['cpu_ms'] - old['cpu_ms']) / (old['cpu_ms'] or 1) * 100:+.0f}%")
+        print(line)
+    total = report['total']
+    print(f"\n{total['count']} events in {total['wall_s']:.1f} s ({total['events_per_s']:.0f}/s), "
+          f"server CPU {total['cpu_s']:.1f} s")
+    if baseline:
+        old = baseline['total']
+        print(f"baseline: {old['count']} events in {old['wall_s']:.1f} s, server CPU {old['cpu_s']:.1f} s")
+
+def main():
+    """Replay a trace and report per-event latency and CPU time"""
+    args = sys.argv[1:]
+    options = {}
+    for option in ("--data-dir", "--output", "--baseline"):
+        if option in args:
+            i = args.index(option)
+            options[option] = args[i + 1]
+            del args[i:i + 2]
+    flags = {arg for arg in args if arg.startswith("--")}
+    args = [arg for arg in args if not arg.startswith("--")]
+    if len(args) != 1:
+        print(__doc__.strip())
+        return False
+
+    entries = load_trace(args[0])
+    if not entries:
+        print(f"No events in {args[0]}")
+        return False
+    baseline = None
+    if "--baseline" in options:
+        with open(options["--baseline"], 'r') as f:
+            baseline = json.load(f)
+
+    # The app reads its configuration on import, so set it up first
+    data_dir = options.get("--data-dir") or tempfile.mkdtemp(prefix="replay_")
+    os.environ['CHAT_DATA_DIR'] = data_dir
+    os.environ.pop('CHAT_RECORD_FILE', None)
+    import app as server
+    if "--no-rate-limits" in flags:
+        server.rate_limiter.limits = {}
+
+    try:
+        replayer = Replayer(server, fast="--fast" in flags)
+        print("Registering users...")
+        print(f"Replaying {len(entries)} events{' as fast as possible' if replayer.fast else ''}...")
+        # Handlers log with print; keep that out of the report
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            replayer.register_users(entries)
+            cpu = time.process_time()
+            wall = replayer.run(entries)
+        report = build_report(replayer, wall, time.process_time() - cpu)
+    finally:
+        if "--data-dir" not in options:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    print()
+    print_report(report, baseline)
+    if "--output" in options:
+        with open(options["--output"], 'w') as f:
+            json.dump(report, f, indent=2)
+    return True
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,153 @@
+import time
+import threading
+from collections import OrderedDict
+
+# Chat keys unused for this long are dropped and unwrapped again on next use
+CHAT_KEY_IDLE_TIMEOUT = 30 * 60  # seconds
+CHAT_KEY_CACHE_SIZE = 100000
+# Deserialized private keys kept for users who need to unwrap chat keys
+PRIVATE_KEY_CACHE_SIZE = 256
+
+class Session:
+    """One logged-in Socket.IO connection"""
+
+    __slots__ = ('username', 'connected_at')
+
+    def __init__(self, username):
+        self.username = username
+        self.connected_at = time.time()
+
+class SessionRegistry:
+    """Logged-in connections, by session id and by username"""
+
+    def __init__(self):
+        self.sessions = {}       # {session_id: Session}
+        self.user_sessions = {}  # {username: set(session_id)}
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def add(self, session_id, username):
+        """Record a login on a connection"""
+        self.sessions[session_id] = Session(username)
+        self.user_sessions.setdefault(username, set()).add(session_id)
+
+    def get(self, session_id):
+        """Get a connection's Session, or None if it isn't logged in"""
+        return self.sessions.get(session_id)
+
+    def username(self, session_id):
+        """Get the user logged in on a connection, or None"""
+        session = self.sessions.get(session_id)
+        return None if session is None else session.username
+
+    def remove(self, session_id):
+        """Forget a connection and return (session, whether it was the user's last)"""
+        session = self.sessions.pop(session_id, None)
+        if session is None:
+            return None, False
+        sessions = self.user_sessions.get(session.username)
+        if sessions is not None:
+            sessions.discard(session_id)
+            if not sessions:
+                del self.user_sessions[session.username]
+                return session, True
+        return session, False
+
+class ChatState:
+    """A chat's AES key and when it was last used"""
+
+    __slots__ = ('aes_key', 'last_used')
+
+    def __init__(self, aes_key, last_used):
+        self.aes_key = aes_key
+        self.last_used = last_used
+
+class ChatKeyCache:
+    """Chat AES keys in memory, least recently used first
+
+    Keys are bounded in number and dropped once idle. Every key is also
+    wrapped in its participants' key rings, so a dropped key is unwrapped
+    again the next time a participant uses the chat.
+    """
+
+    def __init__(self, max_size=CHAT_KEY_CACHE_SIZE, idle_timeout=CHAT_KEY_IDLE_TIMEOUT):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._chats = OrderedDict()  # {chat_id: ChatState}
+
+    def __len__(self):
+        return len(self._chats)
+
+    def get(self, chat_id):
+        """Get a chat's key, or None if it isn't loaded"""
+        with self._lock:
+            state = self._chats.get(chat_id)
+            if state is None:
+                return None
+            state.last_used = time.monotonic()
+            self._chats.move_to_end(chat_id)
+            return state.aes_key
+
+    def put(self, chat_id, aes_key):
+        """Keep a chat's key, dropping the least recently used one when full"""
+        with self._lock:
+            self._chats[chat_id] = ChatState(aes_key, time.monotonic())
+            self._chats.move_to_end(chat_id)
+            while len(self._chats) > self.max_size:
+                self._chats.popitem(last=False)
+
+    def evict_idle(self, now=None):
+        """Drop keys unused for idle_timeout seconds and return their chat ids"""
+        cutoff = (time.monotonic() if now is None else now) - self.idle_timeout
+        evicted = []
+        with self._lock:
+            while self._chats:
+                chat_id, state = next(iter(self._chats.items()))
+                if state.last_used > cutoff:
+                    break
+                self._chats.popitem(last=False)
+                evicted.append(chat_id)
+        return evicted
+
+class PrivateKeyCache:
+    """Deserialized private keys of recently active users
+
+    Sessions don't hold private keys: they are only needed to unwrap chat
+    keys that aren't in memory, so they are loaded on demand and a bounded
+    number are kept for users doing that often.
+    """
+
+    def __init__(self, user_manager, crypto_manager, max_size=PRIVATE_KEY_CACHE_SIZE):
+        self.user_manager = user_manager
+        self.crypto_manager = crypto_manager
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._keys = OrderedDict()  # {username: private key}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def get(self, username):
+        """Get a user's private key, deserializing it if it isn't cached"""
+        with self._lock:
+            private_key = self._keys.get(username)
+            if private_key is not None:
+                self._keys.move_to_end(username)
+                return private_key
+
+        private_key_pem = self.user_manager.get_user_private_key(username)
+        if private_key_pem is None:
+            return None
+        private_key = self.crypto_manager.deserialize_private_key(private_key_pem)
+        with self._lock:
+            self._keys[username] = private_key
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+        return private_key
+
+    def forget(self, username):
+        """Drop a user's private key, e.g. when their last session ends"""
+        with self._lock:
+            self._keys.pop(username, None)
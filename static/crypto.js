@@ -1,8 +1,17 @@
 // Client-side encryption utilities for E2EE chat
+
+// Bytes converted per String.fromCharCode call in the base64 fallback
+const BASE64_CHUNK_SIZE = 0x8000;
+
 class ClientCrypto {
-    constructor() {
-        this.aesKey = null;
+    constructor(maxChatKeys = 32) {
+        this.aesKey = null;  // Most recently imported chat key
         this.rsaKeyPair = null;
+
+        // Non-extractable CryptoKeys per chat, kept in least-recently-used
+        // order; an evicted key is fetched from the server again
+        this.chatKeys = new Map();
+        this.maxChatKeys = maxChatKeys;
     }
 
     // Generate RSA key pair
@@ -79,8 +88,9 @@ class ClientCrypto {
         return this.arrayBufferToBase64(exported);
     }
 
-    // Import AES key
-    async importAESKey(base64Key) {
+    // Import AES key, optionally caching it for a chat
+    // The key can't be exported again, so its raw bytes aren't kept around
+    async importAESKey(base64Key, chatId = null) {
         const keyData = this.base64ToArrayBuffer(base64Key);
         this.aesKey = await window.crypto.subtle.importKey(
             "raw",
@@ -89,12 +99,46 @@ class ClientCrypto {
                 name: "AES-GCM",
                 length: 256,
             },
-            true,
+            false,
             ["encrypt", "decrypt"]
         );
+        if (chatId !== null) {
+            this.cacheChatKey(chatId, this.aesKey);
+        }
         return this.aesKey;
     }
 
+    // Store a chat key, evicting the least recently used one when full
+    cacheChatKey(chatId, key) {
+        this.chatKeys.delete(chatId);
+        this.chatKeys.set(chatId, key);
+        while (this.chatKeys.size > this.maxChatKeys) {
+            this.chatKeys.delete(this.chatKeys.keys().next().value);
+        }
+    }
+
+    // Check whether a key is known for a chat
+    hasChatKey(chatId) {
+        return this.chatKeys.has(chatId);
+    }
+
+    // Get the AES key for a chat, falling back to the current key
+    async getChatKey(chatId = null) {
+        if (chatId === null) {
+            return this.aesKey;
+        }
+
+        const key = this.chatKeys.get(chatId);
+        if (key) {
+            // Move to the most recently used position
+            this.chatKeys.delete(chatId);
+            this.chatKeys.set(chatId, key);
+            return key;
+        }
+        // Evicted or never received; the caller asks the server for it
+        return null;
+    }
+
     // Encrypt AES key with RSA public key
     async encryptAESKeyWithRSA(aesKeyBase64, publicKey) {
         const aesKeyData = this.base64ToArrayBuffer(aesKeyBase64);
@@ -126,8 +170,9 @@ class ClientCrypto {
     }
 
     // Encrypt message with AES
-    async encryptMessage(message) {
-        if (!this.aesKey) {
+    async encryptMessage(message, chatId = null) {
+        const aesKey = await this.getChatKey(chatId);
+        if (!aesKey) {
             throw new Error('AES key not available');
         }
 
@@ -142,7 +187,7 @@ class ClientCrypto {
                 name: "AES-GCM",
                 iv: iv,
             },
-            this.aesKey,
+            aesKey,
             data
         );
 
@@ -155,21 +200,23 @@ class ClientCrypto {
     }
 
     // Decrypt message with AES
-    async decryptMessage(encryptedMessageBase64) {
-        if (!this.aesKey) {
+    async decryptMessage(encryptedMessageBase64, chatId = null) {
+        const aesKey = await this.getChatKey(chatId);
+        if (!aesKey) {
             throw new Error('AES key not available');
         }
 
-        const combined = this.base64ToArrayBuffer(encryptedMessageBase64);
-        const iv = combined.slice(0, 12);
-        const encrypted = combined.slice(12);
+        // Views into the decoded buffer avoid copying the IV and ciphertext
+        const combined = new Uint8Array(this.base64ToArrayBuffer(encryptedMessageBase64));
+        const iv = combined.subarray(0, 12);
+        const encrypted = combined.subarray(12);
 
         const decrypted = await window.crypto.subtle.decrypt(
             {
                 name: "AES-GCM",
                 iv: iv,
             },
-            this.aesKey,
+            aesKey,
             encrypted
         );
 
@@ -177,17 +224,82 @@ class ClientCrypto {
         return decoder.decode(decrypted);
     }
 
+    // Encrypt binary data (e.g. an attachment) with AES, returning IV + ciphertext
+    async encryptBytes(data, chatId = null) {
+        const aesKey = await this.getChatKey(chatId);
+        if (!aesKey) {
+            throw new Error('AES key not available');
+        }
+
+        const iv = window.crypto.getRandomValues(new Uint8Array(12));
+        const encrypted = await window.crypto.subtle.encrypt(
+            {
+                name: "AES-GCM",
+                iv: iv,
+            },
+            aesKey,
+            data
+        );
+
+        const combined = new Uint8Array(iv.length + encrypted.byteLength);
+        combined.set(iv);
+        combined.set(new Uint8Array(encrypted), iv.length);
+        return combined;
+    }
+
+    // Decrypt the output of encryptBytes, returning an ArrayBuffer
+    async decryptBytes(data, chatId = null) {
+        const aesKey = await this.getChatKey(chatId);
+        if (!aesKey) {
+            throw new Error('AES key not available');
+        }
+
+        const combined = new Uint8Array(data);
+        return window.crypto.subtle.decrypt(
+            {
+                name: "AES-GCM",
+                iv: combined.subarray(0, 12),
+            },
+            aesKey,
+            combined.subarray(12)
+        );
+    }
+
+    // Decrypt a list of messages with bounded concurrency, preserving order
+    async decryptMessages(encryptedMessages, chatId = null, concurrency = 8) {
+        const results = new Array(encryptedMessages.length);
+        for (let start = 0; start < encryptedMessages.length; start += concurrency) {
+            const batch = encryptedMessages.slice(start, start + concurrency);
+            const decrypted = await Promise.allSettled(
+                batch.map(message => this.decryptMessage(message, chatId))
+            );
+            decrypted.forEach((result, i) => {
+                results[start + i] = result.status === 'fulfilled' ? result.value : null;
+            });
+        }
+        return results;
+    }
+
     // Utility functions
     arrayBufferToBase64(buffer) {
         const bytes = new Uint8Array(buffer);
-        let binary = '';
-        for (let i = 0; i < bytes.byteLength; i++) {
-            binary += String.fromCharCode(bytes[i]);
+        if (typeof bytes.toBase64 === 'function') {
+            return bytes.toBase64();
+        }
+
+        // Convert in chunks instead of growing a string one character at a time
+        const chunks = [];
+        for (let i = 0; i < bytes.length; i += BASE64_CHUNK_SIZE) {
+            chunks.push(String.fromCharCode.apply(null, bytes.subarray(i, i + BASE64_CHUNK_SIZE)));
         }
-        return btoa(binary);
+        return btoa(chunks.join(''));
     }
 
     base64ToArrayBuffer(base64) {
+        if (typeof Uint8Array.fromBase64 === 'function') {
+            return Uint8Array.fromBase64(base64).buffer;
+        }
+
         const binary = atob(base64);
         const bytes = new Uint8Array(binary.length);
         for (let i = 0; i < binary.length; i++) {
@@ -0,0 +1,209 @@
+// Virtualized message list for large chat histories
+//
+// Only the rows in (or near) the viewport are kept in the DOM. Spacer
+// elements above and below stand in for the rest, sized from measured
+// row heights. Appends and prepends are queued and applied together
+// once per animation frame.
+class VirtualMessageList {
+    constructor(container, renderRow, options = {}) {
+        this.container = container;
+        this.renderRow = renderRow;
+        this.estimatedRowHeight = options.estimatedRowHeight || 64;
+        this.overscan = options.overscan || 8;
+        this.topThreshold = options.topThreshold || 200;
+        this.onReachTop = options.onReachTop || null;
+
+        this.rows = [];            // Row data in display order
+        this.heights = [];         // Measured (or estimated) height per row
+        this.offsets = [0];        // offsets[i] is the top of row i
+        this.firstDirtyOffset = 0; // Offsets from this index on need recomputing
+
+        this.pendingAppends = [];
+        this.pendingPrepends = [];
+        this.frameRequested = false;
+        this.stickToBottom = true;
+        this.renderedStart = 0;
+        this.renderedEnd = 0;
+        this.dirty = false;
+
+        this.topSpacer = document.createElement('div');
+        this.rowsHost = document.createElement('div');
+        this.bottomSpacer = document.createElement('div');
+
+        this.container.addEventListener('scroll', () => this.onScroll(), { passive: true });
+        window.addEventListener('resize', () => this.scheduleRender());
+    }
+
+    // Remove all rows and take over the container
+    reset() {
+        this.rows = [];
+        this.heights = [];
+        this.offsets = [0];
+        this.firstDirtyOffset = 0;
+        this.pendingAppends = [];
+        this.pendingPrepends = [];
+        this.stickToBottom = true;
+        this.renderedStart = 0;
+        this.renderedEnd = 0;
+        this.dirty = true;
+
+        this.rowsHost.replaceChildren();
+        this.container.replaceChildren(this.topSpacer, this.rowsHost, this.bottomSpacer);
+        this.scheduleRender();
+    }
+
+    // Queue newer rows for the bottom of the list
+    append(rows) {
+        for (const row of rows) {
+            this.pendingAppends.push(row);
+        }
+        this.scheduleRender();
+    }
+
+    // Queue older rows for the top of the list
+    prepend(rows) {
+        this.pendingPrepends = rows.concat(this.pendingPrepends);
+        this.scheduleRender();
+    }
+
+    scheduleRender() {
+        if (!this.frameRequested) {
+            this.frameRequested = true;
+            window.requestAnimationFrame(() => this.flush());
+        }
+    }
+
+    onScroll() {
+        const container = this.container;
+        this.stickToBottom = container.scrollHeight - container.scrollTop - container.clientHeight < 4;
+        this.scheduleRender();
+    }
+
+    // Apply queued rows and re-render, once per animation frame
+    flush() {
+        this.frameRequested = false;
+
+        if (this.pendingPrepends.length > 0) {
+            const added = this.pendingPrepends;
+            this.pendingPrepends = [];
+            this.rows = added.concat(this.rows);
+            this.heights = new Array(added.length).fill(this.estimatedRowHeight).concat(this.heights);
+            this.firstDirtyOffset = 0;
+            this.dirty = true;
+
+            // Keep the rows the user is looking at in place
+            if (!this.stickToBottom) {
+                this.container.scrollTop += added.length * this.estimatedRowHeight;
+            }
+        }
+
+        if (this.pendingAppends.length > 0) {
+            this.firstDirtyOffset = Math.min(this.firstDirtyOffset, this.rows.length);
+            for (const row of this.pendingAppends) {
+                this.rows.push(row);
+                this.heights.push(this.estimatedRowHeight);
+            }
+            this.pendingAppends = [];
+            this.dirty = true;
+        }
+
+        this.render();
+    }
+
+    updateOffsets() {
+        const count = this.rows.length;
+        if (this.firstDirtyOffset > count) {
+            return;
+        }
+        this.offsets.length = count + 1;
+        for (let i = this.firstDirtyOffset; i < count; i++) {
+            this.offsets[i + 1] = this.offsets[i] + this.heights[i];
+        }
+        this.firstDirtyOffset = count + 1;
+    }
+
+    // Index of the row containing vertical position y
+    findRow(y) {
+        let low = 0;
+        let high = this.rows.length - 1;
+        while (low < high) {
+            const mid = (low + high + 1) >> 1;
+            if (this.offsets[mid] <= y) {
+                low = mid;
+            } else {
+                high = mid - 1;
+            }
+        }
+        return low;
+    }
+
+    render() {
+        this.updateOffsets();
+        const count = this.rows.length;
+
+        if (this.stickToBottom) {
+            this.container.scrollTop = this.offsets[count];
+        }
+
+        const viewTop = this.container.scrollTop;
+        const viewBottom = viewTop + this.container.clientHeight;
+
+        // Ask for older rows when near the top, including when the rows
+        // loaded so far don't fill the viewport
+        if (count > 0 && viewTop < this.topThreshold && this.onReachTop) {
+            this.onReachTop();
+        }
+        const start = count === 0 ? 0 : Math.max(0, this.findRow(viewTop) - this.overscan);
+        const end = count === 0 ? 0 : Math.min(count, this.findRow(viewBottom) + 1 + this.overscan);
+
+        if (!this.dirty && start === this.renderedStart && end === this.renderedEnd) {
+            return;
+        }
+        this.dirty = false;
+        this.renderedStart = start;
+        this.renderedEnd = end;
+
+        const fragment = document.createDocumentFragment();
+        for (let i = start; i < end; i++) {
+            const node = this.renderRow(this.rows[i]);
+            node.dataset.index = i;
+            fragment.appendChild(node);
+        }
+        this.rowsHost.replaceChildren(fragment);
+        this.topSpacer.style.height = this.offsets[start] + 'px';
+
+        // Replace estimates with measured heights for the rendered rows
+        let aboveViewportDelta = 0;
+        let measured = false;
+        for (const node of this.rowsHost.children) {
+            const i = Number(node.dataset.index);
+            const height = node.offsetHeight;
+            if (height !== this.heights[i]) {
+                if (this.offsets[i] < viewTop) {
+                    aboveViewportDelta += height - this.heights[i];
+                }
+                this.heights[i] = height;
+                this.firstDirtyOffset = Math.min(this.firstDirtyOffset, i);
+                measured = true;
+            }
+        }
+        this.updateOffsets();
+        this.bottomSpacer.style.height = (this.offsets[count] - this.offsets[end]) + 'px';
+
+        if (this.stickToBottom) {
+            this.container.scrollTop = this.offsets[count];
+        } else if (aboveViewportDelta !== 0) {
+            this.container.scrollTop += aboveViewportDelta;
+        }
+
+        // Corrected heights can shift the visible range; settle it next frame
+        if (measured) {
+            this.scheduleRender();
+        }
+    }
+}
+
+// Export for use in other files
+if (typeof module !== 'undefined' && module.exports) {
+    module.exports = VirtualMessageList;
+}
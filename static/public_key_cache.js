@@ -0,0 +1,96 @@
+// Cache of other users' public keys, revalidated by fingerprint
+//
+// Keys are kept in localStorage along with the fingerprint the server sent
+// for them. lookup() asks for a whole batch of users in one round-trip,
+// sending the fingerprints already held, and the server only returns the
+// keys that are missing or have changed.
+//
+// A cached key is pinned: when the server sends a different key for a user,
+// it is reported as changed and not stored until accept() is called, so the
+// change is shown again on every lookup until the user has confirmed it.
+class PublicKeyCache {
+    constructor(socket, storage = window.localStorage, prefix = 'publicKey:') {
+        this.socket = socket;
+        this.storage = storage;
+        this.prefix = prefix;
+        this.pending = [];  // Lookups awaiting a response, oldest first
+
+        socket.on('public_keys_response', (data) => this.handleResponse(data));
+        socket.on('rate_limited', (data) => {
+            if (data.event === 'get_public_keys' && this.pending.length) {
+                this.pending.shift().reject(new Error('Rate limited'));
+            }
+        });
+    }
+
+    // Get a cached {public_key, fingerprint}, or null
+    get(username) {
+        const entry = this.storage.getItem(this.prefix + username);
+        return entry ? JSON.parse(entry) : null;
+    }
+
+    // Pin a key, e.g. once the user has confirmed that it changed
+    accept(username, entry) {
+        try {
+            this.storage.setItem(this.prefix + username, JSON.stringify(entry));
+        } catch (error) {
+            // Storage full or disabled: the key is asked about again next time
+        }
+    }
+
+    // Resolve to {keys: {username: {public_key, fingerprint}}, unknown: [username],
+    // changed: {username: {previous, current}}}, where a changed user's key in
+    // keys is the pinned one
+    lookup(usernames) {
+        const known = {};
+        for (const username of usernames) {
+            const entry = this.get(username);
+            if (entry) {
+                known[username] = entry.fingerprint;
+            }
+        }
+        return new Promise((resolve, reject) => {
+            this.pending.push({ usernames, resolve, reject });
+            this.socket.emit('get_public_keys', { usernames, known });
+        });
+    }
+
+    handleResponse(data) {
+        const lookup = this.pending.shift();
+        if (!lookup) {
+            return;
+        }
+        if (!data.success) {
+            lookup.reject(new Error(data.message));
+            return;
+        }
+
+        const keys = {};
+        const changed = {};
+        for (const [username, entry] of Object.entries(data.keys)) {
+            const pinned = this.get(username);
+            if (pinned && pinned.fingerprint !== entry.fingerprint) {
+                changed[username] = { previous: pinned, current: entry };
+                keys[username] = pinned;
+                continue;
+            }
+            keys[username] = entry;
+            this.accept(username, entry);
+        }
+        for (const username of data.unknown) {
+            this.storage.removeItem(this.prefix + username);
+        }
+        // Keys the server didn't send are unchanged
+        for (const username of lookup.usernames) {
+            if (!(username in keys) && !data.unknown.includes(username)) {
+                keys[username] = this.get(username);
+            }
+        }
+        lookup.resolve({ keys, unknown: data.unknown, changed });
+    }
+}
+
+// Export for use in other files
+if (typeof module !== 'undefined' && module.exports) {
+    module.exports = PublicKeyCache;
+}
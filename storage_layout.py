@@ -0,0 +1,76 @@
+import os
+import time
+import hashlib
+
+# Written to a data directory once it holds no flat (unsharded) files
+SHARDED_MARKER = ".sharded"
+
+def sharded_path(directory, file_name):
+    """Get the path of a file fanned out into two levels of subdirectories
+
+    The subdirectories are the first two bytes of the SHA-256 of the file
+    name in hex, so ids of any shape spread evenly over 65536 directories.
+    """
+    digest = hashlib.sha256(file_name.encode('utf-8')).hexdigest()
+    return os.path.join(directory, digest[:2], digest[2:4], file_name)
+
+def _is_flat_file(entry):
+    """Check if a directory entry is a data file still in the flat layout"""
+    return entry.is_file() and not entry.name.startswith('.') and not entry.name.endswith('.tmp')
+
+def is_sharded(directory):
+    """Check if a directory is fully in the sharded layout
+
+    Directories without flat files (including new ones) are marked so later
+    checks are a single stat.
+    """
+    marker = os.path.join(directory, SHARDED_MARKER)
+    if os.path.exists(marker):
+        return True
+    os.makedirs(directory, exist_ok=True)
+    with os.scandir(directory) as entries:
+        if any(_is_flat_file(entry) for entry in entries):
+            return False
+    with open(marker, 'w'):
+        pass
+    return True
+
+def migrate_file(directory, file_name):
+    """Move a file from the flat layout to its sharded path, if it is still flat
+
+    Safe to race with other migrators: rename is atomic and whoever loses
+    finds the file already moved. Returns True if this call moved it.
+    """
+    flat_path = os.path.join(directory, file_name)
+    if not os.path.exists(flat_path):
+        return False
+    path = sharded_path(directory, file_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        os.rename(flat_path, path)
+    except FileNotFoundError:
+        return False
+    return True
+
+def migrate_directory(directory, batch_size=1000, pause=0.0):
+    """Move every flat file in a directory to its sharded path
+
+    Runs while the server is up: the server moves any file it needs before
+    the migration reaches it, and rename keeps each file whole. Sleeps
+    `pause` seconds after every batch_size files to limit the I/O load.
+    Marks the directory once no flat files remain. Returns the number of
+    files moved.
+    """
+    moved = 0
+    if not os.path.isdir(directory):
+        return moved
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if not _is_flat_file(entry):
+                continue
+            if migrate_file(directory, entry.name):
+                moved += 1
+                if pause and moved % batch_size == 0:
+                    time.sleep(pause)
+    is_sharded(directory)
+    return moved
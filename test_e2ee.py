@@ -9,6 +9,19 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from crypto_utils import CryptoManager
 from user_manager import UserManager
+from key_fanout import KeyFanout
+from rate_limiter import RateLimiter
+from chat_store import ChatStore
+from chat_index import ChatIndex
+from chat_inbox import ChatInbox
+from membership import MembershipRegistry
+from password_hasher import PasswordHasher
+from read_state import ReadStateManager
+from attachment_store import AttachmentStore
+from session_state import SessionRegistry, ChatKeyCache, PrivateKeyCache
+from traffic_recorder import TrafficRecorder
+from profiler import Profiler
+from backup import create_snapshot, restore_snapshot, list_snapshots
 
 def test_crypto_operations():
     """Test basic cryptographic operations"""
@@ -179,6 +192,223 @@ def test_user_management():
     print("\nAll user management tests passed!")
     return True
 
+def test_user_directory_paging():
+    """Test version counters and cursor paging of users and friends"""
+    print("\nTesting user directory paging...")
+    
+    # Clean up any existing test data
+    import shutil
+    if os.path.exists("test_data"):
+        shutil.rmtree("test_data")
+    
+    user_manager = UserManager("test_data")
+    for username in ("carol", "alice", "bob"):
+        user_manager.register_user(username, "password123")
+    
+    print("1. Testing cursor paging in username order...")
+    page, cursor = user_manager.list_users(limit=2)
+    rest, end = user_manager.list_users(cursor, limit=2)
+    if page != ["alice", "bob"] or rest != ["carol"] or end is not None:
+        print(f"   [FAIL] Unexpected pages: {page} {rest}")
+        return False
+    user_manager.register_user("aaron", "password123")
+    if user_manager.list_users(cursor, limit=2)[0] != ["carol"]:
+        print("   [FAIL] Registration shifted a later page")
+        return False
+    print("   [OK] Pages stable across registrations")
+    
+    print("2. Testing version counters...")
+    directory_version = user_manager.directory_version
+    friends_version = user_manager.get_friends_version("alice")
+    user_manager.add_friend("alice", "bob")
+    user_manager.add_friend("alice", "carol")
+    if user_manager.get_friends_version("alice") != friends_version + 2 or \
+            user_manager.directory_version != directory_version:
+        print("   [FAIL] Friend list changes not versioned correctly")
+        return False
+    page, cursor = user_manager.list_friends("alice", limit=1)
+    if page != ["bob"] or user_manager.list_friends("alice", cursor, limit=1) != (["carol"], None):
+        print("   [FAIL] Friend list paging incorrect")
+        return False
+    print("   [OK] Versions bumped only by changes")
+    
+    # Clean up test data
+    shutil.rmtree("test_data")
+    print("   [OK] Test data cleaned up")
+    
+    print("\nAll user directory paging tests passed!")
+    return True
+
+def test_user_records():
+    """Test sharded user records, the LRU cache and users.json migration"""
+    print("\nTesting user records...")
+    
+    # Clean up any existing test data
+    import json
+    import shutil
+    if os.path.exists("test_data"):
+        shutil.rmtree("test_data")
+    
+    print("1. Testing legacy users.json migration...")
+    os.makedirs("test_data")
+    legacy_user = {"public_key": "PUB", "private_key": "PRIV", "password_hash": "",
+                   "created_at": "", "last_seen": "", "friends": ["bob"]}
+    with open(os.path.join("test_data", "users.json"), 'w') as f:
+        json.dump({"alice": legacy_user, "bob": dict(legacy_user, friends=[])}, f)
+    user_manager = UserManager("test_data")
+    if user_manager.get_all_users() != ["alice", "bob"] or user_manager.get_friends("alice") != ["bob"]:
+        print("   [FAIL] Users not migrated")
+        return False
+    if os.path.exists(os.path.join("test_data", "users.json")):
+        print("   [FAIL] Legacy file not retired")
+        return False
+    print("   [OK] Users migrated to per-user records")
+    
+    print("2. Testing records load lazily with a bounded cache...")
+    user_manager.register_user("carol", "password123")
+    reloaded = UserManager("test_data", cache_size=1)
+    if reloaded._record_cache:
+        print("   [FAIL] Records loaded at startup")
+        return False
+    if reloaded.get_user_public_key("alice") != "PUB" or not reloaded.authenticate_user("carol", "password123")[0]:
+        print("   [FAIL] Records not loaded on demand")
+        return False
+    if list(reloaded._record_cache) != ["carol"]:
+        print("   [FAIL] Cache not bounded")
+        return False
+    if not reloaded.user_exists("carol") or reloaded.user_exists("dave"):
+        print("   [FAIL] Directory lookup incorrect")
+        return False
+    print("   [OK] Records loaded on demand and evicted")
+    
+    # Clean up test data
+    shutil.rmtree("test_data")
+    print("   [OK] Test data cleaned up")
+    
+    print("\nAll user record tests passed!")
+    return True
+
+def test_password_hashing():
+    """Test password hash profiles and rehashing outdated hashes on login"""
+    print("\nTesting password hashing...")
+    
+    # Clean up any existing test data
+    import shutil
+    import hashlib
+    if os.path.exists("test_data"):
+        shutil.rmtree("test_data")
+    
+    print("1. Testing every profile verifies its own hashes...")
+    for profile in ("pbkdf2", "scrypt"):
+        hasher = PasswordHasher(profile)
+        stored_hash = hasher.hash("secret123")
+        if not hasher.verify("secret123", stored_hash) or hasher.verify("wrong", stored_hash):
+            print(f"   [FAIL] {profile} hash not verified correctly")
+            return False
+        if hasher.needs_rehash(stored_hash):
+            print(f"   [FAIL] Current {profile} hash reported as outdated")
+            return False
+    if not stored_hash.startswith("$scrypt$16384,8,1$"):
+        print("   [FAIL] Hash doesn't record its KDF and parameters")
+        return False
+    print("   [OK] Hashes record their KDF and parameters")
+    
+    print("2. Testing hashes from other profiles and the legacy format...")
+    salt = "0123456789abcdef0123456789abcdef"
+    legacy_hash = salt + hashlib.pbkdf2_hmac('sha256', b"secret123", salt.encode('utf-8'), 100000).hex()
+    pbkdf2_hash = PasswordHasher("pbkdf2").hash("secret123")
+    if not hasher.verify("secret123", legacy_hash) or not hasher.verify("secret123", pbkdf2_hash):
+        print("   [FAIL] Older hashes not verified")
+        return False
+    if not hasher.needs_rehash(legacy_hash) or not hasher.needs_rehash(pbkdf2_hash):
+        print("   [FAIL] Older hashes not reported as outdated")
+        return False
+    if hasher.verify("secret123", "$scrypt$3,8,1$00$00") or hasher.verify("secret123", "garbage"):
+        print("   [FAIL] Malformed hash accepted")
+        return False
+    print("   [OK] Older hashes verified and flagged for rehashing")
+    
+    print("3. Testing rehash on login...")
+    user_manager = UserManager("test_data", password_profile="pbkdf2")
+    user_manager.register_user("user1", "secret123")
+    user_manager = UserManager("test_data")
+    if user_manager.authenticate_user("user1", "wrong")[0] or \
+            user_manager._get_record("user1")["password_hash"].startswith("$scrypt$"):
+        print("   [FAIL] Failed login changed the hash")
+        return False
+    success, _ = user_manager.authenticate_user("user1", "secret123")
+    stored_hash = UserManager("test_data")._get_record("user1")["password_hash"]
+    if not success or not stored_hash.startswith("$scrypt$"):
+        print("   [FAIL] Outdated hash not upgraded on login")
+        return False
+    if not user_manager.authenticate_user("user1", "secret123")[0]:
+        print("   [FAIL] Login failed after rehash")
+        return False
+    print("   [OK] Hash upgraded to the current profile on login")
+    
+    # Clean up test data
+    shutil.rmtree("test_data")
+    print("   [OK] Test data cleaned up")
+    
+    print("\nAll password hashing tests passed!")
+    return True
+
+def test_public_key_lookup():
+    """Test batch public key lookup against the fingerprints a client holds"""
+    print("\nTesting public key lookup...")
+    
+    # Clean up any existing test data
+    import shutil
+    if os.path.exists("test_data"):
+        shutil.rmtree("test_data")
+    
+    user_manager = UserManager("test_data")
+    crypto_manager = CryptoManager()
+    for username in ("alice", "bob", "carol"):
+        user_manager.register_user(username, "password123")
+    
+    print("1. Testing fingerprints are stored at registration...")
+    record = user_manager._get_record("alice")
+    if record.get("public_key_fingerprint") != crypto_manager.public_key_fingerprint(record["public_key"]):
+        print("   [FAIL] Fingerprint not stored")
+        return False
+    print("   [OK] Fingerprint stored with the key")
+    
+    print("2. Testing only missing or changed keys are returned...")
+    keys, unknown = user_manager.get_public_keys(["alice", "bob", "carol", "dave"])
+    if sorted(keys) != ["alice", "bob", "carol"] or unknown != ["dave"]:
+        print("   [FAIL] First lookup incomplete")
+        return False
+    known = {username: key["fingerprint"] for username, key in keys.items()}
+    keys, unknown = user_manager.get_public_keys(["alice", "bob", "carol"], known)
+    if keys or unknown:
+        print("   [FAIL] Cached keys sent again")
+        return False
+    keys, _ = user_manager.get_public_keys(["alice", "bob"], dict(known, bob="stale"))
+    if list(keys) != ["bob"] or keys["bob"]["public_key"] != user_manager.get_user_public_key("bob"):
+        print("   [FAIL] Changed key not sent")
+        return False
+    print("   [OK] Only missing and changed keys returned")
+    
+    print("3. Testing records from before fingerprints...")
+    user_manager._save_record({k: v for k, v in user_manager._get_record("carol").items()
+                               if k != "public_key_fingerprint"})
+    reloaded = UserManager("test_data")
+    if reloaded.get_public_key_fingerprint("carol") != known["carol"]:
+        print("   [FAIL] Fingerprint not computed for old record")
+        return False
+    if UserManager("test_data")._get_record("carol").get("public_key_fingerprint") != known["carol"]:
+        print("   [FAIL] Computed fingerprint not stored")
+        return False
+    print("   [OK] Old records get their fingerprint stored once")
+    
+    # Clean up test data
+    shutil.rmtree("test_data")
+    print("   [OK] Test data cleaned up")
+    
+    print("\nAll public key lookup tests passed!")
+    return True
+
 def test_chat_log_encryption():
     """Test encrypted chat log functionality"""
     print("\nTesting chat log encryption...")
@@ -243,6 +473,1280 @@ def test_chat_log_encryption():
     print("\nAll chat log encryption tests passed!")
     return True
 
+def test_sharded_chat_storage():
+    """Test hashed chat file paths and migration from the flat layout"""
+    print("\nTesting sharded chat storage...")
+    
+    # Clean up any existing test data
+    import shutil
+    from storage_layout import migrate_directory, SHARDED_MARKER
+    if os.path.exists("test_data"):
+        shutil.rmtree("test_data")
+    
+    crypto_manager = CryptoManager()
+    aes_key = crypto_manager.generate_aes_key()
+    
+    print("1. Testing flat files are found and moved on access...")
+    os.makedirs(os.path.join("test_data", "chat_logs"))
+    for chat_id in ("chat_a", "chat_b"):
+        with open(os.path.join("test_data", "chat_logs", f"{chat_id}.enc"), 'wb') as f:
+            f.write(crypto_manager.encrypt_chat_log([{"username": "user1", "encrypted_message": chat_id,
+                                                      "timestamp": "2024-01-01T10:00:00"}], aes_key))
+    user_manager = UserManager("test_data")
+    log_file = user_manager._chat_log_file("chat_a")
+    if os.path.dirname(log_file) == user_manager.chat_logs_dir or not os.path.exists(log_file):
+        print("   [FAIL] Flat log not moved to its sharded path")
+        return False
+    print("   [OK] Flat log moved on access")
+    
+    print("2. Testing the migration tool...")
+    if migrate_directory(user_manager.chat_logs_dir) != 1:
+        print("   [FAIL] Remaining flat log not migrated")
+        return False
+    if not os.path.exists(os.path.join(user_manager.chat_logs_dir, SHARDED_MARKER)):
+        print("   [FAIL] Migrated directory not marked")
+        return False
+    chat_store = ChatStore(user_manager, crypto_manager)
+    messages, _, _ = chat_store.query("chat_b", aes_key)
+    if [m['encrypted_message'] for m in messages] != ["chat_b"]:
+        print("   [FAIL] Migrated log not readable")
+        return False
+    print("   [OK] Logs migrated and readable")
+    
+    # Clean up test data
+    shutil.rmtree("test_data")
+    print("   [OK] Test data cleaned up")
+    
+    print("\nAll sharded chat storage tests passed!")
+    return True
+
+def test_key_fanout():
+    """Test group chat key fanout and offline delivery"""
+    print("\nTesting key fanout...")
+    
+    # Clean up any existing test data
+    import shutil
+    if os.path.exists("test_data"):
+        shutil.rmtree("test_data")
+    
+    user_manager = UserManager("test_data")
+    crypto_manager = CryptoManager()
+    fanout = KeyFanout(user_manager, crypto_manager, max_workers=4)
+    
+    participants = ["alice", "bob", "carol"]
+    for username in participants:
+        user_manager.register_user(username, "password123")
+    
+    print("1. Testing key wrapping for all participants...")
+    aes_key = crypto_manager.generate_aes_key()
+    wrapped_keys = fanout.fanout("chat_1", aes_key, participants + ["nobody"], online_users=["alice"])
+    if sorted(wrapped_keys) != participants:
+        print(f"   [FAIL] Unexpected wrapped key recipients: {sorted(wrapped_keys)}")
+        return False
+    
+    for username in participants:
+        private_key = crypto_manager.deserialize_private_key(user_manager.get_user_private_key(username))
+        if crypto_manager.decrypt_aes_key(wrapped_keys[username], private_key) != aes_key:
+            print(f"   [FAIL] Wrapped key for {username} does not decrypt to the chat key")
+            return False
+    print("   [OK] Every participant's wrapped key decrypts to the chat key")
+    
+    print("2. Testing pending keys for offline participants...")
+    alice_keys = user_manager.load_wrapped_keys("alice")
+    bob_keys = user_manager.load_wrapped_keys("bob")
+    if alice_keys["chat_1"][1] or not bob_keys["chat_1"][1]:
+        print("   [FAIL] Pending flags not recorded correctly")
+        return False
+    print("   [OK] Offline participants have the key marked pending")
+    
+    # A key stored after the key ring was read for delivery stays pending
+    delivered = [chat_id for chat_id, (_, pending) in user_manager.load_wrapped_keys("bob").items() if pending]
+    later_keys = fanout.fanout("chat_2", crypto_manager.generate_aes_key(), ["bob"])
+    user_manager.mark_wrapped_keys_delivered("bob", delivered)
+    bob_keys = user_manager.load_wrapped_keys("bob")
+    if bob_keys["chat_1"] != (wrapped_keys["bob"], False):
+        print("   [FAIL] Delivered keys not updated correctly")
+        return False
+    if bob_keys["chat_2"] != (later_keys["bob"], True):
+        print("   [FAIL] Key stored after the read was marked delivered")
+        return False
+    print("   [OK] Only the keys actually delivered are cleared")
+    
+    print("3. Testing the public key cache is bounded...")
+    fanout.executor.shutdown()
+    fanout = KeyFanout(user_manager, crypto_manager, max_workers=1, cache_size=2)
+    fanout.fanout("chat_3", aes_key, participants)
+    if list(fanout._public_keys) != ["bob", "carol"]:
+        print(f"   [FAIL] Unexpected cached public keys: {list(fanout._public_keys)}")
+        return False
+    fanout.fanout("chat_4", aes_key, ["bob"])
+    if list(fanout._public_keys) != ["carol", "bob"]:
+        print(f"   [FAIL] Cache not kept in least-recently-used order: {list(fanout._public_keys)}")
+        return False
+    print("   [OK] Least recently used public keys are evicted")
+    
+    fanout.executor.shutdown()
+    
+    # Clean up test data
+    shutil.rmtree("test_data")
+    print("   [OK] Test data cleaned up")
+    
+    print("\nAll key fanout tests passed!")
+    return True
+
+def test_rate_limiter():
+    """Test per-session and per-user token bucket limits"""
+    print("\nTesting rate limiter...")
+    
+    now = [0.0]
+    limiter = RateLimiter({
+        'send_message': {'sid': (1, 3), 'user': (1, 4)}
+    }, clock=lambda: now[0])
+    
+    print("1. Testing per-session burst...")
+    results = [limiter.acquire('send_message', 'sid1', 'alice') for _ in range(4)]
+    if results[:3] != [0, 0, 0] or not results[3] > 0:
+        print(f"   [FAIL] Unexpected session burst results: {results}")
+        return False
+    print("   [OK] Session limited after its burst")
+    
+    print("2. Testing per-user limit across sessions...")
+    if limiter.acquire('send_message', 'sid2', 'alice') != 0:
+        print("   [FAIL] Second session should have one user token left")
+        return False
+    if not limiter.acquire('send_message', 'sid3', 'alice') > 0:
+        print("   [FAIL] User limit not applied across sessions")
+        return False
+    if limiter.acquire('send_message', 'sid4', 'bob') != 0:
+        print("   [FAIL] Other users should not be affected")
+        return False
+    print("   [OK] User limited across all of their sessions")
+    
+    print("3. Testing refill and unlimited events...")
+    now[0] += 2.0
+    if limiter.acquire('send_message', 'sid1', 'alice') != 0:
+        print("   [FAIL] Bucket did not refill")
+        return False
+    if limiter.acquire('join_chat', 'sid1', 'alice') != 0:
+        print("   [FAIL] Events without limits should always be allowed")
+        return False
+    print("   [OK] Buckets refill over time")
+    
+    print("4. Testing counters and cleanup...")
+    counters = limiter.stats()['counters']['send_message']
+    if counters != {'allowed': 6, 'throttled_sid': 1, 'throttled_user': 1}:
+        print(f"   [FAIL] Unexpected counters: {counters}")
+        return False
+    now[0] += 10.0
+    for sid, username in [('sid1', 'alice'), ('sid2', 'alice'), ('sid3', 'alice'), ('sid4', 'bob')]:
+        limiter.forget_session(sid, username)
+    if limiter.stats()['tracked_buckets'] != 0:
+        print("   [FAIL] Buckets not released after sessions closed")
+        return False
+    print("   [OK] Counters recorded and buckets released")
+    
+    print("5. Testing login buckets per claimed user and address...")
+    limiter = RateLimiter({'login': {'user': (0.2, 5)}}, clock=lambda: now[0])
+    for attempt in range(6):
+        limiter.acquire('login', f"attacker{attempt}", ('victim', '203.0.113.9'))
+    if limiter.acquire('login', 'victim_sid', ('victim', '198.51.100.7')) != 0:
+        print("   [FAIL] Failed attempts from one address locked out another")
+        return False
+    now[0] += 30.0
+    if limiter.prune() != 2 or limiter.stats()['tracked_buckets'] != 0:
+        print("   [FAIL] Refilled login buckets not pruned")
+        return False
+    print("   [OK] Attempts limited per address and pruned once refilled")
+    
+    print("\nAll rate limiter tests passed!")
+    return True
+
+def test_chat_index():
+    """Test indexed chat history queries"""
+    print("\nTesting chat metadata index...")
+    
+    # Clean up any existing test data
+    import shutil
+    from datetime import datetime, timedelta
+    if os.path.exists("test_data"):
+        shutil.rmtree("test_data")
+    
+    user_manager = UserManager("test_data")
+    crypto_manager = CryptoManager()
+    chat_store = ChatStore(user_manager, crypto_manager)
+    aes_key = crypto_manager.generate_aes_key()
+    
+    start_time = datetime(2023, 1, 1, 10, 0)
+    for i in range(30):
+        chat_store.append_message("test_chat_123", {
+            "username": ["user1", "user2", "user3"][i % 3],
+            "encrypted_message": f"encrypted_msg_{i}",
+            "timestamp": (start_time + timedelta(minutes=i)).isoformat()
+        }, aes_key)
+    
+    print("1. Testing latest page...")
+    messages, has_more, _ = chat_store.query("test_chat_123", aes_key, limit=5)
+    if [m["seq"] for m in messages] != [25, 26, 27, 28, 29] or not has_more:
+        print("   [FAIL] Latest page incorrect")
+        return False
+    if messages[0]["encrypted_message"] != "encrypted_msg_25":
+        print("   [FAIL] Message content incorrect")
+        return False
+    print("   [OK] Latest page returned")
+    
+    print("2. Testing time range and sender filter...")
+    messages, _, _ = chat_store.query(
+        "test_chat_123", aes_key,
+        since=(start_time + timedelta(minutes=10)).timestamp(),
+        until=(start_time + timedelta(minutes=20)).timestamp(),
+        sender="user2"
+    )
+    if [m["seq"] for m in messages] != [10, 13, 16, 19]:
+        print(f"   [FAIL] Unexpected filtered messages: {[m['seq'] for m in messages]}")
+        return False
+    print("   [OK] Time range and sender filter applied")
+    
+    print("3. Testing jump to date...")
+    messages, has_more, has_newer = chat_store.query(
+        "test_chat_123", aes_key, at=(start_time + timedelta(minutes=7, seconds=30)).timestamp(), limit=2
+    )
+    if [m["seq"] for m in messages] != [8, 9] or not has_more or not has_newer:
+        print("   [FAIL] Jump to date returned the wrong page")
+        return False
+    print("   [OK] Jump to date found the first later message")
+    
+    print("4. Testing index reload from disk...")
+    reloaded_store = ChatStore(user_manager, crypto_manager)
+    if reloaded_store.message_count("test_chat_123") != 30:
+        print("   [FAIL] Index not reloaded")
+        return False
+    print("   [OK] Index reloaded")
+    
+    print("5. Testing corrupt index lines keep later seqs in place...")
+    index_file = reloaded_store._index_file("test_chat_123")
+    with open(index_file) as f:
+        lines = f.readlines()
+    lines[10] = '{"not": "an entry"}\n'
+    lines[11] = '["x", 1, 2.0, "user1", 11]\n'
+    del lines[20]
+    with open(index_file, "w") as f:
+        f.writelines(lines)
+    corrupt_store = ChatStore(user_manager, crypto_manager)
+    if corrupt_store.message_count("test_chat_123") != 30:
+        print("   [FAIL] Corrupt lines changed the message count")
+        return False
+    messages, _, _ = corrupt_store.query("test_chat_123", aes_key)
+    if [m["seq"] for m in messages] != [seq for seq in range(30) if seq not in (10, 11, 20)]:
+        print(f"   [FAIL] Seqs shifted past corrupt lines: {[m['seq'] for m in messages]}")
+        return False
+    if any(m["encrypted_message"] != f"encrypted_msg_{m['seq']}" for m in messages):
+        print("   [FAIL] Seqs no longer match their messages")
+        return False
+    if corrupt_store.append_message("test_chat_123", {
+        "username": "user1", "encrypted_message": "encrypted_msg_30",
+        "timestamp": (start_time + timedelta(minutes=30)).isoformat()
+    }, aes_key) != 30:
+        print("   [FAIL] New message not given the next seq")
+        return False
+    print("   [OK] Corrupt and missing lines keep their seqs and are left out of results")
+    
+    print("6. Testing legacy chat log upgrade...")
+    legacy_messages = [{"username": "user1", "encrypted_message": "old", "timestamp": start_time.isoformat()}]
+    user_manager.save_chat_log("legacy_chat", crypto_manager.encrypt_chat_log(legacy_messages, aes_key))
+    messages, _, _ = reloaded_store.query("legacy_chat", aes_key)
+    if messages != [dict(legacy_messages[0], seq=0)] or user_manager.chat_log_format("legacy_chat") != "records":
+        print("   [FAIL] Legacy chat log not upgraded")
+        return False
+    print("   [OK] Legacy chat log upgraded to records")
+    
+    # Clean up test data
+    shutil.rmtree("test_data")
+    print("   [OK] Test data cleaned up")
+    
+    print("\nAll chat index tests passed!")
+    return True
+
+def test_concurrent_chat_writes():
+    """Test that concurrent sends to the same and different chats lose nothing"""
+    print("\nTesting concurrent chat writes...")
+    
+    # Clean up any existing test data
+    import shutil
+    import threading
+    if os.path.exists("test_data"):
+        shutil.rmtree("test_data")
+    
+    user_manager = UserManager("test_data")
+    crypto_manager = CryptoManager()
+    chat_store = ChatStore(user_manager, crypto_manager)
+    aes_key = crypto_manager.generate_aes_key()
+    
+    # A legacy log, so the first writers also race to upgrade it
+    legacy_message = {"username": "old", "encrypted_message": "old", "timestamp": "2023-01-01T10:00:00"}
+    user_manager.save_chat_log("chat_0", crypto_manager.encrypt_chat_log([legacy_message], aes_key))
+    
+    chat_ids = ["chat_0", "chat_1", "chat_2"]
+    writers, per_writer = 6, 50
+    barrier = threading.Barrier(writers)
+    seqs = {chat_id: [] for chat_id in chat_ids}
+    
+    def write(writer):
+        barrier.wait()
+        for i in range(per_writer):
+            chat_id = chat_ids[(writer + i) % len(chat_ids)]
+            seqs[chat_id].append(chat_store.append_message(chat_id, {
+                "username": f"writer{writer}",
+                "encrypted_message": f"{writer}:{i}",
+                "timestamp": "2023-01-01T10:00:00"
+            }, aes_key))
+    
+    threads = [threading.Thread(target=write, args=(writer,)) for writer in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    print("1. Testing sequence numbers...")
+    for chat_id in chat_ids:
+        first = 1 if chat_id == "chat_0" else 0
+        if sorted(seqs[chat_id]) != list(range(first, first + len(seqs[chat_id]))):
+            print(f"   [FAIL] Duplicate or missing seqs in {chat_id}")
+            return False
+    print("   [OK] Every message got its own seq")
+    
+    print("2. Testing stored messages after reload...")
+    reloaded_store = ChatStore(user_manager, crypto_manager)
+    stored = []
+    for chat_id in chat_ids:
+        messages, _, _ = reloaded_store.query(chat_id, aes_key)
+        if [m["seq"] for m in messages] != list(range(len(messages))):
+            print(f"   [FAIL] Stored seqs out of order in {chat_id}")
+            return False
+        stored.extend(m["encrypted_message"] for m in messages if m["username"] != "old")
+        # Each writer's messages to a chat must keep the order they were sent in
+        for writer in range(writers):
+            sent = [int(m["encrypted_message"].split(":")[1]) for m in messages
+                    if m["username"] == f"writer{writer}"]
+            if sent != sorted(sent):
+                print(f"   [FAIL] writer{writer}'s messages reordered in {chat_id}")
+                return False
+    if sorted(stored) != sorted(f"{w}:{i}" for w in range(writers) for i in range(per_writer)):
+        print(f"   [FAIL] Expected {writers * per_writer} messages, found {len(stored)}")
+        return False
+    print(f"   [OK] All {len(stored)} messages stored in order")
+    
+    print("3. Testing lock-free index reads during appends...")
+    index = ChatIndex(os.path.join("test_data", "race.idx"))
+    done = threading.Event()
+    errors = []
+    
+    def read():
+        while not done.is_set():
+            try:
+                start, end = index.seq_range(until=float("inf"))
+                for seq in range(max(start, end - 3), end):
+                    index.span(seq)
+                    index.senders[seq]
+                    index.timestamps[seq]
+            except IndexError as e:
+                errors.append(e)
+                return
+    
+    # Switch threads as often as possible so a reader lands mid-append
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        readers = [threading.Thread(target=read) for _ in range(2)]
+        for thread in readers:
+            thread.start()
+        for i in range(100000):
+            index._add(i * 10, 10, float(i), f"user{i % 4}")
+        done.set()
+        for thread in readers:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    if errors:
+        print(f"   [FAIL] Reader saw a partly added entry: {errors[0]!r}")
+        return False
+    print("   [OK] Readers only saw complete entries")
+    
+    # Clean up test data
+    shutil.rmtree("test_data")
+    print("   [OK] Test data cleaned up")
+    
+    print("\nAll concurrent chat write tests passed!")
+    return True
+
+def test_chat_inbox():
+    """Test per-user chat lists ordered by last activity"""
+    print("\nTesting chat inbox...")
+    
+    # Clean up any existing test data
+    import shutil
+    from datetime import datetime
+    if os.path.exists("test_data"):
+        shutil.rmtree("test_data")
+    
+    user_manager = UserManager("test_data")
+    crypto_manager = CryptoManager()
+    chat_store = ChatStore(user_manager, crypto_manager)
+    chat_inbox = ChatInbox(user_manager, chat_store)
+    aes_key = crypto_manager.generate_aes_key()
+    
+    print("1. Testing chats ordered by creation...")
+    for i, chat_id in enumerate(["chat_a", "chat_b", "chat_c"]):
+        chat_inbox.add_chat(chat_id, ["user1", f"friend{i}"], 1000.0 + i)
+    chats, _ = chat_inbox.list_chats("user1")
+    if [c["chat_id"] for c in chats] != ["chat_c", "chat_b", "chat_a"]:
+        print("   [FAIL] Chats not ordered by creation time")
+        return False
+    print("   [OK] Newest chat listed first")
+    
+    print("2. Testing activity moves a chat to the front...")
+    message = {"username": "user1", "encrypted_message": "msg", "timestamp": datetime.now().isoformat()}
+    seq = chat_store.append_message("chat_a", message, aes_key)
+    chat_inbox.record_message("chat_a", datetime.now().timestamp(), seq)
+    chats, next_cursor = chat_inbox.list_chats("user1", limit=2)
+    if [c["chat_id"] for c in chats] != ["chat_a", "chat_c"] or chats[0]["last_seq"] != 0:
+        print("   [FAIL] Active chat not moved to the front")
+        return False
+    print("   [OK] Active chat moved to the front")
+    
+    print("3. Testing cursor paging...")
+    # The last chat on the first page becoming active must not restart paging
+    seq = chat_store.append_message("chat_c", dict(message, timestamp=datetime.now().isoformat()), aes_key)
+    chat_inbox.record_message("chat_c", datetime.now().timestamp(), seq)
+    chats, next_cursor = chat_inbox.list_chats("user1", cursor=next_cursor, limit=2)
+    if [c["chat_id"] for c in chats] != ["chat_b"] or next_cursor is not None:
+        print("   [FAIL] Second page incorrect")
+        return False
+    try:
+        chat_inbox.list_chats("user1", cursor="chat_b")
+        print("   [FAIL] Malformed cursor accepted")
+        return False
+    except ValueError:
+        pass
+    print("   [OK] Cursor paging resumes after the cursor's old place")
+    
+    print("4. Testing inbox rebuilt from disk...")
+    reloaded_inbox = ChatInbox(user_manager, ChatStore(user_manager, crypto_manager))
+    chats, _ = reloaded_inbox.list_chats("user1")
+    if [c["chat_id"] for c in chats] != ["chat_c", "chat_a", "chat_b"]:
+        print("   [FAIL] Rebuilt inbox order incorrect")
+        return False
+    if [c["chat_id"] for c in reloaded_inbox.list_chats("friend1")[0]] != ["chat_b"]:
+        print("   [FAIL] Participant inbox incorrect")
+        return False
+    print("   [OK] Inbox rebuilt from journals and chat indexes")
+    
+    print("5. Testing activity while an inbox is built...")
+    building_inbox = ChatInbox(user_manager, ChatStore(user_manager, crypto_manager))
+    load_inbox = building_inbox._load_inbox
+    
+    def load_with_activity(username):
+        inbox = load_inbox(username)
+        if building_inbox._lock.locked():
+            raise RuntimeError("Inbox built under the lock")
+        # A message sent after the build read its chats, before it is published
+        building_inbox.record_message("chat_b", datetime.now().timestamp() + 60, 5)
+        return inbox
+    
+    building_inbox._load_inbox = load_with_activity
+    chats, _ = building_inbox.list_chats("user1")
+    if [c["chat_id"] for c in chats] != ["chat_b", "chat_c", "chat_a"] or chats[0]["last_seq"] != 5:
+        print("   [FAIL] Activity during the build was lost")
+        return False
+    print("   [OK] Built outside the lock without losing activity")
+    
+    # Clean up test data
+    shutil.rmtree("test_data")
+    print("   [OK] Test data cleaned up")
+    
+    print("\nAll chat inbox tests passed!")
+    return True
+
+def test_membership():
+    """Test the chat membership registry and member changes"""
+    print("\nTesting chat membership...")
+    
+    # Clean up any existing test data
+    import shutil
+    if os.path.exists("test_data"):
+        shutil.rmtree("test_data")
+    
+    user_manager = UserManager("test_data")
+    crypto_manager = CryptoManager()
+    chat_store = ChatStore(user_manager, crypto_manager)
+    membership = MembershipRegistry(user_manager)
+    chat_inbox = ChatInbox(user_manager, chat_store, membership)
+    
+    print("1. Testing membership checks...")
+    chat_inbox.add_chat("chat_a", ["user1", "user2"], 1000.0, created_by="user1")
+    if not membership.is_member("chat_a", "user2") or membership.is_member("chat_a", "user3"):
+        print("   [FAIL] Membership check incorrect")
+        return False
+    if membership.is_member("missing", "user1") or membership.get_members("missing") != ():
+        print("   [FAIL] Unknown chat reported members")
+        return False
+    print("   [OK] Members and non-members told apart")
+    
+    print("2. Testing adding a member...")
+    chat_inbox.list_chats("user3")
+    success, _ = chat_inbox.add_member("chat_a", "user3")
+    if not success or membership.get_members("chat_a") != ("user1", "user2", "user3"):
+        print("   [FAIL] Member not added")
+        return False
+    if chat_inbox.add_member("chat_a", "user3")[0]:
+        print("   [FAIL] Member added twice")
+        return False
+    if [c["chat_id"] for c in chat_inbox.list_chats("user3")[0]] != ["chat_a"]:
+        print("   [FAIL] Added member's loaded inbox not updated")
+        return False
+    print("   [OK] Member added to the chat and their inbox")
+    
+    print("3. Testing removing a member...")
+    success, _ = chat_inbox.remove_member("chat_a", "user2")
+    if not success or membership.is_member("chat_a", "user2"):
+        print("   [FAIL] Member not removed")
+        return False
+    if chat_inbox.remove_member("chat_a", "user2")[0] or chat_inbox.list_chats("user2")[0]:
+        print("   [FAIL] Removed member still listed")
+        return False
+    print("   [OK] Member removed from the chat and their inbox")
+    
+    print("4. Testing membership reloaded from disk...")
+    reloaded = MembershipRegistry(user_manager)
+    if reloaded.get_members("chat_a") != ("user1", "user3"):
+        print("   [FAIL] Reloaded members incorrect")
+        return False
+    if reloaded.get_user_chats("user2") != [] or reloaded.get_user_chats("user3") != ["chat_a"]:
+        print("   [FAIL] Reloaded user chats incorrect")
+        return False
+    if reloaded.get_chat("chat_a")["created_by"] != "user1":
+        print("   [FAIL] Chat creator not stored")
+        return False
+    print("   [OK] Members and user chats replayed from disk")
+    
+    print("5. Testing unloading...")
+    reloaded.unload_chat("chat_a")
+    reloaded.unload_user("user3")
+    if reloaded.loaded_count() != (0, 1) or not reloaded.is_member("chat_a", "user3"):
+        print("   [FAIL] Unloading incorrect")
+        return False
+    print("   [OK] Unloaded chats reloaded on demand")
+    
+    print("6. Testing idle memberships are evicted...")
+    import time
+    now = time.monotonic()
+    reloaded.get_user_chats("user1")
+    if reloaded.evict_idle(idle_timeout=30, now=now + 10) != (0, 0):
+        print("   [FAIL] Recently used memberships evicted")
+        return False
+    if reloaded.evict_idle(idle_timeout=30, now=now + 60) == (0, 0) or reloaded.loaded_count() != (0, 0):
+        print(f"   [FAIL] Idle memberships not evicted: {reloaded.loaded_count()}")
+        return False
+    if reloaded.get_members("chat_a") != ("user1", "user3") or reloaded.get_user_chats("user1") != ["chat_a"]:
+        print("   [FAIL] Evicted memberships not reloaded")
+        return False
+    print("   [OK] Idle chats and chat lists dropped and reloaded on demand")
+    
+    # Clean up test data
+    shutil.rmtree("test_data")
+    print("   [OK] Test data cleaned up")
+    
+    print("\nAll membership tests passed!")
+    return True
+
+def test_membership_events():
+    """Test that the Socket.IO handlers enforce chat membership"""
+    print("\nTesting chat membership events...")
+    
+    # The app keeps its data where CHAT_DATA_DIR points when it is imported
+    import shutil
+    import importlib
+    if os.path.exists("test_app_data"):
+        shutil.rmtree("test_app_data")
+    os.environ["CHAT_DATA_DIR"] = "test_app_data"
+    server = importlib.import_module("app")
+    server.rate_limiter.limits = {}
+    
+    clients = {}
+    for username in ("alice", "bob", "carol"):
+        server.user_manager.register_user(username, "password123")
+        client = server.socketio.test_client(server.app)
+        client.emit("login", {"username": username, "password": "password123"})
+        client.get_received()
+        clients[username] = client
+    
+    def received(username, event):
+        return [packet["args"][0] for packet in clients[username].get_received() if packet["name"] == event]
+    
+    clients["alice"].emit("start_chat", {"participants": ["bob"]})
+    chat_id = received("alice", "chat_started")[0]["chat_id"]
+    clients["bob"].get_received()
+    
+    print("1. Testing non-members are rejected...")
+    clients["carol"].emit("join_chat", {"chat_id": chat_id})
+    rejected = received("carol", "chat_error")
+    clients["carol"].emit("send_message", {"chat_id": chat_id, "encrypted_message": "x"})
+    rejected += received("carol", "message_error")
+    clients["carol"].emit("get_chat_history", {"chat_id": chat_id})
+    rejected += received("carol", "chat_history_error")
+    clients["carol"].emit("get_chat_key", {"chat_id": chat_id})
+    rejected += received("carol", "chat_error")
+    if [error["message"] for error in rejected] != ["Chat not found"] * 4:
+        print(f"   [FAIL] Non-member not rejected: {rejected}")
+        return False
+    clients["bob"].emit("join_chat", {"chat_id": chat_id})
+    if not received("bob", "joined_chat"):
+        print("   [FAIL] Member could not join")
+        return False
+    print("   [OK] join_chat, send_message, get_chat_history and get_chat_key check membership")
+    
+    print("2. Testing any member can add others...")
+    clients["bob"].emit("add_chat_member", {"chat_id": chat_id, "username": "carol"})
+    carol_keys = received("carol", "aes_key")
+    clients["carol"].emit("get_chat_history", {"chat_id": chat_id})
+    if not carol_keys or not received("carol", "chat_history"):
+        print("   [FAIL] Added member got no key or history")
+        return False
+    if received("alice", "chat_members")[-1]["members"] != ["bob", "alice", "carol"]:
+        print("   [FAIL] Members not sent to the room")
+        return False
+    clients["carol"].emit("get_chat_key", {"chat_id": chat_id})
+    if received("carol", "aes_key") != carol_keys:
+        print("   [FAIL] Member could not fetch the chat key again")
+        return False
+    print("   [OK] Added member gets the key, can fetch it again and can read the chat")
+    
+    for i in range(3):
+        clients["alice"].emit("send_message", {"chat_id": chat_id, "encrypted_message": f"msg_{i}"})
+    page_size = server.MAX_HISTORY_PAGE_SIZE
+    server.MAX_HISTORY_PAGE_SIZE = 2
+    clients["carol"].get_received()
+    clients["carol"].emit("get_chat_history", {"chat_id": chat_id})
+    clients["carol"].emit("get_chat_history", {"chat_id": chat_id, "limit": 1000000})
+    pages = received("carol", "chat_history")
+    server.MAX_HISTORY_PAGE_SIZE = page_size
+    if [[m["seq"] for m in page["messages"]] for page in pages] != [[1, 2]] * 2 or not pages[0]["has_more"]:
+        print(f"   [FAIL] History page size not bounded: {pages}")
+        return False
+    print("   [OK] History pages are bounded with or without a limit")
+    
+    print("3. Testing only the creator can remove others...")
+    clients["bob"].emit("remove_chat_member", {"chat_id": chat_id, "username": "carol"})
+    if not received("bob", "chat_error") or not server.membership.is_member(chat_id, "carol"):
+        print("   [FAIL] Non-creator removed another member")
+        return False
+    clients["alice"].emit("remove_chat_member", {"chat_id": chat_id, "username": "carol"})
+    clients["carol"].emit("send_message", {"chat_id": chat_id, "encrypted_message": "x"})
+    if not received("carol", "removed_from_chat") or server.membership.is_member(chat_id, "carol"):
+        print("   [FAIL] Creator could not remove a member")
+        return False
+    clients["bob"].emit("remove_chat_member", {"chat_id": chat_id, "username": "bob"})
+    if server.membership.get_members(chat_id) != ("alice",):
+        print("   [FAIL] Member could not leave")
+        return False
+    print("   [OK] Creator removes others, members remove themselves")
+    
+    print("4. Testing a removed member gets no key at their next login...")
+    clients["carol"].disconnect()
+    clients["alice"].emit("add_chat_member", {"chat_id": chat_id, "username": "carol"})
+    if not server.user_manager.load_wrapped_keys("carol")[chat_id][1]:
+        print("   [FAIL] Offline member's key not pending")
+        return False
+    clients["alice"].emit("remove_chat_member", {"chat_id": chat_id, "username": "carol"})
+    if chat_id in server.user_manager.load_wrapped_keys("carol"):
+        print("   [FAIL] Removed member's key left in their key ring")
+        return False
+    # A key wrapped by an add that raced the removal
+    server.key_fanout.fanout(chat_id, server.get_chat_key(chat_id, "alice"), ["carol"])
+    clients["carol"] = server.socketio.test_client(server.app)
+    clients["carol"].emit("login", {"username": "carol", "password": "password123"})
+    if any(key["chat_id"] == chat_id for key in received("carol", "aes_key")):
+        print("   [FAIL] Removed member got the chat key at login")
+        return False
+    print("   [OK] Key ring entry dropped and login only delivers members' keys")
+    
+    for client in clients.values():
+        client.disconnect()
+    
+    # Clean up test data
+    shutil.rmtree("test_app_data")
+    print("   [OK] Test data cleaned up")
+    
+    print("\nAll membership event tests passed!")
+    return True
+
+def test_read_state():
+    """Test read cursors, unread counts and coalesced acknowledgements"""
+    print("\nTesting read state...")
+    
+    # Clean up any existing test data
+    import shutil
+    if os.path.exists("test_data"):
+        shutil.rmtree("test_data")
+    
+    user_manager = UserManager("test_data")
+    read_state = ReadStateManager(user_manager)
+    
+    print("1. Testing unread counts...")
+    if read_state.unread_count("user1", "chat_a", 9) != 10:
+        print("   [FAIL] Unread count without a cursor incorrect")
+        return False
+    read_state.ack("user1", "chat_a", 4)
+    if read_state.unread_count("user1", "chat_a", 9) != 5:
+        print("   [FAIL] Unread count after ack incorrect")
+        return False
+    print("   [OK] Unread counts follow the read cursor")
+    
+    print("2. Testing acks are coalesced...")
+    read_state.ack("user1", "chat_a", 7)
+    read_state.ack("user1", "chat_a", 6)
+    read_state.ack("user2", "chat_a", 3)
+    receipts = read_state.flush()
+    if receipts != {"chat_a": {"user1": 7, "user2": 3}}:
+        print(f"   [FAIL] Unexpected receipts: {receipts}")
+        return False
+    if read_state.flush() != {}:
+        print("   [FAIL] Receipts sent twice")
+        return False
+    print("   [OK] One receipt per user and chat per flush")
+    
+    print("3. Testing cursors persisted...")
+    read_state.unload("user1")
+    reloaded = ReadStateManager(user_manager)
+    if reloaded.get_cursor("user1", "chat_a") != 7 or reloaded.get_cursor("user2", "chat_b") != -1:
+        print("   [FAIL] Cursors not persisted")
+        return False
+    print("   [OK] Cursors persisted")
+    
+    # Clean up test data
+    shutil.rmtree("test_data")
+    print("   [OK] Test data cleaned up")
+    
+    print("\nAll read state tests passed!")
+    return True
+
+def test_session_state():
+    """Test compact session state and chat key eviction"""
+    print("\nTesting session state...")
+    
+    # Clean up any existing test data
+    import shutil
+    if os.path.exists("test_data"):
+        shutil.rmtree("test_data")
+    
+    user_manager = UserManager("test_data")
+    crypto_manager = CryptoManager()
+    user_manager.register_user("alice", "password123")
+    
+    print("1. Testing session registry...")
+    registry = SessionRegistry()
+    registry.add("sid1", "alice")
+    registry.add("sid2", "alice")
+    if registry.username("sid1") != "alice" or hasattr(registry.get("sid1"), "__dict__"):
+        print("   [FAIL] Session not registered as a slotted object")
+        return False
+    if registry.remove("sid1")[1] or not registry.remove("sid2")[1] or registry.user_sessions:
+        print("   [FAIL] Last session not detected")
+        return False
+    print("   [OK] Sessions tracked per connection and per user")
+    
+    print("2. Testing chat key eviction...")
+    keys = ChatKeyCache(max_size=2, idle_timeout=60)
+    keys.put("chat1", b"k1")
+    keys.put("chat2", b"k2")
+    keys.get("chat1")
+    keys.put("chat3", b"k3")
+    if keys.get("chat2") is not None or keys.get("chat1") != b"k1":
+        print("   [FAIL] Least recently used key not dropped")
+        return False
+    import time
+    keys._chats["chat1"].last_used = time.monotonic() - 120
+    keys._chats.move_to_end("chat1", last=False)
+    if keys.evict_idle() != ["chat1"] or len(keys) != 1:
+        print("   [FAIL] Idle key not evicted")
+        return False
+    print("   [OK] Keys bounded and evicted when idle")
+    
+    print("3. Testing lazy private key loading...")
+    private_keys = PrivateKeyCache(user_manager, crypto_manager)
+    aes_key = crypto_manager.generate_aes_key()
+    public_key = crypto_manager.deserialize_public_key(user_manager.get_user_public_key("alice"))
+    wrapped_key = crypto_manager.encrypt_aes_key(aes_key, public_key)
+    if len(private_keys) != 0 or crypto_manager.decrypt_aes_key(wrapped_key, private_keys.get("alice")) != aes_key:
+        print("   [FAIL] Private key not loaded on demand")
+        return False
+    private_keys.forget("alice")
+    if len(private_keys) != 0 or private_keys.get("nobody") is not None:
+        print("   [FAIL] Private key cache not cleared")
+        return False
+    print("   [OK] Private keys loaded on demand")
+    
+    # Clean up test data
+    shutil.rmtree("test_data")
+    print("   [OK] Test data cleaned up")
+    
+    print("\nAll session state tests passed!")
+    return True
+
+def test_traffic_recording():
+    """Test traffic trace recording, redaction and loading for replay"""
+    print("\nTesting traffic recording...")
+    
+    import replay
+    trace_file = "test_trace.jsonl"
+    if os.path.exists(trace_file):
+        os.remove(trace_file)
+    
+    recorder = TrafficRecorder(trace_file)
+    recorder.record_event('connect', 'sid-a', None, recorder.now(), 0)
+    recorder.record_event('login', 'sid-a', {'username': 'alice', 'password': 'password123'},
+                          recorder.now(), 0.04)
+    recorder.record_event('start_chat', 'sid-a', {'participants': ['bob']}, recorder.now(), 0.003,
+                          {'chat_id': 'chat-1'})
+    recorder.record_event('upload_attachment_chunk', 'sid-a',
+                          {'attachment_id': 'a1', 'data': b'\x01' * 100, 'sha256': 'ab' * 32},
+                          recorder.now(), 0.001)
+    recorder.record_event('send_message', 'sid-a', {'chat_id': 'chat-1', 'encrypted_message': 'secret'},
+                          recorder.now(), 0.001)
+    recorder.close()
+    
+    print("1. Testing redaction...")
+    with open(trace_file, 'r') as f:
+        text = f.read()
+    if 'password123' in text or 'secret' in text or 'AQEB' in text:
+        print("   [FAIL] Secrets or ciphertext written to the trace")
+        return False
+    print("   [OK] Passwords and ciphertext redacted")
+    
+    print("2. Testing trace loading...")
+    entries = replay.load_trace(trace_file)
+    if [e['name'] for e in entries] != ['connect', 'login', 'start_chat', 'upload_attachment_chunk', 'send_message']:
+        print("   [FAIL] Entries not loaded in order")
+        return False
+    chunk = replay.decode(entries[3]['data'])
+    message = replay.decode(entries[4]['data'])
+    if chunk['data'] != bytes(100) or chunk['sha256'] is not None or len(message['encrypted_message']) != 6:
+        print("   [FAIL] Redacted payloads not rebuilt at their original sizes")
+        return False
+    if replay.decode(entries[1]['data'])['password'] != replay.REPLAY_PASSWORD or entries[2]['ids'] != {'chat_id': 'chat-1'}:
+        print("   [FAIL] Login or created ids not replayable")
+        return False
+    print("   [OK] Trace loaded with placeholders of the original sizes")
+    
+    os.remove(trace_file)
+    print("\nAll traffic recording tests passed!")
+    return True
+
+def test_profiler():
+    """Test stack sampling and per-event cProfile output"""
+    print("\nTesting profiler...")
+    
+    import shutil
+    import time
+    import threading
+    if os.path.exists("test_profiles"):
+        shutil.rmtree("test_profiles")
+    profiler = Profiler("test_profiles")
+    
+    def busy_loop():
+        end = time.monotonic() + 0.3
+        while time.monotonic() < end:
+            sum(i * i for i in range(1000))
+    
+    print("1. Testing that nothing is profiled while off...")
+    if profiler.should_profile("send_message"):
+        print("   [FAIL] Event profiled while off")
+        return False
+    print("   [OK] Nothing profiled")
+    
+    print("2. Testing stack sampling...")
+    profiler.start_sampling(duration=0.2, interval=0.002)
+    worker = threading.Thread(target=busy_loop, name="busy-worker")
+    worker.start()
+    worker.join()
+    while profiler.status()['sampling']:
+        time.sleep(0.01)
+    samples_file = [f for f in os.listdir("test_profiles") if f.startswith("samples")][0]
+    with open(os.path.join("test_profiles", samples_file), 'r') as f:
+        stacks = f.read().splitlines()
+    if not any(line.startswith("busy-worker;") and "busy_loop" in line for line in stacks):
+        print("   [FAIL] Worker thread's stack not sampled")
+        return False
+    print(f"   [OK] {len(stacks)} distinct stacks sampled")
+    
+    print("3. Testing event profiling...")
+    profiler.profile_events({"send_message": 1.0}, duration=60)
+    for _ in range(3):
+        if profiler.should_profile("send_message"):
+            profiler.profile_call("send_message", busy_loop)
+    if profiler.should_profile("login"):
+        print("   [FAIL] Unselected event profiled")
+        return False
+    paths = profiler.finish_events()
+    collapsed = [p for p in paths if p.endswith(".collapsed")]
+    with open(collapsed[0], 'r') as f:
+        stacks = f.read().splitlines()
+    if len(paths) != 2 or not any("busy_loop" in line.split(";")[0] for line in stacks):
+        print("   [FAIL] Event profile not written as collapsed stacks")
+        return False
+    print("   [OK] Event profile written as .prof and collapsed stacks")
+    
+    print("4. Testing an expired window is finished by its timer...")
+    finishing_threads = []
+    finish_events = profiler.finish_events
+    
+    def record_finish():
+        finishing_threads.append(threading.current_thread())
+        return finish_events()
+    
+    profiler.finish_events = record_finish
+    profiler.profile_events({"send_message": 1.0}, duration=60)
+    # End the window early, as if its timer were about to fire
+    profiler._events_until = time.monotonic() - 1
+    if profiler.should_profile("send_message"):
+        print("   [FAIL] Event profiled after the window ended")
+        return False
+    timer = threading.Thread(target=profiler._finish_events_when_due)
+    timer.start()
+    timer.join()
+    if profiler.status()['events'] or threading.current_thread() in finishing_threads:
+        print("   [FAIL] Window not finished by its timer")
+        return False
+    print("   [OK] Results written by the timer, not by an event handler")
+    
+    print("5. Testing event profiling is refused under green threads...")
+    green_profiler = Profiler("test_profiles", async_mode="eventlet")
+    success, _ = green_profiler.profile_events({"send_message": 1.0}, duration=60)
+    if success or green_profiler.should_profile("send_message"):
+        print("   [FAIL] Event profiling started under eventlet")
+        return False
+    print("   [OK] Only stack sampling offered when handlers share a thread")
+    
+    shutil.rmtree("test_profiles")
+    print("\nAll profiler tests passed!")
+    return True
+
+def test_streaming_decryption():
+    """Test incremental decryption of legacy blobs and memory-mapped records"""
+    print("\nTesting streaming decryption...")
+    
+    # Clean up any existing test data
+    import shutil
+    if os.path.exists("test_data"):
+        shutil.rmtree("test_data")
+    
+    crypto_manager = CryptoManager()
+    user_manager = UserManager("test_data")
+    chat_store = ChatStore(user_manager, crypto_manager)
+    aes_key = crypto_manager.generate_aes_key()
+    messages = [{
+        'username': f"user{i % 2}",
+        'encrypted_message': "caf\u00e9 " * (i % 7),
+        'timestamp': f"2024-01-01T10:{i // 60:02d}:{i % 60:02d}"
+    } for i in range(200)]
+    encrypted_log = crypto_manager.encrypt_chat_log(messages, aes_key)
+    
+    print("1. Testing legacy blob streamed in small chunks...")
+    # Chunks this small split messages and multi-byte characters
+    for chunk_size in (16, 48, 1 << 20):
+        if list(crypto_manager.iter_decrypt_chat_log(encrypted_log, aes_key, chunk_size)) != messages:
+            print(f"   [FAIL] Streamed messages differ with chunk size {chunk_size}")
+            return False
+    print("   [OK] Streamed messages match")
+    
+    print("2. Testing records decrypted into a reused buffer...")
+    buffer = bytearray()
+    for text in ("a much longer message than the next one", "", "short"):
+        if crypto_manager.decrypt_record(crypto_manager.encrypt_message(text, aes_key), aes_key, buffer) != text:
+            print("   [FAIL] Record decryption incorrect")
+            return False
+    print("   [OK] Records decrypted")
+    
+    print("3. Testing legacy log upgrade and memory-mapped reads...")
+    user_manager.save_chat_log("legacy_chat", encrypted_log)
+    read_back = list(chat_store.iter_messages("legacy_chat", aes_key, range(200)))
+    if [{k: v for k, v in m.items() if k != 'seq'} for m in read_back] != messages:
+        print("   [FAIL] Upgraded log messages differ")
+        return False
+    if user_manager.chat_log_format("legacy_chat") != 'records':
+        print("   [FAIL] Legacy log not upgraded")
+        return False
+    print("   [OK] Upgraded log read back")
+    
+    print("4. Testing truncated and wrongly keyed logs are rejected...")
+    import json
+    # The last message ends exactly at the end of the input, with no ']'
+    truncated_log = crypto_manager.encrypt_message(json.dumps(messages)[:-1], aes_key)
+    for blob, key in ((truncated_log, aes_key), (encrypted_log, crypto_manager.generate_aes_key())):
+        try:
+            list(crypto_manager.iter_decrypt_chat_log(blob, key, 48))
+            print("   [FAIL] Bad log accepted")
+            return False
+        except ValueError:
+            pass
+    user_manager.save_chat_log("truncated_chat", truncated_log)
+    try:
+        chat_store.message_count("truncated_chat", aes_key)
+        print("   [FAIL] Truncated log upgraded")
+        return False
+    except ValueError:
+        pass
+    if user_manager.chat_log_format("truncated_chat") != 'legacy' or \
+            user_manager.load_chat_log("truncated_chat") != truncated_log:
+        print("   [FAIL] Truncated legacy log was replaced")
+        return False
+    print("   [OK] Bad logs raise and the legacy log is kept")
+    
+    # Clean up test data
+    shutil.rmtree("test_data")
+    print("   [OK] Test data cleaned up")
+    
+    print("\nAll streaming decryption tests passed!")
+    return True
+
+def test_stream_encryption():
+    """Test chunked streaming encryption and its integrity checks"""
+    print("\nTesting stream encryption...")
+    
+    import io
+    from crypto_utils import STREAM_HEADER
+    crypto_manager = CryptoManager()
+    aes_key = crypto_manager.generate_aes_key()
+    data = os.urandom(5000)
+    
+    print("1. Testing round trips...")
+    for chunk_size in (100, 1024, 8192):
+        encrypted = b''.join(crypto_manager.encrypt_stream(io.BytesIO(data), aes_key, chunk_size))
+        # Feed the ciphertext back in odd-sized pieces
+        pieces = [encrypted[i:i + 333] for i in range(0, len(encrypted), 333)]
+        if b''.join(crypto_manager.decrypt_stream(pieces, aes_key)) != data:
+            print(f"   [FAIL] Round trip failed with chunk size {chunk_size}")
+            return False
+    empty = b''.join(crypto_manager.encrypt_stream([], aes_key))
+    if b''.join(crypto_manager.decrypt_stream(io.BytesIO(empty), aes_key)) != b'':
+        print("   [FAIL] Empty stream round trip failed")
+        return False
+    print("   [OK] Streams round trip")
+    
+    print("2. Testing tampering is detected...")
+    encrypted = b''.join(crypto_manager.encrypt_stream([data], aes_key, 1024))
+    header_size = STREAM_HEADER.size
+    chunk = 1024 + 16
+    first, second = (encrypted[header_size + i * chunk:header_size + (i + 1) * chunk] for i in range(2))
+    tampered = {
+        'truncated': encrypted[:header_size + 2 * chunk],
+        'reordered': encrypted[:header_size] + second + first + encrypted[header_size + 2 * chunk:],
+        'extended': encrypted + b'\x00',
+        'modified': encrypted[:-1] + bytes([encrypted[-1] ^ 1]),
+    }
+    for name, stream in tampered.items():
+        try:
+            b''.join(crypto_manager.decrypt_stream([stream], aes_key))
+            print(f"   [FAIL] {name.capitalize()} stream accepted")
+            return False
+        except ValueError:
+            pass
+    print("   [OK] Truncated, reordered, extended and modified streams rejected")
+    
+    print("\nAll stream encryption tests passed!")
+    return True
+
+def test_attachment_store():
+    """Test chunked attachment uploads, content-addressed chunks and ranged reads"""
+    print("\nTesting attachment store...")
+    
+    # Clean up any existing test data
+    import io
+    import shutil
+    from attachment_store import ATTACHMENT_CHUNK_SIZE
+    if os.path.exists("test_data"):
+        shutil.rmtree("test_data")
+    
+    user_manager = UserManager("test_data")
+    attachment_store = AttachmentStore(user_manager)
+    chunk = os.urandom(ATTACHMENT_CHUNK_SIZE)
+    data = chunk + chunk + b"tail"
+    
+    print("1. Testing resumable upload...")
+    success, attachment_id = attachment_store.create_upload("user1", "chat_a", len(data))
+    if not success:
+        print(f"   [FAIL] Upload not created: {attachment_id}")
+        return False
+    attachment_store.put_chunk(attachment_id, 2, io.BytesIO(data[2 * ATTACHMENT_CHUNK_SIZE:]))
+    manifest = attachment_store.get_manifest(attachment_id)
+    if attachment_store.missing_chunks(manifest) != [0, 1]:
+        print("   [FAIL] Missing chunks incorrect")
+        return False
+    if attachment_store.complete_upload(attachment_id)[0]:
+        print("   [FAIL] Incomplete upload accepted")
+        return False
+    if attachment_store.put_chunk(attachment_id, 0, io.BytesIO(chunk[:-1]))[0]:
+        print("   [FAIL] Short chunk accepted")
+        return False
+    for index in (0, 1):
+        attachment_store.put_chunk(attachment_id, index, io.BytesIO(chunk))
+    if not attachment_store.complete_upload(attachment_id)[0]:
+        print("   [FAIL] Complete upload rejected")
+        return False
+    print("   [OK] Upload resumed and completed")
+    
+    print("2. Testing repeated ciphertext is stored once...")
+    stored = sum(len(files) for _, _, files in os.walk(attachment_store.chunks_dir))
+    if stored != 2:
+        print(f"   [FAIL] Expected 2 stored chunks, found {stored}")
+        return False
+    print("   [OK] Chunks stored by content")
+    
+    print("3. Testing a chunk racing completion...")
+    _, racing_id = attachment_store.create_upload("user1", "chat_a", 100)
+    attachment_store.put_chunk(racing_id, 0, io.BytesIO(os.urandom(100)))
+    
+    class CompletingStream(io.BytesIO):
+        def read(self, size=-1):
+            # The upload is completed while this chunk is being received
+            attachment_store.complete_upload(racing_id)
+            return super().read(size)
+    
+    before = attachment_store.get_manifest(racing_id)["chunks"]
+    success, message = attachment_store.put_chunk(racing_id, 0, CompletingStream(os.urandom(100)))
+    if success or attachment_store.get_manifest(racing_id)["chunks"] != before:
+        print("   [FAIL] Chunk rewrote a complete attachment")
+        return False
+    print("   [OK] Complete attachments can't be rewritten")
+    
+    print("4. Testing ranged reads...")
+    manifest = attachment_store.get_manifest(attachment_id)
+    start, end = ATTACHMENT_CHUNK_SIZE - 10, 2 * ATTACHMENT_CHUNK_SIZE + 2
+    if b''.join(attachment_store.iter_range(manifest, start, end)) != data[start:end]:
+        print("   [FAIL] Ranged read incorrect")
+        return False
+    if b''.join(attachment_store.iter_range(manifest, 0, len(data))) != data:
+        print("   [FAIL] Full read incorrect")
+        return False
+    print("   [OK] Ranges span chunks correctly")
+    
+    print("5. Testing access tokens...")
+    token = attachment_store.make_token(attachment_id, 'download')
+    if not attachment_store.check_token(attachment_id, 'download', token):
+        print("   [FAIL] Valid token rejected")
+        return False
+    if attachment_store.check_token(attachment_id, 'upload', token) or \
+            attachment_store.check_token(attachment_id, 'download', attachment_store.make_token(attachment_id, 'download', -1)):
+        print("   [FAIL] Wrong purpose or expired token accepted")
+        return False
+    print("   [OK] Tokens checked")
+    
+    # Clean up test data
+    shutil.rmtree("test_data")
+    print("   [OK] Test data cleaned up")
+    
+    print("\nAll attachment store tests passed!")
+    return True
+
+def test_backup():
+    """Test snapshots taken during writes, incremental snapshots and restore"""
+    print("\nTesting backup and restore...")
+    
+    # Clean up any existing test data
+    import shutil
+    import threading
+    for directory in ("test_data", "test_backups", "test_restore"):
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+    
+    user_manager = UserManager("test_data")
+    crypto_manager = CryptoManager()
+    chat_store = ChatStore(user_manager, crypto_manager)
+    chat_inbox = ChatInbox(user_manager, chat_store)
+    aes_key = crypto_manager.generate_aes_key()
+    chat_ids = [f"chat_{i}" for i in range(20)]
+    for chat_id in chat_ids:
+        chat_inbox.add_chat(chat_id, ["alice", "bob"], 1700000000.0)
+        chat_store.append_message(chat_id, {"username": "alice", "encrypted_message": "hello",
+                                            "timestamp": "2023-01-01T10:00:00"}, aes_key)
+    
+    print("1. Testing a snapshot taken while messages are sent...")
+    stop = threading.Event()
+    
+    def write():
+        i = 0
+        while not stop.is_set():
+            chat_store.append_message(chat_ids[i % len(chat_ids)], {
+                "username": "bob", "encrypted_message": f"m{i}", "timestamp": "2023-01-01T10:00:00"
+            }, aes_key)
+            i += 1
+    
+    writer = threading.Thread(target=write)
+    writer.start()
+    try:
+        summary = create_snapshot("test_data", "test_backups", workers=4)
+    finally:
+        stop.set()
+        writer.join()
+    success, message = restore_snapshot(summary['snapshot'], "test_restore", workers=4)
+    if not success:
+        print(f"   [FAIL] Restore failed: {message}")
+        return False
+    restored_manager = UserManager("test_restore")
+    restored_store = ChatStore(restored_manager, crypto_manager)
+    restored_inbox = ChatInbox(restored_manager, restored_store)
+    for chat_id in chat_ids:
+        # Every indexed message must be readable from the restored log
+        messages, _, _ = restored_store.query(chat_id, aes_key)
+        if not messages or [m["seq"] for m in messages] != list(range(len(messages))):
+            print(f"   [FAIL] {chat_id} restored incompletely")
+            return False
+        if restored_inbox.get_participants(chat_id) != ("alice", "bob"):
+            print(f"   [FAIL] {chat_id} metadata missing after restore")
+            return False
+    print(f"   [OK] Snapshot of {summary['files']} files restored consistently")
+    
+    print("2. Testing incremental snapshot...")
+    # Catch up with the messages sent during the first snapshot
+    create_snapshot("test_data", "test_backups")
+    chat_store.append_message("chat_3", {"username": "alice", "encrypted_message": "later",
+                                         "timestamp": "2023-01-01T11:00:00"}, aes_key)
+    with open(chat_store._index_file("chat_5"), 'a') as f:
+        f.write('[1, 2, 3')  # A torn append
+    summary = create_snapshot("test_data", "test_backups", workers=4)
+    if summary['base'] is None or summary['copied'] != 3 or summary['linked'] != summary['files'] - 3:
+        print(f"   [FAIL] Expected 3 changed files copied, got {summary}")
+        return False
+    snapshot_index = os.path.join(summary['snapshot'], "data", os.path.relpath(chat_store._index_file("chat_5"), "test_data"))
+    with open(snapshot_index, 'rb') as f:
+        if not f.read().endswith(b'\n'):
+            print("   [FAIL] Torn index line copied")
+            return False
+    if len(list_snapshots("test_backups")) != 3:
+        print("   [FAIL] Snapshots not listed")
+        return False
+    print("   [OK] Only changed files copied, torn lines left out")
+    
+    print("3. Testing restore safety...")
+    success, _ = restore_snapshot(summary['snapshot'], "test_restore")
+    if success:
+        print("   [FAIL] Restored over existing data")
+        return False
+    shutil.rmtree("test_restore")
+    success, message = restore_snapshot(summary['snapshot'], "test_restore")
+    messages, _, _ = ChatStore(UserManager("test_restore"), crypto_manager).query("chat_3", aes_key)
+    if not success or messages[-1]["encrypted_message"] != "later":
+        print(f"   [FAIL] Incremental snapshot restore: {message}")
+        return False
+    print("   [OK] Incremental snapshot restored, non-empty target refused")
+    
+    # Clean up test data
+    for directory in ("test_data", "test_backups", "test_restore"):
+        shutil.rmtree(directory)
+    print("   [OK] Test data cleaned up")
+    
+    print("\nAll backup tests passed!")
+    return True
+
 def main():
     """Run all tests"""
     print("Secure Chat App - E2EE Test Suite")
@@ -251,7 +1755,27 @@ def main():
     tests = [
         test_crypto_operations,
         test_user_management,
-        test_chat_log_encryption
+        test_user_directory_paging,
+        test_user_records,
+        test_password_hashing,
+        test_public_key_lookup,
+        test_chat_log_encryption,
+        test_sharded_chat_storage,
+        test_key_fanout,
+        test_rate_limiter,
+        test_chat_index,
+        test_concurrent_chat_writes,
+        test_chat_inbox,
+        test_membership,
+        test_membership_events,
+        test_read_state,
+        test_session_state,
+        test_traffic_recording,
+        test_profiler,
+        test_streaming_decryption,
+        test_stream_encryption,
+        test_attachment_store,
+        test_backup
     ]
     
     passed = 0
@@ -0,0 +1,169 @@
+import os
+import json
+import gzip
+import time
+import base64
+import threading
+from datetime import datetime
+
+TRACE_VERSION = 1
+
+# Fields holding ciphertext; redacted traces keep only their length
+CIPHERTEXT_FIELDS = {'encrypted_message', 'data'}
+# Fields that are never written to a trace
+SECRET_FIELDS = {'password'}
+# Request headers kept in HTTP records; tokens are kept as their length
+RECORDED_HEADERS = ('Range', 'If-None-Match', 'X-Upload-Token', 'X-Chunk-SHA256')
+TOKEN_HEADERS = {'X-Upload-Token'}
+# Buffered lines are written out at least this often
+FLUSH_INTERVAL = 1.0  # seconds
+
+def _encode(value, redact, key=None):
+    """Make an event payload JSON-safe, redacting secrets and ciphertext
+
+    Redacted strings become {"$redacted": length} and redacted bytes
+    {"$bytes": length}; bytes kept in full become {"$b64": base64}. A
+    chunk's sha256 is dropped along with its data, since it could not be
+    checked against the redacted bytes on replay.
+    """
+    if isinstance(value, dict):
+        encoded = {k: _encode(v, redact, k) for k, v in value.items()}
+        if redact and isinstance(value.get('data'), (bytes, bytearray)) and 'sha256' in value:
+            encoded['sha256'] = None
+        return encoded
+    if isinstance(value, (list, tuple)):
+        return [_encode(item, redact) for item in value]
+    if key in SECRET_FIELDS or (redact and key in CIPHERTEXT_FIELDS):
+        if isinstance(value, str):
+            return {'$redacted': len(value)}
+        if isinstance(value, (bytes, bytearray)):
+            return {'$bytes': len(value)}
+    if isinstance(value, (bytes, bytearray)):
+        return {'$b64': base64.b64encode(value).decode('ascii')}
+    return value
+
+def _payload_size(value):
+    """Get the approximate size of an event payload on the wire in bytes"""
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, dict):
+        return 2 + sum(len(k) + 4 + _payload_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return 2 + sum(_payload_size(item) + 1 for item in value)
+    return len(json.dumps(value))
+
+class TrafficRecorder:
+    """Append-only trace of inbound Socket.IO events and HTTP requests
+
+    Each line of the trace is a JSON object: a header first, then one entry
+    per event or request with its start time (seconds since recording
+    began), connection alias, name, payload size, handling time and
+    payload. Ciphertext is redacted unless redact is False, and passwords
+    and tokens always are. Traces ending in .gz are gzipped.
+    """
+
+    def __init__(self, path, redact=True):
+        self.path = path
+        self.redact = redact
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._aliases = {}  # {session_id: short alias}
+        self._alias_count = 0
+        self._flushed = self._start
+        if path.endswith('.gz'):
+            self._file = gzip.open(path, 'at')
+        else:
+            self._file = open(path, 'a', buffering=1 << 16)
+        self._write({'trace': TRACE_VERSION, 'started': datetime.now().isoformat(), 'redacted': redact})
+
+    @classmethod
+    def from_env(cls):
+        """Create a recorder from CHAT_RECORD_FILE and CHAT_RECORD_REDACT, or None"""
+        path = os.environ.get('CHAT_RECORD_FILE')
+        if not path:
+            return None
+        return cls(path, redact=os.environ.get('CHAT_RECORD_REDACT', '1') != '0')
+
+    def _write(self, entry):
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(line)
+            now = time.monotonic()
+            if now - self._flushed >= FLUSH_INTERVAL:
+                self._file.flush()
+                self._flushed = now
+
+    def now(self):
+        """Get the current time on the trace's clock"""
+        return time.monotonic() - self._start
+
+    def _alias(self, session_id):
+        alias = self._aliases.get(session_id)
+        if alias is None:
+            with self._lock:
+                alias = self._aliases.get(session_id)
+                if alias is None:
+                    self._alias_count += 1
+                    alias = self._aliases[session_id] = f"s{self._alias_count}"
+        return alias
+
+    def record_event(self, name, session_id, data, started, duration, ids=None):
+        """Record a Socket.IO event that started at trace time started
+
+        ids maps names of ids the server created while handling the event
+        to their values, so a replay can map them to the ids it gets back.
+        """
+        entry = {
+            't': round(started, 6),
+            'kind': 'event',
+            'sid': self._alias(session_id),
+            'name': name,
+            'size': _payload_size(data) if data is not None else 0,
+            'ms': round(duration * 1000, 3),
+            'data': _encode(data, self.redact)
+        }
+        if ids:
+            entry['ids'] = ids
+        self._write(entry)
+        if name == 'disconnect':
+            with self._lock:
+                self._aliases.pop(session_id, None)
+
+    def record_http(self, request, status, started, duration):
+        """Record a Flask request after its response status is known"""
+        headers = {}
+        for header in RECORDED_HEADERS:
+            value = request.headers.get(header)
+            if value is not None:
+                headers[header] = {'$redacted': len(value)} if header in TOKEN_HEADERS else value
+        query = {key: {'$redacted': len(value)} if key == 'token' else value
+                 for key, value in request.args.items()}
+
+        body = None
+        if request.is_json:
+            body = _encode(request.get_json(silent=True), self.redact)
+        elif request.content_length:
+            # Raw bodies are streamed to disk, so only their size is known
+            body = {'$bytes': request.content_length}
+
+        self._write({
+            't': round(started, 6),
+            'kind': 'http',
+            'name': f"{request.method} {request.url_rule.rule if request.url_rule else request.path}",
+            'method': request.method,
+            'path': request.path,
+            'query': query,
+            'headers': headers,
+            'size': request.content_length or 0,
+            'status': status,
+            'ms': round(duration * 1000, 3),
+            'body': body
+        })
+
+    def close(self):
+        """Write out buffered lines and close the trace"""
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
@@ -0,0 +1,118 @@
+import os
+import heapq
+from bisect import bisect_left, bisect_right, insort
+
+# Registrations are journaled and merged into the sorted base file once
+# this many have accumulated
+DIRECTORY_COMPACT_THRESHOLD = 4096
+
+class UserDirectory:
+    """Sorted set of all usernames, packed to a few bytes per user
+
+    The base is the directory file as one bytes object of UTF-8 usernames,
+    each followed by a newline, in sorted order (UTF-8 byte order matches
+    str order), searched by bisecting on line boundaries. Usernames added
+    since the base was written live in a journal file and a small sorted
+    list, and are merged into the base once enough have accumulated.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.journal_path = path + '.log'
+        self.base = b''
+        self.base_count = 0
+        self.recent = []
+
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                self.base = f.read()
+            self.base_count = self.base.count(b'\n')
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'rb') as f:
+                for line in f:
+                    # Skip a torn final line from an interrupted append
+                    if line.endswith(b'\n'):
+                        username = line[:-1].decode('utf-8')
+                        if username not in self:
+                            insort(self.recent, username)
+
+    @classmethod
+    def create(cls, path, usernames):
+        """Write a new directory holding the given usernames"""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(b''.join(username.encode('utf-8') + b'\n' for username in sorted(set(usernames))))
+        os.replace(tmp_path, path)
+        if os.path.exists(path + '.log'):
+            os.remove(path + '.log')
+        return cls(path)
+
+    def _base_position(self, key):
+        """Get the offset of the first base line at or after key (UTF-8 bytes)"""
+        base = self.base
+        lo, hi = 0, len(base)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = base.rfind(b'\n', lo, mid) + 1 or lo
+            end = base.index(b'\n', start)
+            if base[start:end] < key:
+                lo = end + 1
+            else:
+                hi = start
+        return lo
+
+    def __contains__(self, username):
+        key = username.encode('utf-8')
+        if self.base.startswith(key + b'\n', self._base_position(key)):
+            return True
+        i = bisect_left(self.recent, username)
+        return i < len(self.recent) and self.recent[i] == username
+
+    def __len__(self):
+        return self.base_count + len(self.recent)
+
+    def _iter_base(self, position=0):
+        """Yield base usernames from a line offset onwards"""
+        base = self.base
+        while position < len(base):
+            end = base.index(b'\n', position)
+            yield base[position:end].decode('utf-8')
+            position = end + 1
+
+    def __iter__(self):
+        return heapq.merge(self._iter_base(), self.recent)
+
+    def add(self, username):
+        """Add a username, which must not contain line breaks"""
+        with open(self.journal_path, 'ab') as f:
+            f.write(username.encode('utf-8') + b'\n')
+        insort(self.recent, username)
+        if len(self.recent) >= DIRECTORY_COMPACT_THRESHOLD:
+            self.compact()
+
+    def compact(self):
+        """Merge the journaled usernames into the base file"""
+        merged = b''.join(username.encode('utf-8') + b'\n' for username in self)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(merged)
+        os.replace(tmp_path, self.path)
+        os.remove(self.journal_path)
+        self.base = merged
+        self.base_count += len(self.recent)
+        self.recent = []
+
+    def page(self, cursor=None, limit=100):
+        """Get up to limit usernames after cursor in order, and whether more follow"""
+        if cursor is None:
+            position, start = 0, 0
+        else:
+            key = cursor.encode('utf-8')
+            position = self._base_position(key)
+            if self.base.startswith(key + b'\n', position):
+                position += len(key) + 1
+            start = bisect_right(self.recent, cursor)
+
+        usernames = heapq.merge(self._iter_base(position), self.recent[start:start + limit + 1])
+        page = [username for _, username in zip(range(limit + 1), usernames)]
+        return page[:limit], len(page) > limit
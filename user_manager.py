@@ -1,59 +1,199 @@
 import json
 import os
 import base64
+import contextlib
 import hashlib
+import mmap
 import secrets
+import struct
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
 from crypto_utils import CryptoManager
+from password_hasher import PasswordHasher, DEFAULT_PASSWORD_PROFILE
+from user_directory import UserDirectory
+from storage_layout import sharded_path, is_sharded, migrate_file
+
+# Chat logs starting with this header hold length-prefixed encrypted records;
+# older logs are a single encrypted JSON blob
+CHAT_LOG_MAGIC = b'CHATLOG1'
+RECORD_HEADER = struct.Struct('>I')
+
+# User records kept in memory at most; the rest are read from disk on demand
+USER_CACHE_SIZE = 1024
+
+# How often to look again for flat-layout files while a migration runs
+SHARD_RECHECK_INTERVAL = 60  # seconds
 
 class UserManager:
-    """Manages user registration, authentication, and key storage"""
+    """Manages user registration, authentication, and key storage
+    
+    Each user's record (keys, password hash, friends) is its own JSON file
+    under data/users, fanned out into subdirectories by the hash of the
+    username. Only the packed UserDirectory of usernames is loaded at
+    startup; records are read on demand and kept in a bounded LRU cache.
+    """
     
-    def __init__(self, data_dir="data"):
+    def __init__(self, data_dir="data", cache_size=USER_CACHE_SIZE, password_profile=DEFAULT_PASSWORD_PROFILE):
         self.data_dir = data_dir
         self.crypto_manager = CryptoManager()
+        self.password_hasher = PasswordHasher(password_profile)
         self.users_file = os.path.join(data_dir, "users.json")
+        self.users_dir = os.path.join(data_dir, "users")
         self.chat_logs_dir = os.path.join(data_dir, "chat_logs")
+        self.wrapped_keys_dir = os.path.join(data_dir, "wrapped_keys")
         
         # Create directories if they don't exist
         os.makedirs(data_dir, exist_ok=True)
+        os.makedirs(self.users_dir, exist_ok=True)
         os.makedirs(self.chat_logs_dir, exist_ok=True)
+        os.makedirs(self.wrapped_keys_dir, exist_ok=True)
+        
+        # Guard key ring appends against concurrent rewrites, striped by user
+        self._key_ring_locks = [threading.Lock() for _ in range(64)]
+        # Guard read-modify-write of user records, striped by user
+        self._record_locks = [threading.Lock() for _ in range(64)]
+        self._directory_lock = threading.Lock()
+        self._sharded_dirs = set()
+        self._shard_rechecks = {}  # {directory: monotonic time of next check}
+        
+        # Recently used user records: {username: record}
+        self.cache_size = cache_size
+        self._record_cache = OrderedDict()
+        self._cache_lock = threading.Lock()
         
         # Load existing users
-        self.users = self._load_users()
-    
-    def _load_users(self):
-        """Load users from file"""
-        if os.path.exists(self.users_file):
-            try:
-                with open(self.users_file, 'r') as f:
-                    return json.load(f)
-            except (json.JSONDecodeError, FileNotFoundError):
-                return {}
-        return {}
-    
-    def _save_users(self):
-        """Save users to file"""
-        with open(self.users_file, 'w') as f:
-            json.dump(self.users, f, indent=2)
+        self.directory = self._load_directory()
+        
+        # Version counters for the user directory and each friend list, so
+        # clients can revalidate cached lists; the epoch keeps versions from
+        # before a restart from matching
+        self.version_epoch = secrets.token_hex(4)
+        self.directory_version = 0
+        self._friends_versions = {}
+    
+    def _load_directory(self):
+        """Load the username directory, migrating a legacy users.json first"""
+        directory_file = os.path.join(self.users_dir, "directory")
+        if os.path.exists(self.users_file) and not os.path.exists(directory_file):
+            self._migrate_users_file(directory_file)
+        return UserDirectory(directory_file)
+    
+    def _migrate_users_file(self, directory_file):
+        """Split a legacy users.json into per-user records"""
+        try:
+            with open(self.users_file, 'r') as f:
+                users = json.load(f)
+        except json.JSONDecodeError:
+            users = {}
+        
+        usernames = []
+        for username, record in users.items():
+            if '\n' in username or '\r' in username:
+                print(f"Skipping user with a line break in its name: {username!r}")
+                continue
+            self._save_record(dict(record, username=username))
+            usernames.append(username)
+        UserDirectory.create(directory_file, usernames)
+        
+        # Keep the old file around instead of deleting user data
+        os.replace(self.users_file, self.users_file + '.migrated')
+        print(f"Migrated {len(usernames)} users to per-user records")
+    
+    def _record_file(self, username):
+        """Get the path of a user's record, in one of 256 subdirectories"""
+        name = hashlib.sha256(username.encode('utf-8')).hexdigest()
+        return os.path.join(self.users_dir, name[:2], f"{name}.json")
+    
+    def _record_lock(self, username):
+        """Get the lock stripe guarding a user's record"""
+        return self._record_locks[hash(username) % len(self._record_locks)]
+    
+    def _get_record(self, username):
+        """Get a user's record from the cache or disk, or None for unknown users"""
+        with self._cache_lock:
+            record = self._record_cache.get(username)
+            if record is not None:
+                self._record_cache.move_to_end(username)
+                return record
+        
+        if username not in self.directory:
+            return None
+        try:
+            with open(self._record_file(username), 'r') as f:
+                record = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        # A record saved while this one was being read is newer, so keep it
+        return self._cache_record(record, replace=False)
+    
+    def _cache_record(self, record, replace=True):
+        """Add a record to the LRU cache, evicting the least recently used
+        
+        Returns the cached record.
+        """
+        username = record['username']
+        with self._cache_lock:
+            if replace or username not in self._record_cache:
+                self._record_cache[username] = record
+            record = self._record_cache[username]
+            self._record_cache.move_to_end(username)
+            while len(self._record_cache) > self.cache_size:
+                self._record_cache.popitem(last=False)
+            return record
+    
+    def _save_record(self, record):
+        """Atomically write a user's record and update the cache"""
+        record_file = self._record_file(record['username'])
+        os.makedirs(os.path.dirname(record_file), exist_ok=True)
+        tmp_file = record_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp_file, record_file)
+        self._cache_record(record)
+    
+    def add_user_record(self, record):
+        """Store a complete user record and list it in the directory
+        
+        Returns False if the username is taken.
+        """
+        username = record['username']
+        with self._directory_lock:
+            if username in self.directory:
+                return False
+            self._save_record(record)
+            self.directory.add(username)
+            self.directory_version += 1
+        return True
     
     def _hash_password(self, password):
-        """Hash password with salt"""
-        salt = secrets.token_hex(16)
-        password_hash = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt.encode('utf-8'), 100000)
-        return salt + password_hash.hex()
+        """Hash password with salt, using the current password profile"""
+        return self.password_hasher.hash(password)
     
     def _verify_password(self, password, stored_hash):
         """Verify password against stored hash"""
-        salt = stored_hash[:32]  # First 32 chars are salt
-        password_hash = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt.encode('utf-8'), 100000)
-        return stored_hash == salt + password_hash.hex()
+        return self.password_hasher.verify(password, stored_hash)
+    
+    def _rehash_password(self, username, password, stored_hash):
+        """Replace a hash made with an outdated profile after a successful login"""
+        new_hash = self._hash_password(password)
+        with self._record_lock(username):
+            record = self._get_record(username)
+            # Leave it if the password changed while this login was checked
+            if record is None or record.get('password_hash') != stored_hash:
+                return
+            self._save_record(dict(record, password_hash=new_hash))
+        print(f"Upgraded password hash for {username} to the {self.password_hasher.profile} profile")
 
     def register_user(self, username, password):
         """Register a new user with RSA key pair and password"""
-        if username in self.users:
+        if username in self.directory:
             return False, "Username already exists"
         
+        if '\n' in username or '\r' in username:
+            return False, "Username cannot contain line breaks"
+        
         if len(password) < 6:
             return False, "Password must be at least 6 characters"
         
@@ -68,8 +208,10 @@ class UserManager:
         password_hash = self._hash_password(password)
         
         # Store user data
-        self.users[username] = {
+        record = {
+            "username": username,
             "public_key": public_key_pem,
+            "public_key_fingerprint": self.crypto_manager.public_key_fingerprint(public_key_pem),
             "private_key": private_key_pem,
             "password_hash": password_hash,
             "created_at": datetime.now().isoformat(),
@@ -77,91 +219,348 @@ class UserManager:
             "friends": []
         }
         
-        self._save_users()
+        if not self.add_user_record(record):
+            return False, "Username already exists"
         return True, "User registered successfully"
     
     def get_user_public_key(self, username):
         """Get user's public key"""
-        if username not in self.users:
+        record = self._get_record(username)
+        if record is None:
             return None
-        return self.users[username]["public_key"]
+        return record["public_key"]
+    
+    def _public_key_fingerprint(self, record):
+        """Get a record's public key fingerprint, storing it in records from before fingerprints"""
+        fingerprint = record.get("public_key_fingerprint")
+        if fingerprint is None:
+            username = record["username"]
+            with self._record_lock(username):
+                record = self._get_record(username)
+                fingerprint = record.get("public_key_fingerprint")
+                if fingerprint is None:
+                    fingerprint = self.crypto_manager.public_key_fingerprint(record["public_key"])
+                    self._save_record(dict(record, public_key_fingerprint=fingerprint))
+        return fingerprint
+    
+    def get_public_key_fingerprint(self, username):
+        """Get the SHA-256 fingerprint of a user's public key, or None for unknown users"""
+        record = self._get_record(username)
+        if record is None:
+            return None
+        return self._public_key_fingerprint(record)
+    
+    def get_public_keys(self, usernames, known=None):
+        """Look up several users' public keys, skipping those the caller has
+        
+        known maps usernames to the fingerprints of keys the caller already
+        holds. Returns ({username: {'public_key', 'fingerprint'}} for keys
+        that are missing or changed, list of unknown usernames).
+        """
+        known = known or {}
+        keys = {}
+        unknown = []
+        for username in dict.fromkeys(usernames):
+            record = self._get_record(username)
+            if record is None:
+                unknown.append(username)
+                continue
+            fingerprint = self._public_key_fingerprint(record)
+            if known.get(username) != fingerprint:
+                keys[username] = {'public_key': record["public_key"], 'fingerprint': fingerprint}
+        return keys, unknown
     
     def get_user_private_key(self, username):
         """Get user's private key"""
-        if username not in self.users:
+        record = self._get_record(username)
+        if record is None:
             return None
-        return self.users[username]["private_key"]
+        return record["private_key"]
     
     def update_last_seen(self, username):
         """Update user's last seen timestamp"""
-        if username in self.users:
-            self.users[username]["last_seen"] = datetime.now().isoformat()
-            self._save_users()
+        with self._record_lock(username):
+            record = self._get_record(username)
+            if record is not None:
+                self._save_record(dict(record, last_seen=datetime.now().isoformat()))
     
     def get_all_users(self):
         """Get list of all registered users"""
-        return list(self.users.keys())
+        return list(self.directory)
     
     def user_exists(self, username):
         """Check if user exists"""
-        return username in self.users
+        return username in self.directory
+    
+    def chat_data_file(self, directory, chat_id, extension, create=False):
+        """Get the path of a per-chat file in a data directory
+        
+        Files are fanned out into hashed subdirectories (see storage_layout).
+        Until a directory is fully migrated from the old flat layout, a
+        file still at its flat path is moved into place first. create makes
+        the parent directory for writers.
+        """
+        file_name = f"{chat_id}{extension}"
+        if directory not in self._sharded_dirs:
+            now = time.monotonic()
+            if now >= self._shard_rechecks.get(directory, 0):
+                if is_sharded(directory):
+                    self._sharded_dirs.add(directory)
+                else:
+                    self._shard_rechecks[directory] = now + SHARD_RECHECK_INTERVAL
+            if directory not in self._sharded_dirs:
+                migrate_file(directory, file_name)
+        path = sharded_path(directory, file_name)
+        if create:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+    
+    def _chat_log_file(self, chat_id, create=False):
+        """Get the path of a chat's log file"""
+        return self.chat_data_file(self.chat_logs_dir, chat_id, ".enc", create)
     
     def save_chat_log(self, chat_id, encrypted_data):
         """Save encrypted chat log to file"""
-        log_file = os.path.join(self.chat_logs_dir, f"{chat_id}.enc")
+        log_file = self._chat_log_file(chat_id, create=True)
         with open(log_file, 'wb') as f:
             f.write(encrypted_data)
     
     def load_chat_log(self, chat_id):
         """Load encrypted chat log from file"""
-        log_file = os.path.join(self.chat_logs_dir, f"{chat_id}.enc")
+        log_file = self._chat_log_file(chat_id)
         if os.path.exists(log_file):
             with open(log_file, 'rb') as f:
                 return f.read()
         return None
     
+    def chat_log_format(self, chat_id):
+        """Get a chat log's format: 'records', 'legacy' or None if missing"""
+        log_file = self._chat_log_file(chat_id)
+        if not os.path.exists(log_file):
+            return None
+        with open(log_file, 'rb') as f:
+            return 'records' if f.read(len(CHAT_LOG_MAGIC)) == CHAT_LOG_MAGIC else 'legacy'
+    
+    def append_chat_record(self, chat_id, payload):
+        """Append an encrypted record to a chat log and return its offset"""
+        with open(self._chat_log_file(chat_id, create=True), 'ab') as f:
+            if f.tell() == 0:
+                f.write(CHAT_LOG_MAGIC)
+            offset = f.tell()
+            f.write(RECORD_HEADER.pack(len(payload)) + payload)
+        return offset
+    
+    def write_chat_records(self, chat_id, payloads):
+        """Replace a chat log with the given records and return their (offset, length)"""
+        log_file = self._chat_log_file(chat_id, create=True)
+        tmp_file = log_file + '.tmp'
+        spans = []
+        try:
+            with open(tmp_file, 'wb') as f:
+                f.write(CHAT_LOG_MAGIC)
+                for payload in payloads:
+                    spans.append((f.tell(), len(payload)))
+                    f.write(RECORD_HEADER.pack(len(payload)) + payload)
+        except BaseException:
+            # The old log is only replaced once every record is written
+            os.remove(tmp_file)
+            raise
+        os.replace(tmp_file, log_file)
+        return spans
+    
+    @contextlib.contextmanager
+    def open_chat_log(self, chat_id):
+        """Memory-map a chat log read-only, yielding None if it doesn't exist
+        
+        The mapping covers the log as it was when opened, and any memoryviews
+        taken from it must be released before the context exits.
+        """
+        log_file = self._chat_log_file(chat_id)
+        if not os.path.exists(log_file):
+            yield None
+            return
+        
+        with open(log_file, 'rb') as f:
+            # Empty files can't be mapped
+            if os.fstat(f.fileno()).st_size == 0:
+                yield b''
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                yield mapped
+    
+    def iter_chat_records(self, chat_id, spans):
+        """Yield the payloads of the records at the given (offset, length) spans
+        
+        Payloads are memoryviews into the memory-mapped log rather than
+        copies, and each one is released as soon as the next is requested,
+        so consumers must decrypt or copy a payload before moving on.
+        """
+        with self.open_chat_log(chat_id) as mapped:
+            if mapped is None:
+                return
+            with memoryview(mapped) as view:
+                for offset, length in spans:
+                    start = offset + RECORD_HEADER.size
+                    with view[start:start + length] as payload:
+                        yield payload
+    
+    def user_data_file(self, directory, username, extension):
+        """Get the path of a per-user file in a data directory"""
+        # Usernames are user-supplied, so hash them into a safe file name
+        name = hashlib.sha256(username.encode('utf-8')).hexdigest()
+        return os.path.join(directory, f"{name}{extension}")
+    
+    def _key_ring_file(self, username):
+        """Get the path of a user's wrapped key ring"""
+        return self.user_data_file(self.wrapped_keys_dir, username, ".jsonl")
+    
+    def _key_ring_lock(self, username):
+        """Get the lock stripe guarding a user's key ring"""
+        return self._key_ring_locks[hash(username) % len(self._key_ring_locks)]
+    
+    def store_wrapped_key(self, username, chat_id, wrapped_key, pending=False):
+        """Append an RSA-wrapped chat key to a user's key ring"""
+        entry = {
+            'chat_id': chat_id,
+            'wrapped_key': base64.b64encode(wrapped_key).decode('utf-8'),
+            'pending': pending
+        }
+        with self._key_ring_lock(username):
+            with open(self._key_ring_file(username), 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+    
+    def load_wrapped_keys(self, username):
+        """Load a user's key ring as {chat_id: (wrapped_key, pending)}"""
+        key_ring_file = self._key_ring_file(username)
+        if not os.path.exists(key_ring_file):
+            return {}
+        
+        wrapped_keys = {}
+        with open(key_ring_file, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                wrapped_keys[entry['chat_id']] = (
+                    base64.b64decode(entry['wrapped_key']),
+                    entry.get('pending', False)
+                )
+        return wrapped_keys
+    
+    def mark_wrapped_keys_delivered(self, username, chat_ids):
+        """Clear the pending flag on the keys of the given chats in a user's key ring
+        
+        Only the chats whose keys were actually sent are cleared, so a key
+        stored after the caller read the key ring stays pending.
+        """
+        chat_ids = set(chat_ids)
+        with self._key_ring_lock(username):
+            wrapped_keys = self.load_wrapped_keys(username)
+            if not chat_ids & wrapped_keys.keys():
+                return
+            
+            self._write_key_ring(username, {
+                chat_id: (wrapped_key, pending and chat_id not in chat_ids)
+                for chat_id, (wrapped_key, pending) in wrapped_keys.items()
+            })
+    
+    def remove_wrapped_key(self, username, chat_id):
+        """Drop a chat's key from a user's key ring, e.g. when they leave the chat"""
+        with self._key_ring_lock(username):
+            wrapped_keys = self.load_wrapped_keys(username)
+            if wrapped_keys.pop(chat_id, None) is None:
+                return
+            self._write_key_ring(username, wrapped_keys)
+    
+    def _write_key_ring(self, username, wrapped_keys):
+        """Atomically replace a user's key ring (call with its lock held)"""
+        key_ring_file = self._key_ring_file(username)
+        tmp_file = key_ring_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            for chat_id, (wrapped_key, pending) in wrapped_keys.items():
+                f.write(json.dumps({
+                    'chat_id': chat_id,
+                    'wrapped_key': base64.b64encode(wrapped_key).decode('utf-8'),
+                    'pending': pending
+                }) + '\n')
+        os.replace(tmp_file, key_ring_file)
+    
     def authenticate_user(self, username, password):
         """Authenticate user with username and password"""
-        if username not in self.users:
+        record = self._get_record(username)
+        if record is None:
             return False, "User not found"
         
-        stored_hash = self.users[username].get('password_hash')
+        stored_hash = record.get('password_hash')
         if not stored_hash:
             return False, "User not found"
         
         if self._verify_password(password, stored_hash):
+            if self.password_hasher.needs_rehash(stored_hash):
+                self._rehash_password(username, password, stored_hash)
             return True, "Authentication successful"
         else:
             return False, "Invalid password"
     
     def add_friend(self, username, friend_username):
         """Add a friend to user's friend list"""
-        if username not in self.users:
+        if username not in self.directory:
             return False, "User not found"
         
-        if friend_username not in self.users:
+        if friend_username not in self.directory:
             return False, "Friend not found"
         
         if friend_username == username:
             return False, "Cannot add yourself as friend"
         
-        if friend_username not in self.users[username]['friends']:
-            self.users[username]['friends'].append(friend_username)
-            self._save_users()
-            return True, f"Added {friend_username} as friend"
-        else:
-            return False, "User is already your friend"
+        with self._record_lock(username):
+            record = self._get_record(username)
+            if friend_username in record['friends']:
+                return False, "User is already your friend"
+            # Cached records are shared, so replace rather than mutate them
+            self._save_record(dict(record, friends=record['friends'] + [friend_username]))
+            self._friends_versions[username] = self._friends_versions.get(username, 0) + 1
+        return True, f"Added {friend_username} as friend"
     
     def get_friends(self, username):
         """Get user's friend list"""
-        if username not in self.users:
+        record = self._get_record(username)
+        if record is None:
             return []
-        return self.users[username].get('friends', [])
+        return record.get('friends', [])
+    
+    def get_friends_version(self, username):
+        """Get the version of a user's friend list, bumped on every change"""
+        return self._friends_versions.get(username, 0)
+    
+    def list_friends(self, username, cursor=None, limit=100):
+        """Get a page of a user's friends and the cursor of the next page
+        
+        Friend lists only grow, so the cursor is the offset of the next page.
+        """
+        friends = self.get_friends(username)
+        start = int(cursor) if cursor else 0
+        if start < 0:
+            raise ValueError("Invalid cursor")
+        page = friends[start:start + limit]
+        next_cursor = str(start + limit) if start + limit < len(friends) else None
+        return page, next_cursor
+    
+    def list_users(self, cursor=None, limit=100):
+        """Get a page of usernames in sorted order and the cursor of the next page
+        
+        The cursor is the last username of the previous page, so pages stay
+        consistent while users register.
+        """
+        page, has_more = self.directory.page(cursor, limit)
+        next_cursor = page[-1] if has_more else None
+        return page, next_cursor
     
     def search_users(self, query, exclude_user=None):
         """Search for users by username"""
         matching_users = []
-        for username in self.users.keys():
+        for username in self.directory:
             if exclude_user and username == exclude_user:
                 continue
             if query.lower() in username.lower():